@@ -1,22 +1,38 @@
 from functools import partial
+from multiprocessing import Pool
 from pathlib import Path
 import shutil
 import menpobench
 from menpobench.cache import (retrieve_results, upload_results, can_upload,
-                              hash_of_id)
+                              hash_of_id, save_local_results,
+                              prefetch_cdn_misses, flush_uploads,
+                              close_uploads, defer_cdn_index_updates,
+                              publish_cdn_index, results_may_be_cached)
 from menpobench.config import resolve_cache_dir
+from menpobench.dataset.managed import MANAGED_DATASETS
+from menpobench.dataset.processed import has_processed_dataset
 from menpobench.exception import (CachedExperimentNotAvailable,
                                   MenpoCDNCredentialsMissingError,
-                                  OutputDirExistsError)
-from menpobench.experiment import retrieve_experiment
-from menpobench.method.matlab.base import resolve_matlab_bin_path
+                                  OutputDirExistsError,
+                                  TrainedModelNotAvailable)
+from menpobench.errormetric import retrieve_error_metrics
+from menpobench.experiment import retrieve_experiment, Experiment
+from menpobench.managed import prefetch_assets, DEFAULT_ASSET_JOBS
+from menpobench.method.cache import (retrieve_trained_model,
+                                     save_trained_model, trained_model_lock,
+                                     PICKLING_ERRORS)
+from menpobench.method.managed import MANAGED_METHODS
+from menpobench.method.matlab.base import (resolve_matlab_bin_path,
+                                           close_matlab_session)
 from menpobench.output import (save_test_results, compute_and_save_errors,
-                               plot_ceds)
-from menpobench.utils import centre_str, TempDirectory, norm_path, save_yaml
+                               plot_ceds, summarise_speed, ResultsLog)
+from menpobench.timing import (stage, save_timings, collect_timings,
+                               merge_timings, current_stage, within)
+from menpobench.utils import (centre_str, TempDirectory, norm_path, save_yaml,
+                              load_yaml, load_json)
 
 
-def invoke_train(train, training_f):
-    print(centre_str('training', c='-'))
+def train_method(train, training_f):
     print("Training '{}' with {}".format(train, training_f))
     train_set = training_f()
     test = train(train_set)
@@ -24,25 +40,80 @@ def invoke_train(train, training_f):
     return test
 
 
-def invoke_test(test, testing_f):
+def invoke_train(train, training_f, model_id=None):
+    print(centre_str('training', c='-'))
+    if model_id is None:
+        return train_method(train, training_f)
+    # if another process is training this model, wait for it rather than
+    # train it again
+    with trained_model_lock(model_id):
+        try:
+            test = train.wrap_test(retrieve_trained_model(model_id))
+        except TrainedModelNotAvailable as e:
+            print("{} for '{}' - training.".format(e, train))
+        else:
+            print("Loaded cached model of '{}' - skipping "
+                  "training.".format(train))
+            return test
+        test = train_method(train, training_f)
+        print("Caching trained model of '{}'".format(train))
+        with stage('save_model'):
+            try:
+                save_trained_model(test.test, model_id)
+            except PICKLING_ERRORS as e:
+                # the model is still good for this run
+                print("Warning: the trained model of '{}' cannot be pickled "
+                      "({}) - carrying on without caching it".format(train, e))
+    return test
+
+
+def iter_test_results(test, testing_f, fit_jobs=1, skip_ids=None):
     print(centre_str('testing', c='-'))
     print("Testing '{}' with {}".format(test, testing_f))
-    test_set = testing_f()
-    results = test(test_set)
+    test_set = testing_f(skip_ids=skip_ids)
+    # the test set records ids and gt shapes as it is consumed, so they are
+    # always available by the time the corresponding result is produced
+    for r in test(test_set, n_jobs=fit_jobs):
+        id_, gt_shape = test_set.pop_oldest()
+        yield id_, {'gt': gt_shape.points.tolist(), 'result': r.tojson()}
     print("Testing of '{}' completed.\n".format(test))
-    return {id_: {'gt': gt.points.tolist(),
-                  'result': r.tojson()}
-            for (id_, r, gt) in zip(test_set.ids, results, test_set.gt_shapes)}
 
 
-def invoke_train_and_test(training_f, train, testing_f):
-    test = invoke_train(train, training_f)
-    return invoke_test(test, testing_f)
+def invoke_test(test, testing_f, fit_jobs=1, results_log=None,
+                resume=False):
+    skip_ids = None
+    if resume and results_log is not None and results_log.exists():
+        # pick up where an interrupted run left off
+        skip_ids = results_log.recorded_ids()
+        print('Resuming - {} test results already recorded'.format(
+            len(skip_ids)))
+    results = iter_test_results(test, testing_f, fit_jobs=fit_jobs,
+                                skip_ids=skip_ids)
+    if results_log is None:
+        return dict(results)
+    else:
+        # stream every result to disk as soon as it is available
+        results_log.extend(results, append=skip_ids is not None)
+        return results_log
+
+
+def invoke_train_and_test(training_f, train, testing_f, model_id=None,
+                          fit_jobs=1, results_log=None, resume=False):
+    test = invoke_train(train, training_f, model_id=model_id)
+    return invoke_test(test, testing_f, fit_jobs=fit_jobs,
+                       results_log=results_log, resume=resume)
+
+
+def mkdir_if_missing(path):
+    if not path.is_dir():
+        path.mkdir()
 
 
 def invoke_benchmark(experiment_name, output_dir=None, overwrite=False,
                      matlab=False, upload=False, force=False,
-                     force_upload=False):
+                     force_upload=False, jobs=1, cache_models=False,
+                     fit_jobs=None, stream=False, resume=False,
+                     binary=False, shard=None):
     print('')
     print(centre_str('- - - -  M E N P O B E N C H  - - - -'))
     if upload:
@@ -60,9 +131,28 @@ def invoke_benchmark(experiment_name, output_dir=None, overwrite=False,
     print(centre_str('cache: {}'.format(resolve_cache_dir())))
     if force:
         print(centre_str('FORCED RECOMPUTATION ENABLED'))
+    if jobs > 1:
+        print(centre_str('jobs: {}'.format(jobs)))
+    if cache_models:
+        print(centre_str('TRAINED MODEL CACHING ENABLED'))
+    if resume:
+        # resuming relies on the per-image results log
+        stream = True
+        print(centre_str('RESUME ENABLED'))
 
     # Load the experiment and check it's schematically valid
-    ex = retrieve_experiment(experiment_name)
+    ex = retrieve_experiment(experiment_name, shard=shard)
+    if ex.shard is not None:
+        print(centre_str('shard: {} of {}'.format(*ex.shard)))
+
+    # the command line takes precedence over the experiment for fitting
+    if fit_jobs is None:
+        fit_jobs = ex.fit_jobs
+    elif fit_jobs < 1:
+        raise ValueError('fit_jobs must be at least 1, '
+                         'not {}'.format(fit_jobs))
+    if fit_jobs > 1:
+        print(centre_str('fit jobs: {}'.format(fit_jobs)))
 
     # Check if we have any dependency on matlab
     if ex.depends_on_matlab:
@@ -73,98 +163,319 @@ def invoke_benchmark(experiment_name, output_dir=None, overwrite=False,
         # Handle the creation of the output directory
         output_dir = Path(norm_path(output_dir))
         if output_dir.is_dir():
-            if not overwrite:
+            if resume:
+                check_resumable(output_dir, ex)
+                print('--resume passed and output directory {} exists - '
+                      'continuing\n'.format(output_dir))
+            elif not overwrite:
                 raise OutputDirExistsError(
                     "Output directory {} already exists.\n"
                     "Pass '--overwrite' if you want menpobench to delete this "
-                    "directory automatically.".format(output_dir))
+                    "directory automatically, or '--resume' to continue an "
+                    "interrupted run.".format(output_dir))
             else:
                 print('--overwrite passed and output directory {} exists - '
                       'deleting\n'.format(output_dir))
                 shutil.rmtree(str(output_dir))
-        output_dir.mkdir()
+        mkdir_if_missing(output_dir)
         errors_dir = output_dir / 'errors'
         results_dir = output_dir / 'results'
-        errors_dir.mkdir()
-        results_dir.mkdir()
+        mkdir_if_missing(errors_dir)
+        mkdir_if_missing(results_dir)
         results_trainable_dir = results_dir / 'trainable_methods'
         results_untrainable_dir = results_dir / 'untrainable_methods'
         errors_trainable_dir = errors_dir / 'trainable_methods'
         errors_untrainable_dir = errors_dir / 'untrainable_methods'
         save_yaml(ex.config, str(output_dir / 'experiment.yaml'))
 
-    run = partial(run_method, ex, upload=upload, force=force,
-                  force_upload=force_upload, matlab=matlab,
-                  output=(output_dir is not None))
+    run_kwargs = dict(upload=upload, force=force, force_upload=force_upload,
+                      matlab=matlab, output=(output_dir is not None),
+                      cache_models=cache_models, fit_jobs=fit_jobs,
+                      stream=(stream and output_dir is not None),
+                      resume=resume, binary=binary)
+    run = partial(run_method, ex, **run_kwargs)
+    # with more than one job the methods are queued up here and dispatched
+    # to a process pool once both sections have been walked
+    queued = []
     try:
-        if ex.n_trainable_methods > 0:
-            print(centre_str('I. TRAINABLE METHODS'))
-            if output_dir is not None:
-                results_trainable_dir.mkdir()
-                errors_trainable_dir.mkdir()
-            else:
-                results_trainable_dir = None
-                errors_trainable_dir = None
-
-            for i, train in enumerate(ex.trainable_methods, 1):
-                print(centre_str('{}/{} - {}'.format(i, ex.n_trainable_methods,
-                                                     train), c='='))
-                run(train, trainable=True,
-                    errors_dir=errors_trainable_dir,
-                    results_dir=results_trainable_dir)
-
-        if ex.n_untrainable_methods > 0:
-            print(centre_str('II. UNTRAINABLE METHODS', c=' '))
+        # every stage of the run is nested inside this one
+        with stage('benchmark'):
+            if not force:
+                # find out which methods the CDN doesn't hold in one go
+                ids = [cache_id(ex, m, t) for ms, t in
+                       [(ex.trainable_methods, True),
+                        (ex.untrainable_methods, False)] for m in ms]
+                prefetch_cdn_misses([i for i in ids if i is not None])
+
+            # fetch every asset the methods that will run need up front (and
+            # all at once) rather than as each dataset or method first needs it
+            running = [(m, t) for ms, t in [(ex.trainable_methods, True),
+                                            (ex.untrainable_methods, False)]
+                       for m in ms if method_will_run(
+                           ex, m, t, force=force, upload=upload,
+                           force_upload=force_upload, output_dir=output_dir,
+                           resume=resume)]
+            prefetch_assets(experiment_assets(ex, running=running))
+
+            if ex.n_trainable_methods > 0:
+                print(centre_str('I. TRAINABLE METHODS'))
+                if output_dir is not None:
+                    mkdir_if_missing(results_trainable_dir)
+                    mkdir_if_missing(errors_trainable_dir)
+                else:
+                    results_trainable_dir = None
+                    errors_trainable_dir = None
+
+                for i, train in enumerate(ex.trainable_methods, 1):
+                    if jobs > 1:
+                        # the worker running the method prints its banner
+                        queued.append((True, i - 1, errors_trainable_dir,
+                                       results_trainable_dir))
+                    else:
+                        print_method_banner(i, ex.n_trainable_methods, train)
+                        run(train, trainable=True,
+                            errors_dir=errors_trainable_dir,
+                            results_dir=results_trainable_dir)
+
+            if ex.n_untrainable_methods > 0:
+                print(centre_str('II. UNTRAINABLE METHODS', c=' '))
+                if output_dir is not None:
+                    mkdir_if_missing(results_untrainable_dir)
+                    mkdir_if_missing(errors_untrainable_dir)
+                else:
+                    results_untrainable_dir = None
+                    errors_untrainable_dir = None
+
+                for i, test in enumerate(ex.untrainable_methods, 1):
+                    if jobs > 1:
+                        queued.append((False, i - 1, errors_untrainable_dir,
+                                       results_untrainable_dir))
+                    else:
+                        print_method_banner(i, ex.n_untrainable_methods, test)
+                        run(test, trainable=False,
+                            errors_dir=errors_untrainable_dir,
+                            results_dir=results_untrainable_dir)
+
+            if len(queued) > 0:
+                run_methods_in_pool(ex, queued, jobs, **run_kwargs)
+
+            # uploads run in the background - make sure they have all landed
+            flush_uploads()
+
+            # We now have all the results computed - draw the CED curves.
             if output_dir is not None:
-                results_untrainable_dir.mkdir()
-                errors_untrainable_dir.mkdir()
-            else:
-                results_untrainable_dir = None
-                errors_untrainable_dir = None
-
-            for i, test in enumerate(ex.untrainable_methods, 1):
-                print(centre_str('{}/{} - '
-                                 '{}'.format(i, ex.n_untrainable_methods,
-                                             test), c='='))
-                run(test, trainable=False,
-                    errors_dir=errors_untrainable_dir,
-                    results_dir=results_untrainable_dir)
-
-        # We now have all the results computed - draw the CED curves.
+                plot_ceds(output_dir)
+                summarise_speed(output_dir)
+    finally:
+        close_uploads()
+        close_matlab_session()
+        TempDirectory.delete_all()
         if output_dir is not None:
-            plot_ceds(output_dir)
+            save_timings(output_dir / 'timings.json')
+
+
+def method_will_run(ex, method, trainable, force=False, upload=False,
+                    force_upload=False, output_dir=None, resume=False):
+    r"""False if run_method would take the results of a method from a cache
+    (or a previous run being resumed) without running it. Results that might
+    be on the CDN are assumed to be.
+    """
+    if resume and output_dir is not None:
+        section = 'trainable_methods' if trainable else 'untrainable_methods'
+        if method_is_complete(method, output_dir / 'results' / section,
+                              output_dir / 'errors' / section):
+            return False
+    if force:
+        return True
+    id_ = cache_id(ex, method, trainable)
+    if id_ is None:
+        # uncachable methods are only run to produce output
+        return output_dir is not None
+    if force_upload and upload:
+        return True
+    return not results_may_be_cached(id_, local=not upload)
+
+
+def experiment_assets(ex, running=None):
+    r"""(asset set, name) pairs for each managed asset declared by the
+    datasets and methods of an experiment. If given a list of the
+    (method, trainable) pairs that will run, only what they need is
+    included.
+    """
+    if running is None:
+        running = ([(m, True) for m in ex.trainable_methods] +
+                   [(m, False) for m in ex.untrainable_methods])
+    if len(running) == 0:
+        return []
+    datasets = list(ex.testing.datasets)
+    if any(trainable for _, trainable in running):
+        datasets += ex.training.datasets
+    # datasets in the processed cache never touch their assets
+    datasets = [d for d in datasets
+                if not (d.cachable and has_processed_dataset(d))]
+    assets = []
+    for asset_set, modules in [(MANAGED_DATASETS, datasets),
+                               (MANAGED_METHODS, [m for m, _ in running])]:
+        names = set(n for m in modules
+                    for n in m.metadata.get('managed_assets', []))
+        assets += [(asset_set, n) for n in sorted(names)]
+    return assets
+
+
+def prefetch_experiment(experiment_name, n_jobs=DEFAULT_ASSET_JOBS):
+    r"""Download and unpack everything an experiment needs, without running
+    it.
+    """
+    ex = retrieve_experiment(experiment_name)
+    try:
+        prefetch_assets(experiment_assets(ex), n_jobs=n_jobs)
     finally:
         TempDirectory.delete_all()
 
 
-# Runs a single method in an experiment.
-def run_method(ex, method, trainable=True, upload=False, force=False,
-               force_upload=False, output=False, errors_dir=None,
-               results_dir=None, matlab=False):
-    id_f = ex.trainable_id if trainable else ex.untrainable_id
-    run = (partial(invoke_train_and_test, ex.training) if trainable
-           else invoke_test)
-    cachable = ex.testing.predefined and method.predefined
+def check_resumable(output_dir, ex):
+    experiment_path = output_dir / 'experiment.yaml'
+    if not experiment_path.is_file():
+        raise OutputDirExistsError(
+            "Output directory {} has no experiment.yaml - it was not written "
+            "by a menpobench run and cannot be resumed.".format(output_dir))
+    if load_yaml(experiment_path) != ex.config:
+        raise OutputDirExistsError(
+            "Output directory {} holds the results of a different experiment "
+            "and cannot be resumed.".format(output_dir))
+
+
+def method_is_complete(method, results_dir, errors_dir):
+    # errors are only ever written after the full results
+    return ((results_dir / '{}.json'.format(method.name)).is_file() and
+            (errors_dir / '{}.json'.format(method.name)).is_file())
+
+
+def run_methods_in_pool(ex, queued, jobs, **kwargs):
+    # Only the experiment config crosses the process boundary - methods and
+    # datasets hold dynamically loaded modules which cannot be pickled, so
+    # each worker rebuilds the experiment and looks the method up by index.
+    print(centre_str('running {} methods over {} '
+                     'processes'.format(len(queued), jobs), c='='))
+    pool = Pool(processes=min(jobs, len(queued)))
+    try:
+        pending = [pool.apply_async(_run_method_in_worker,
+                                    (ex.config, trainable, i, errors_dir,
+                                     results_dir, current_stage(), kwargs))
+                   for trainable, i, errors_dir, results_dir in queued]
+        pool.close()
+        # block until every worker is done, re-raising the first failure
+        uploaded = []
+        for p in pending:
+            timings, worker_uploaded = p.get()
+            merge_timings(timings)
+            uploaded += worker_uploaded
+        # workers leave the CDN index to us, so it is only rewritten once
+        publish_cdn_index(uploaded)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def print_method_banner(i, n, method):
+    print(centre_str('{}/{} - {}'.format(i, n, method), c='='))
+
+
+def _run_method_in_worker(config, trainable, i, errors_dir, results_dir,
+                          parent_stage, kwargs):
+    # a forked worker inherits the parent's temp dirs (e.g. unpacked assets)
+    # - only the ones this method creates are the worker's to delete
+    TempDirectory.forget_all()
+    # ...and what the parent has timed so far, which it still holds - only
+    # what is timed here is handed back
+    collect_timings()
+    ex = Experiment(config)
+    methods = ex.trainable_methods if trainable else ex.untrainable_methods
+    print_method_banner(i + 1, len(methods), methods[i])
+    defer_cdn_index_updates()
+    try:
+        with within(parent_stage):
+            run_method(ex, methods[i], trainable=trainable,
+                       errors_dir=errors_dir, results_dir=results_dir,
+                       **kwargs)
+        uploaded = flush_uploads()
+        # hand what was timed and uploaded in this process back to the parent
+        return collect_timings(), uploaded
+    finally:
+        close_uploads()
+        close_matlab_session()
+        TempDirectory.delete_all()
+
+
+# The id results of a method are cached under, or None if it is uncachable.
+def cache_id(ex, method, trainable):
+    # results for part of the test set can't stand in for the full set
+    cachable = (ex.shard is None and ex.testing.predefined and
+                method.predefined)
     if trainable:
         # to cache a trainable method we also need the experiment training
         # to be predefined
         cachable = cachable and ex.training.predefined
+    if not cachable:
+        return None
+    return ex.trainable_id(method) if trainable else ex.untrainable_id(method)
+
+
+# Runs a single method in an experiment.
+def run_method(ex, method, **kwargs):
+    # labelled with the section output is saved under, as method names are
+    # only unique within one
+    section = ('trainable_methods' if kwargs.get('trainable', True) else
+               'untrainable_methods')
+    with stage('method', method=method.name, section=section):
+        return _run_method(ex, method, **kwargs)
+
+
+def _run_method(ex, method, trainable=True, upload=False, force=False,
+               force_upload=False, output=False, errors_dir=None,
+               results_dir=None, matlab=False, cache_models=False,
+               fit_jobs=1, stream=False, resume=False, binary=False):
+    if resume and output and method_is_complete(method, results_dir,
+                                                errors_dir):
+        print("Results for '{}' already present - skipping.\n".format(method))
+        return
+    # when streaming, results are logged next to where the final JSON will go
+    results_log = (ResultsLog(results_dir / '{}.jsonl'.format(method.name))
+                   if stream else None)
+    if trainable:
+        # Models are pickled, so only methods trained in-process on a
+        # predefined training set can be cached.
+        model_cachable = (cache_models and ex.training.predefined and
+                          method.predefined and not method.depends_on_matlab)
+        model_id = ex.trained_model_id(method) if model_cachable else None
+        run = partial(invoke_train_and_test, ex.training, model_id=model_id,
+                      fit_jobs=fit_jobs, results_log=results_log,
+                      resume=resume)
+    else:
+        run = partial(invoke_test, fit_jobs=fit_jobs, results_log=results_log,
+                      resume=resume)
+    id_ = cache_id(ex, method, trainable)
+    cachable = id_ is not None
 
     if not force:
         if cachable:
-            id_ = id_f(method)
             id_hash = hash_of_id(id_)[:5]
             print(centre_str('[ cache id: {} ]'.format(id_hash)))
             if force_upload and upload:
                 results = run(method, ex.testing)
+                save_local_results(results, id_)
                 print('Uploading results for {} (forced)'.format(id_hash))
                 upload_results(results, id_)
             else:
                 try:
-                    results = retrieve_results(id_)
+                    # when uploading we need to know what the CDN has, so
+                    # can't stop at the local cache
+                    with stage('cache_lookup', method=method.name):
+                        results = retrieve_results(id_, local=not upload)
                 except CachedExperimentNotAvailable:
                     print('No cached version of {}.'.format(id_hash))
                     results = run(method, ex.testing)
+                    save_local_results(results, id_)
                     if upload:
                         print('Uploading results for {}'.format(id_hash))
                         upload_results(results, id_)
@@ -179,9 +490,62 @@ def run_method(ex, method, trainable=True, upload=False, force=False,
             results = run(method, ex.testing)
     else:
         results = run(method, ex.testing)
+        if cachable:
+            # refresh the local cache with the recomputed results
+            save_local_results(results, id_)
 
     if output:
-        save_test_results(results, method.name, results_dir, matlab=matlab)
+        save_test_results(results, method.name, results_dir, matlab=matlab,
+                          binary=binary)
         compute_and_save_errors(results, ex.error_metrics, method.name,
-                                errors_dir)
+                                errors_dir, binary=binary)
+        if isinstance(results, ResultsLog):
+            # the final JSON now holds everything the log did
+            results.delete()
         print("Results saved for '{}'.\n".format(method))
+
+
+def merge_shards(shard_dirs, output_dir, overwrite=False):
+    r"""Merge the output directories of runs over every shard of an
+    experiment's test set into a single output directory, as if the
+    experiment had been run in one go.
+    """
+    shard_dirs = [Path(norm_path(d)) for d in shard_dirs]
+    output_dir = Path(norm_path(output_dir))
+    configs = [load_yaml(d / 'experiment.yaml') for d in shard_dirs]
+    shards = [tuple(c.pop('shard', (1, 1))) for c in configs]
+    config = configs[0]
+    if any(c != config for c in configs[1:]):
+        raise ValueError('Shards were run for different experiments')
+    n = shards[0][1]
+    if sorted(shards) != [(k, n) for k in range(1, n + 1)]:
+        raise ValueError('Expected each of shards 1 to {} exactly once, got '
+                         '{}'.format(n, ', '.join('{} of {}'.format(*s)
+                                                  for s in shards)))
+    if output_dir.is_dir():
+        if not overwrite:
+            raise OutputDirExistsError(
+                "Output directory {} already exists.\n"
+                "Pass '--overwrite' if you want menpobench to delete this "
+                "directory automatically.".format(output_dir))
+        shutil.rmtree(str(output_dir))
+    print(centre_str('merging {} shards into {}'.format(n, output_dir)))
+    mkdir_if_missing(output_dir)
+    save_yaml(config, str(output_dir / 'experiment.yaml'))
+    error_metrics = retrieve_error_metrics(config['error_metric'])
+    # every shard holds results for the same methods
+    for path in sorted((shard_dirs[0] / 'results').glob('*/*.json')):
+        section = path.parent.name
+        results = {}
+        for d in shard_dirs:
+            results.update(load_json(d / 'results' / section / path.name))
+        results_dir = output_dir / 'results' / section
+        errors_dir = output_dir / 'errors' / section
+        for p in [results_dir.parent, results_dir, errors_dir.parent,
+                  errors_dir]:
+            mkdir_if_missing(p)
+        save_test_results(results, path.stem, results_dir)
+        compute_and_save_errors(results, error_metrics, path.stem,
+                                errors_dir)
+    plot_ceds(output_dir)
+    summarise_speed(output_dir)
@@ -0,0 +1,251 @@
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from menpobench.config import resolve_cache_dir
+from menpobench.ledger import (ledger_checksum, record_verified, update_ledger,
+                               load_ledger)
+from menpobench.utils import create_path, checksum, file_lock
+
+# Downloaded archives are stored once, by content, in a blob store keyed on
+# their SHA-1. The archive paths that menpobench uses (one per asset name,
+# release version and cache version) are hard links into the store, and a ref
+# file per archive path records which blob it is. An archive whose checksum is
+# already known (or has been recorded by a ref) is therefore never downloaded
+# or hashed twice, whatever it is called. Blobs are only stored, linked to or
+# garbage collected while holding the blob store lock - a blob is otherwise
+# unreferenced between being stored and its ref being written.
+
+# file locks only exclude other processes - assets may also be fetched on
+# several threads at once
+_THREAD_LOCK = threading.Lock()
+
+
+# ----------- Cache path management ---------- #
+
+@create_path
+def blob_dir():
+    return resolve_cache_dir() / 'blobs'
+
+
+@create_path
+def ref_dir():
+    return resolve_cache_dir() / 'refs'
+
+
+def blob_lock_path():
+    # kept out of blob_dir(), where every file is taken to be a blob
+    return resolve_cache_dir() / 'blobs.lock'
+
+
+@contextmanager
+def blob_store_lock():
+    with _THREAD_LOCK, file_lock(blob_lock_path()):
+        yield
+
+
+def blob_path(sha1):
+    return blob_dir() / sha1[:2] / sha1
+
+
+def has_blob(sha1):
+    return blob_path(sha1).is_file()
+
+
+def has_valid_blob(sha1):
+    r"""True if the blob for sha1 is stored and intact. The blob is only
+    re-hashed if it has changed on disk since it was last verified - a blob
+    found to be corrupt is deleted.
+    """
+    if not has_blob(sha1):
+        return False
+    if ledger_checksum(blob_path(sha1)) == sha1:
+        return True
+    delete_blob(sha1)
+    return False
+
+
+def ref_path(path):
+    # refs mirror the layout of the archives they describe
+    return ref_dir() / path.relative_to(resolve_cache_dir())
+
+
+# ----------- Refs ---------- #
+
+def read_ref(path):
+    r"""The SHA-1 of the blob an archive path refers to, or None."""
+    ref = ref_path(path)
+    if not ref.is_file():
+        return None
+    with open(str(ref), 'rt') as f:
+        return f.read().strip()
+
+
+def write_ref(path, sha1):
+    ref = ref_path(path)
+    if not ref.parent.is_dir():
+        os.makedirs(str(ref.parent))
+    with open(str(ref), 'wt') as f:
+        f.write(sha1)
+
+
+def delete_ref(path):
+    ref = ref_path(path)
+    if ref.is_file():
+        ref.unlink()
+
+
+# ----------- Blobs ---------- #
+
+def link_or_copy(src, dest):
+    try:
+        os.link(str(src), str(dest))
+    except (AttributeError, OSError):
+        # no hard links (Py2 on Windows, or the cache spans devices) - fall
+        # back to a copy, moved into place so it is never seen half written
+        fd, tmp_path = tempfile.mkstemp(prefix=dest.name,
+                                        dir=str(dest.parent))
+        os.close(fd)
+        shutil.copyfile(str(src), tmp_path)
+        os.rename(tmp_path, str(dest))
+
+
+def store_blob(path, sha1):
+    r"""Add the file at path (which must have the given SHA-1) to the blob
+    store and record a ref to it. The file at path is left in place, sharing
+    its bytes with the blob.
+    """
+    with blob_store_lock():
+        _store_blob(path, sha1)
+
+
+def _store_blob(path, sha1):
+    blob = blob_path(sha1)
+    if not blob.parent.is_dir():
+        try:
+            os.makedirs(str(blob.parent))
+        except OSError:
+            # another process made it first
+            pass
+    if blob.is_file():
+        # these bytes are already stored - share them rather than keep a
+        # second copy
+        if not os.path.samefile(str(path), str(blob)):
+            path.unlink()
+            link_or_copy(blob, path)
+    else:
+        try:
+            link_or_copy(path, blob)
+        except OSError:
+            # another process stored the same blob first
+            if not blob.is_file():
+                raise
+    # the caller has just hashed these bytes
+    record_verified(blob, sha1)
+    write_ref(path, sha1)
+
+
+def link_blob(sha1, path):
+    r"""Make path refer to the stored blob with the given SHA-1, if it is
+    stored and intact. Returns False if it isn't.
+    """
+    with blob_store_lock():
+        if not has_valid_blob(sha1):
+            return False
+        _link_blob(sha1, path)
+        return True
+
+
+def _link_blob(sha1, path):
+    blob = blob_path(sha1)
+    if path.is_file():
+        if os.path.samefile(str(path), str(blob)):
+            write_ref(path, sha1)
+            return
+        path.unlink()
+    link_or_copy(blob, path)
+    write_ref(path, sha1)
+
+
+def delete_blob(sha1):
+    blob = blob_path(sha1)
+    update_ledger(forget=[blob])
+    blob.unlink()
+
+
+# ----------- Garbage collection and verification ---------- #
+
+def iter_files(directory):
+    for root, _, files in os.walk(str(directory)):
+        for f in files:
+            yield os.path.join(root, f)
+
+
+def iter_refs():
+    # (archive path, ref path, sha1) for every ref
+    cache_dir = resolve_cache_dir()
+    for ref in iter_files(ref_dir()):
+        archive = cache_dir / os.path.relpath(ref, str(ref_dir()))
+        with open(ref, 'rt') as f:
+            yield archive, ref, f.read().strip()
+
+
+def verify_blobs(verbose=True):
+    r"""Re-hash every stored blob, whether or not it has changed since it
+    was last verified. Corrupt blobs are deleted along with the archives that
+    share their bytes, so they are downloaded again when next needed. Returns
+    the number of blobs found to be corrupt.
+    """
+    corrupt = set()
+    for blob in iter_files(blob_dir()):
+        sha1 = os.path.basename(blob)
+        if verbose:
+            print('Verifying {}'.format(sha1))
+        if checksum(blob) == sha1:
+            record_verified(blob_path(sha1), sha1)
+        else:
+            print("Warning: blob '{}' is corrupt - deleting".format(sha1))
+            delete_blob(sha1)
+            corrupt.add(sha1)
+    for archive, ref, sha1 in iter_refs():
+        if sha1 in corrupt:
+            if archive.is_file():
+                archive.unlink()
+            os.remove(ref)
+    # forget anything in the ledger that is no longer in the cache
+    cache_dir = resolve_cache_dir()
+    update_ledger(forget=[cache_dir / k for k in load_ledger()
+                          if not (cache_dir / k).is_file()])
+    if verbose:
+        print('Verified blobs - {} corrupt'.format(len(corrupt)))
+    return len(corrupt)
+
+
+def collect_garbage(verbose=True):
+    r"""Delete refs to archives that no longer exist, and then every blob that
+    isn't referred to. Returns the number of blobs deleted and the bytes
+    freed.
+    """
+    with blob_store_lock():
+        return _collect_garbage(verbose=verbose)
+
+
+def _collect_garbage(verbose=True):
+    referenced = set()
+    for archive, ref, sha1 in iter_refs():
+        if archive.is_file():
+            referenced.add(sha1)
+        else:
+            os.remove(ref)
+    n_deleted, n_bytes = 0, 0
+    for blob in iter_files(blob_dir()):
+        sha1 = os.path.basename(blob)
+        if sha1 not in referenced:
+            n_bytes += os.path.getsize(blob)
+            delete_blob(sha1)
+            n_deleted += 1
+    if verbose:
+        print('Deleted {} unreferenced blobs ({:.1f} MB)'.format(
+            n_deleted, n_bytes / 1024.0 ** 2))
+    return n_deleted, n_bytes
@@ -1,17 +1,39 @@
 import hashlib
 import json
 import gzip
+import os
+import tempfile
+import time
 from io import BytesIO
+from threading import Thread
+try:
+    from queue import Queue  # Py3
+except ImportError:
+    from Queue import Queue  # Py2
 import menpobench
 from menpobench.config import resolve_cache_dir, load_config
 from menpobench.managed import (WebSource, MENPO_CDN_URL,
                                 download_asset_if_needed)
-from menpobench.utils import create_path, HTTPError, load_json
+from menpobench.output import (ArrayResults, write_results_array,
+                               write_results_json)
+from menpobench.utils import (create_path, HTTPError, URLError, load_json,
+                              save_json, urlopen, Request, file_lock)
 from menpobench.exception import (CachedExperimentNotAvailable,
                                   MissingConfigKeyError)
 
 MENPO_CDN_EXPERIMENT_URL = MENPO_CDN_URL + 'experiments/'
 
+# Where results are uploaded to - MENPO_CDN_URL is this bucket on this
+# endpoint
+DEFAULT_S3_ENDPOINT = 's3-eu-west-1.amazonaws.com'
+DEFAULT_S3_BUCKET = 'cdn.menpo.org'
+
+# Default limit on the size of the local results cache, in megabytes
+DEFAULT_RESULTS_CACHE_MAX_MB = 1024
+
+# Default time for which a failed CDN lookup is remembered, in seconds
+DEFAULT_CDN_MISS_TTL = 60 * 60
+
 
 # ----------- Cache path management ---------- #
 
@@ -25,35 +47,282 @@ def experiment_dir_for_version(version):
     return experiment_dir() / version
 
 
+@create_path
+def local_results_dir():
+    return resolve_cache_dir() / 'results'
+
+
+@create_path
+def local_results_dir_for_version(version):
+    return local_results_dir() / version
+
+
 # ----------- DatasetSource Classes ---------- #
 
 class CDNExperimentSource(WebSource):
 
     def __init__(self, name, version):
-        url = MENPO_CDN_EXPERIMENT_URL + '{}/{}.json.gz'.format(version, name)
+        url = cdn_experiment_url() + '{}/{}.json.gz'.format(version, name)
         self.version = version
         super(CDNExperimentSource, self).__init__(name, url, None)
 
     def _download_cache_dir(self):
         return experiment_dir_for_version(self.version)
 
-    def validate_archive_checksum(self):
+    def validate_checksum(self, sha1):
         # unfortunately, we can't know ahead of time the SHAs of all the
         # experiments
         return True
 
+    def validate_archive_checksum(self):
+        return True
+
+    def array_path(self):
+        # a binary copy of the downloaded results, see ArrayResults
+        return self._download_cache_dir() / '{}.npz'.format(self.name)
+
+
+# ----------- CDN location ---------- #
+#
+# Results are read from the Menpo CDN unless an S3 endpoint is configured, in
+# which case they are read back from the configured bucket on that endpoint -
+# the same place they are uploaded to.
+
+def s3_tls():
+    tls = load_config().get('MENPO_CDN_S3_TLS', True)
+    if isinstance(tls, str):
+        # set with 'menpobench config'
+        tls = tls.lower() not in ('false', 'no', '0')
+    return tls
+
+
+def cdn_experiment_url():
+    c = load_config()
+    if 'MENPO_CDN_S3_ENDPOINT' not in c:
+        return MENPO_CDN_EXPERIMENT_URL
+    # the virtual host style URL that uploads are made to
+    return '{}://{}.{}/experiments/'.format(
+        'https' if s3_tls() else 'http',
+        c.get('MENPO_CDN_S3_BUCKET', DEFAULT_S3_BUCKET),
+        c['MENPO_CDN_S3_ENDPOINT'])
+
+
+def cdn_key(version, name):
+    return 'experiments/{}/{}'.format(version, name)
+
+
+# ----------- Local results cache ---------- #
+#
+# Results computed locally are kept (keyed like the CDN on the cache version
+# and hash of the experiment id) so repeated runs never recompute them. The
+# cache is kept under a configurable size by evicting the least recently used
+# results.
+
+def local_results_paths(id_):
+    d = local_results_dir_for_version(cache_version())
+    h = hash_of_id(id_)
+    # results are stored as arrays where possible, JSON otherwise
+    return d / '{}.npz'.format(h), d / '{}.json.gz'.format(h)
 
-# ----------- Magic dataset contextmanager ---------- #
 
+def results_cache_max_bytes():
+    mb = load_config().get('results_cache_max_mb',
+                           DEFAULT_RESULTS_CACHE_MAX_MB)
+    return int(mb) * 1024 * 1024
 
-def retrieve_results(id_):
-    potential_asset = CDNExperimentSource(hash_of_id(id_), cache_version())
+
+def retrieve_local_results(id_):
+    for path in local_results_paths(id_):
+        if path.is_file():
+            # mark as recently used
+            os.utime(str(path), None)
+            if path.suffix == '.npz':
+                return ArrayResults.load(path)
+            else:
+                return load_json(path)
+    raise CachedExperimentNotAvailable('No locally cached experiment '
+                                       'available')
+
+
+def results_may_be_cached(id_, local=True):
+    r"""False only if the results of an experiment are known not to be
+    cached - locally (if local is True) or on the CDN, going by the CDN miss
+    cache.
+    """
+    if local and any(p.is_file() for p in local_results_paths(id_)):
+        return True
+    id_hash, version = hash_of_id(id_), cache_version()
+    source = CDNExperimentSource(id_hash, version)
+    if source.array_path().is_file() or source.archive_path().is_file():
+        return True
+    return id_hash not in load_cdn_misses(version)
+
+
+def save_local_results(results, id_):
+    array_path, json_path = local_results_paths(id_)
+    # results may be streamed from an on-disk ResultsLog
     try:
-        download_asset_if_needed(potential_asset, verbose=True, )
+        write_results_array(results, array_path)
+    except ValueError:
+        with gzip.open(str(json_path), 'wt') as f:
+            write_results_json(results, f.write, pretty=False)
+    evict_local_results(results_cache_max_bytes())
+
+
+def evict_local_results(max_bytes):
+    paths = [p for p in local_results_dir().glob('*/*') if p.is_file()]
+    stats = dict((p, p.stat()) for p in paths)
+    total = sum(s.st_size for s in stats.values())
+    # oldest first
+    for p in sorted(paths, key=lambda p: stats[p].st_mtime):
+        if total <= max_bytes:
+            break
+        total -= stats[p].st_size
+        p.unlink()
+
+
+# ----------- CDN miss (negative) cache ---------- #
+#
+# The CDN reports a missing experiment by failing the download. Misses are
+# remembered per cache version for a short while (cdn_miss_ttl seconds in the
+# config) so they aren't requested again on every run. The CDN can also
+# publish an index of the experiments it holds per cache version, letting all
+# the misses of an experiment be found with a single request. Uploaders can
+# race to rewrite the index, so it can be missing entries - but a miss is only
+# trusted for the TTL, after which the experiment is looked for again. Only if
+# the CDN has no index at all is each experiment checked with a HEAD request.
+
+def cdn_miss_ttl():
+    return int(load_config().get('cdn_miss_ttl', DEFAULT_CDN_MISS_TTL))
+
+
+def cdn_misses_path(version):
+    return experiment_dir_for_version(version) / 'misses.json'
+
+
+def cdn_misses_lock_path(version):
+    return experiment_dir_for_version(version) / 'misses.lock'
+
+
+def load_cdn_misses(version):
+    path = cdn_misses_path(version)
+    if not path.is_file():
+        return {}
+    now, ttl = time.time(), cdn_miss_ttl()
+    return dict((h, t) for h, t in load_json(path).items() if now - t < ttl)
+
+
+def update_cdn_misses(version, add=(), remove=()):
+    with file_lock(cdn_misses_lock_path(version)):
+        # loading drops any expired misses
+        misses = load_cdn_misses(version)
+        now = time.time()
+        for h in add:
+            misses[h] = now
+        for h in remove:
+            misses.pop(h, None)
+        # readers don't take the lock - never let them see a partial write
+        path = cdn_misses_path(version)
+        tmp_path = path.with_suffix('.json.tmp')
+        save_json(misses, tmp_path)
+        os.rename(str(tmp_path), str(path))
+
+
+def cdn_index_url(version):
+    return cdn_experiment_url() + '{}/index.json'.format(version)
+
+
+def fetch_cdn_index(version):
+    r"""The set of experiment hashes held on the CDN for a cache version, or
+    None if the CDN has no index for it. Raises HTTPError or URLError if the
+    index couldn't be read for any other reason.
+    """
+    try:
+        req = urlopen(cdn_index_url(version))
+    except HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+    try:
+        return set(json.loads(req.read().decode('utf-8')))
+    finally:
+        req.close()
+
+
+def cdn_has_experiment(version, id_hash):
+    r"""Ask the CDN (with a HEAD request) whether it holds an experiment.
+    Returns None if the CDN can't be reached.
+    """
+    request = Request(CDNExperimentSource(id_hash, version).url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        urlopen(request).close()
+    except HTTPError:
+        return False
+    except URLError:
+        return None
+    return True
+
+
+def prefetch_cdn_misses(ids):
+    r"""Record which of the given experiment ids the CDN does not hold
+    using a single index request, so they are each not downloaded in turn.
+    """
+    version = cache_version()
+    known_misses = load_cdn_misses(version)
+    unknown = [h for h in set(hash_of_id(id_) for id_ in ids)
+               if h not in known_misses and not
+               CDNExperimentSource(h, version).archive_path().is_file()]
+    if len(unknown) == 0:
+        return
+    try:
+        index = fetch_cdn_index(version)
+    except (HTTPError, URLError):
+        # the CDN can't be reached - each experiment is tried as it runs
+        return
+    if index is not None:
+        misses = [h for h in unknown if h not in index]
+    else:
+        misses = [h for h in unknown
+                  if cdn_has_experiment(version, h) is False]
+    if len(misses) > 0:
+        print('{} of {} experiments are not cached on the '
+              'CDN'.format(len(misses), len(unknown)))
+        update_cdn_misses(version, add=misses)
+
+
+def retrieve_results(id_, local=True):
+    if local:
+        try:
+            results = retrieve_local_results(id_)
+        except CachedExperimentNotAvailable:
+            pass
+        else:
+            print('Using locally cached results')
+            return results
+    id_hash, version = hash_of_id(id_), cache_version()
+    potential_asset = CDNExperimentSource(id_hash, version)
+    array_path = potential_asset.array_path()
+    if array_path.is_file():
+        # converted on a previous retrieval - no need to touch the JSON
+        return ArrayResults.load(array_path)
+    if (not potential_asset.archive_path().is_file() and
+            id_hash in load_cdn_misses(version)):
+        raise CachedExperimentNotAvailable('No cached experiment available '
+                                           '(recently checked)')
+    try:
+        download_asset_if_needed(potential_asset, verbose=True)
     except HTTPError:
+        update_cdn_misses(version, add=[id_hash])
         raise CachedExperimentNotAvailable('No cached experiment available')
     else:
-        return load_json(potential_asset.archive_path())
+        results = load_json(potential_asset.archive_path())
+        try:
+            write_results_array(results, array_path)
+        except ValueError:
+            return results
+        # hold on to the compact arrays rather than the parsed JSON
+        return ArrayResults.load(array_path)
 
 
 def retrieve_upload_credentials():
@@ -75,21 +344,171 @@ def can_upload():
         return True
 
 
-def upload_results(results, id_):
+# ----------- Uploading to the CDN ---------- #
+#
+# Uploads are queued to a single background thread that owns one S3
+# connection, so sending one method's results overlaps with computing the next
+# method's. The CDN index is rewritten once when the queue is flushed rather
+# than once per result - processes working for another menpobench process
+# (--jobs) leave the index to it, so it is rewritten once per run. The S3
+# endpoint, bucket and use of TLS can be set in the config, so uploading can
+# be exercised against a local S3-compatible server.
+
+# Maximum number of gzipped results waiting to be uploaded at once
+UPLOAD_QUEUE_SIZE = 8
+
+
+def open_s3_connection():
     import tinys3
-    conn = tinys3.Connection(*retrieve_upload_credentials(), tls=True,
-                             default_bucket='cdn.menpo.org',
-                             endpoint='s3-eu-west-1.amazonaws.com')
-    out = BytesIO()
-    with gzip.GzipFile(fileobj=out, mode="wt") as f:
-        json.dump(results, f)
-    conn.upload('experiments/{}/{}.json.gz'.format(cache_version(),
-                                                   hash_of_id(id_)), out)
-    print('Successfully cached result')
+    c = load_config()
+    return tinys3.Connection(*retrieve_upload_credentials(),
+                             tls=s3_tls(),
+                             default_bucket=c.get('MENPO_CDN_S3_BUCKET',
+                                                  DEFAULT_S3_BUCKET),
+                             endpoint=c.get('MENPO_CDN_S3_ENDPOINT',
+                                            DEFAULT_S3_ENDPOINT))
+
+
+def gzip_results(results):
+    r"""Gzipped JSON of the results in a temporary file (positioned at the
+    start) - results may be streamed from an on-disk ResultsLog, and are
+    never held in memory as a whole.
+    """
+    out = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        write_results_json(results, lambda s: f.write(s.encode('utf-8')),
+                           pretty=False)
+    out.seek(0)
+    return out
+
+
+def update_cdn_index(conn, version, id_hashes):
+    # keep the CDN index of available experiments up to date
+    try:
+        index = fetch_cdn_index(version)
+    except (HTTPError, URLError) as e:
+        # rewriting an index we couldn't read would drop every entry in it
+        print('Warning: could not read the CDN index ({}) - not updating '
+              'it'.format(e))
+        return
+    index = set() if index is None else index
+    index.update(id_hashes)
+    conn.upload(cdn_key(version, 'index.json'),
+                BytesIO(json.dumps(sorted(index)).encode('utf-8')))
+
+
+class ResultsUploader(object):
+    r"""Uploads gzipped results to the CDN from a background thread, reusing
+    a single S3 connection for every upload.
+
+    Results are serialized to a temporary file as soon as they are submitted
+    (the caller is free to delete them straight after). Any failed upload is
+    raised from :meth:`flush`. The CDN index is only updated if update_index
+    is True.
+    """
+
+    def __init__(self, connection_f=open_s3_connection, update_index=True):
+        self.connection_f = connection_f
+        self.update_index = update_index
+        self.version = cache_version()
+        self.queue = Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        self.uploaded = []
+        self.errors = []
+        self.thread = Thread(target=self._upload_queued)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _upload_queued(self):
+        conn = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            id_hash, data = item
+            try:
+                if conn is None:
+                    conn = self.connection_f()
+                conn.upload(cdn_key(self.version,
+                                    '{}.json.gz'.format(id_hash)), data)
+            except Exception as e:
+                self.errors.append(e)
+            else:
+                self.uploaded.append(id_hash)
+                print('Successfully cached result {}'.format(id_hash[:5]))
+            finally:
+                data.close()
+        if len(self.uploaded) > 0:
+            try:
+                update_cdn_misses(self.version, remove=self.uploaded)
+                if self.update_index:
+                    update_cdn_index(conn, self.version, self.uploaded)
+            except Exception as e:
+                self.errors.append(e)
+
+    def submit(self, results, id_):
+        self.queue.put((hash_of_id(id_), gzip_results(results)))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def flush(self):
+        self.close()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        return self.uploaded
+
+
+_UPLOADER = {'uploader': None, 'update_index': True}
+
+
+def results_uploader():
+    if _UPLOADER['uploader'] is None:
+        _UPLOADER['uploader'] = ResultsUploader(
+            update_index=_UPLOADER['update_index'])
+    return _UPLOADER['uploader']
+
+
+def defer_cdn_index_updates(defer=True):
+    r"""Leave updating the CDN index with what this process uploads to
+    whoever calls publish_cdn_index with the hashes flush_uploads returns.
+    """
+    _UPLOADER['update_index'] = not defer
+
+
+def publish_cdn_index(id_hashes):
+    r"""Add experiments uploaded by other processes to the CDN index."""
+    if len(id_hashes) > 0:
+        update_cdn_index(open_s3_connection(), cache_version(), id_hashes)
+
+
+def upload_results(results, id_):
+    results_uploader().submit(results, id_)
+
+
+def flush_uploads():
+    r"""Wait for every queued upload to finish, raising the first failure.
+    Returns the hashes of the experiments uploaded.
+    """
+    uploader, _UPLOADER['uploader'] = _UPLOADER['uploader'], None
+    if uploader is None:
+        return []
+    print('Waiting for queued uploads to finish')
+    return uploader.flush()
+
+
+def close_uploads():
+    # used when bailing out on an error - uploads that were already queued
+    # are still sent, but any failure is not allowed to mask the error
+    uploader, _UPLOADER['uploader'] = _UPLOADER['uploader'], None
+    if uploader is not None:
+        uploader.close()
 
 
 def hash_of_id(id_):
-    return hashlib.sha1(json.dumps(id_, sort_keys=True)).hexdigest()
+    s = json.dumps(id_, sort_keys=True)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
 
 
 def cache_version():
@@ -1,3 +1,4 @@
 from .base import (retrieve_datasets, list_predefined_datasets,
-                   load_and_validate_dataset_module)
+                   load_and_validate_dataset_module, import_images,
+                   DEFAULT_PREFETCH, DEFAULT_SEED)
 from .managed import managed_dataset
@@ -1,12 +1,28 @@
+from collections import deque
 from functools import partial
+try:
+    from inspect import getfullargspec as getargspec  # Py3
+except ImportError:
+    from inspect import getargspec  # Py2
+import random
+from threading import Thread, Event
+try:
+    from queue import Queue, Full  # Py3
+except ImportError:
+    from Queue import Queue, Full  # Py2
 from menpobench import predefined_dir
 from menpobench.lmprocess import (retrieve_lm_processes,
                                   apply_lm_process_to_img,
                                   id_of_lm_process_or_none)
 from menpobench.imgprocess import basic_img_process
+from menpobench.timing import timed_iter, timed_map
+from menpobench.dataset.processed import (has_processed_dataset,
+                                          load_processed_dataset,
+                                          store_processed_dataset)
 from menpobench.utils import (load_module_with_error_messages,
                               load_callable_with_error_messages, load_schema,
-                              memoize, predefined_module, randomly_exhaust)
+                              memoize, predefined_module, randomly_exhaust,
+                              in_shard, seeded_key)
 
 
 def predefined_dataset_dir():
@@ -37,9 +53,95 @@ def load_and_validate_dataset_module(name):
     return generate_dataset, metadata
 
 
-def wrap_dataset_with_processing(id_img_gen, process):
+def wrap_dataset_with_processing(id_img_gen, process, name, **labels):
+    # process is timed on each image as the stage name
+    return timed_map(lambda x: (x[0], process(x[1])), id_img_gen, name,
+                     id_f=lambda x: x[0], **labels)
+
+
+# Seed for the order images are drawn from a chain of datasets when the
+# experiment doesn't give one
+DEFAULT_SEED = 0
+
+# Default number of images each dataset decodes and processes ahead of the
+# consumer
+DEFAULT_PREFETCH = 8
+
+
+def prefetch(id_img_gen, n):
+    r"""Drain a generator of (id, image) pairs from a background thread,
+    buffering up to n images ahead of the consumer. Loading and processing the
+    next images then overlaps with whatever the consumer does with the current
+    one. Any exception raised by the wrapped generator is re-raised in the
+    consumer.
+    """
+    buffer = Queue(maxsize=n)
+    stop = Event()
+    done = object()
+
+    def put(item):
+        # give up if the consumer goes away rather than block forever
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def produce():
+        try:
+            for item in id_img_gen:
+                if not put((item, None)):
+                    # closing the generator lets it clean up (e.g. discard a
+                    # partially stored processed dataset)
+                    id_img_gen.close()
+                    return
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def filter_dataset(id_img_gen, keep):
     for id_, img in id_img_gen:
-        yield id_, process(img)
+        if keep(id_):
+            yield id_, img
+
+
+def import_images(pattern, max_images=None, keep=None, seed=None, **kwargs):
+    r"""menpo.io.import_images for dataset modules whose generate_dataset
+    takes keep and seed (see Dataset). The id of an image is the stem of its
+    path. The first max_images paths (in menpo.io's order) make up the
+    dataset - of those, only the images whose ids keep accepts are imported,
+    in an order fixed by seed. Nothing is decoded until then. Any other
+    kwargs are passed on to menpo.io.import_image.
+    """
+    import menpo.io as mio
+    paths = list(mio.image_paths(pattern))
+    if max_images is not None:
+        paths = paths[:max_images]
+    if keep is not None:
+        paths = [p for p in paths if keep(p.stem)]
+    if seed is not None:
+        paths.sort(key=lambda p: seeded_key(seed, p.stem))
+    for path in paths:
+        yield mio.import_image(path, **kwargs)
 
 
 def print_processing_status(id_img_gen):
@@ -52,13 +154,14 @@ def print_processing_status(id_img_gen):
     print('')
 
 
-# logs ids and gt shapes for later use by menpobench
+# logs ids and gt shapes for later use by menpobench. Each is only held until
+# the result for its image is taken, so memory doesn't grow with the test set.
 class TestsetWrapper(object):
 
     def __init__(self, id_img_gen):
         self.id_img_gen = id_img_gen
-        self.ids = []
-        self.gt_shapes = []
+        self.ids = deque()
+        self.gt_shapes = deque()
 
     def __iter__(self):
         return self
@@ -69,6 +172,14 @@ class TestsetWrapper(object):
         self.gt_shapes.append(img.landmarks.pop('gt').lms)
         return img
 
+    __next__ = next  # Py3
+
+    def pop_oldest(self):
+        r"""The id and gt shape of the oldest image whose result hasn't been
+        taken - results come back in the order images were drawn.
+        """
+        return self.ids.popleft(), self.gt_shapes.popleft()
+
 
 # discards ids and allows gt shapes through uninterrupted
 def trainset_wrapper(id_img_gen):
@@ -84,6 +195,9 @@ class Dataset(object):
         self.metadata = metadata
         self.dataset_gen_f = dataset_gen_f
         self.lm_post_load = lm_post_load
+        # a generate_dataset taking keep and seed drops images and orders
+        # them itself, before they are decoded
+        self.takes_options = 'keep' in getargspec(dataset_gen_f).args
 
     @property
     def predefined(self):
@@ -94,35 +208,93 @@ class Dataset(object):
 
     @property
     def id(self):
-        return {
+        id_ = {
             'name': self.name,
             'lm_post_load': id_of_lm_process_or_none(self.lm_post_load)
         }
+        # bumped by a dataset whenever the images it generates change
+        if 'version' in self.metadata:
+            id_['version'] = self.metadata['version']
+        return id_
+
+    @property
+    def cachable(self):
+        # only predefined datasets are stable enough to be keyed on their id
+        return self.predefined
+
+    def __call__(self, keep=None, seed=None):
+        # keep, if given, is a predicate on image ids. Images it rejects are
+        # dropped as early as possible - before they are read from the
+        # processed cache, or before they are decoded (or failing that,
+        # processed). Images are generated in an order fixed by seed, unless
+        # generate_dataset doesn't take a seed.
+        if self.cachable and has_processed_dataset(self):
+            print("Loading pre-processed dataset '{}' from "
+                  "cache".format(self.name))
+            return timed_iter(load_processed_dataset(self, keep=keep,
+                                                     seed=seed),
+                              'load', id_f=lambda x: x[0], dataset=self.name,
+                              processed=True)
+
+        # only a complete dataset can be stored in the processed cache
+        store = self.cachable
+        if self.takes_options:
+            gen = self.dataset_gen_f(keep=keep, seed=seed)
+            store = store and keep is None
+        else:
+            gen = self.dataset_gen_f()
+            if keep is not None and not self.cachable:
+                gen = filter_dataset(gen, keep)
+
+        # record the time to decode each image on its own
+        gen = timed_iter(gen, 'decode', id_f=lambda x: x[0],
+                         dataset=self.name)
 
-    def __call__(self):
         # we have a hold on the loading function, but we have some base
         # pre-processing that we always perform per-image. Wrap the generator
         # with the basic pre-processing
-        gen = wrap_dataset_with_processing(self.dataset_gen_f(),
-                                           basic_img_process)
+        gen = wrap_dataset_with_processing(gen, basic_img_process, 'process',
+                                           dataset=self.name)
 
         if self.lm_post_load is not None:
             # the specified lm_processes needs to be added after basic
             # processing
             # -> take the landmark processing and apply it to each image
             img_lm_process = partial(apply_lm_process_to_img, self.lm_post_load)
-            gen = wrap_dataset_with_processing(gen, img_lm_process)
+            gen = wrap_dataset_with_processing(gen, img_lm_process,
+                                               'lm_post_load',
+                                               dataset=self.name)
+
+        if store:
+            # store the fully processed images as they stream past so the
+            # next run can skip decoding and processing entirely (only once
+            # every image has gone past is the store committed)
+            gen = store_processed_dataset(gen, self)
+            if keep is not None:
+                # every image has to be processed to be stored, but only
+                # those kept go on
+                gen = filter_dataset(gen, keep)
 
-        return gen
+        # record the time to decode, process (and store) each image in all
+        return timed_iter(gen, 'load', id_f=lambda x: x[0], dataset=self.name,
+                          processed=False)
 
 
 # a chain of datasets. self.generator provides a generator of either
 # (id, image) or image depending on whether or not test is true or false.
+# The images of each dataset are ordered, and datasets are interleaved, in an
+# order fixed by seed. If shard is given as (k, n) only the images in shard k
+# of n are generated.
 class DatasetChain(object):
 
-    def __init__(self, datasets, test=False):
+    def __init__(self, datasets, test=False, prefetch=DEFAULT_PREFETCH,
+                 seed=DEFAULT_SEED, shard=None):
         self.datasets = datasets
         self.test = test
+        # number of images each dataset loads ahead - 0 loads in line
+        self.prefetch = prefetch
+        self.seed = seed
+        self.shard = shard
 
     @property
     def predefined(self):
@@ -135,11 +307,25 @@ class DatasetChain(object):
     def id(self):
         return tuple(d.id for d in self.datasets)
 
-    def __call__(self):
+    def __call__(self, skip_ids=None):
         # draw from the datasets randomly, and add process reporting
-        # notice that we invoke each dataset in turn.
-        id_img_gen = print_processing_status(randomly_exhaust(*(d() for d in
-                                                              self.datasets)))
+        # notice that we invoke each dataset in turn. Images outside the
+        # shard, or already tested (e.g. by an interrupted run), are skipped
+        # by the datasets themselves.
+        keep = None
+        if skip_ids or self.shard is not None:
+            skip_ids = set(skip_ids or [])
+            shard = self.shard
+
+            def keep(id_):
+                return (id_ not in skip_ids and
+                        (shard is None or in_shard(id_, *shard)))
+        gens = [d(keep=keep, seed=self.seed) for d in self.datasets]
+        if self.prefetch > 0:
+            # each dataset loads on its own thread
+            gens = [prefetch(g, self.prefetch) for g in gens]
+        id_img_gen = randomly_exhaust(*gens, rng=random.Random(self.seed))
+        id_img_gen = print_processing_status(id_img_gen)
         return (TestsetWrapper(id_img_gen) if self.test
                 else trainset_wrapper(id_img_gen))
 
@@ -162,5 +348,7 @@ def retrieve_dataset(dataset_def):
     return Dataset(dataset_gen_f, name, metadata, lm_post_load=lm_process)
 
 
-def retrieve_datasets(dataset_defs, test=False):
-    return DatasetChain([retrieve_dataset(d) for d in dataset_defs], test=test)
+def retrieve_datasets(dataset_defs, test=False, prefetch=DEFAULT_PREFETCH,
+                      seed=DEFAULT_SEED, shard=None):
+    return DatasetChain([retrieve_dataset(d) for d in dataset_defs], test=test,
+                        prefetch=prefetch, seed=seed, shard=shard)
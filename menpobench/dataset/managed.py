@@ -1,10 +1,10 @@
 from functools import partial
 from menpobench.config import resolve_cache_dir
 from menpobench.managed import WebSource, MENPO_CDN_URL, managed_asset
-from menpobench.utils import create_path, extract_archive
+from menpobench.utils import create_path
 
 MENPO_CDN_DATASET_URL = MENPO_CDN_URL + 'datasets/'
-MENPO_GITHUB_URL_TEMPLATE = 'https://github.com/menpo/{name}/releases/download/{version}/{name}.tar.gz'
+MENPO_GITHUB_URL_TEMPLATE = 'https://github.com/menpo/{name}/releases/download/{version}/{name}{suffix}'
 
 # ----------- Cache path management ---------- #
 
@@ -18,6 +18,11 @@ def download_dataset_dir():
     return dataset_dir() / 'dlcache'
 
 
+@create_path
+def unpacked_dataset_dir():
+    return dataset_dir() / 'unpacked'
+
+
 # ----------- DatasetSource Classes ---------- #
 
 class DatasetSource(WebSource):
@@ -25,33 +30,38 @@ class DatasetSource(WebSource):
     def _download_cache_dir(self):
         return download_dataset_dir()
 
+    def _persistent_unpacked_dir(self):
+        # datasets are only ever read, so can be safely left unpacked
+        return unpacked_dataset_dir()
+
 
 class CDNDatasetSource(DatasetSource):
 
-    def __init__(self, name, sha1):
-        url = MENPO_CDN_DATASET_URL + '{}.tar.gz'.format(name)
+    def __init__(self, name, sha1, suffix='.tar.gz'):
+        url = MENPO_CDN_DATASET_URL + '{}{}'.format(name, suffix)
         super(CDNDatasetSource, self).__init__(name, url, sha1)
 
-    def unpack(self):
+    def _unpack_dir(self):
         # Extracts the archive into the unpacked dir - the unpacked
         # path will then point to the folder because it is ASSUMED that the
         # archive name matches the name of the asset and therefore the asset
         # is actually completely contained inside self.unpacked_path()
-        extract_archive(self.archive_path(), self._unpacked_cache_dir())
+        return self._unpacked_cache_dir()
 
 
 class GithubDatasetSource(DatasetSource):
 
-    def __init__(self, name, version, sha1):
-        url = MENPO_GITHUB_URL_TEMPLATE.format(name=name, version=version)
+    def __init__(self, name, version, sha1, suffix='.tar.gz'):
+        url = MENPO_GITHUB_URL_TEMPLATE.format(name=name, version=version,
+                                               suffix=suffix)
         super(GithubDatasetSource, self).__init__(name, url, sha1)
 
-    def unpack(self):
+    def _unpack_dir(self):
         # Extracts the archive into the unpacked dir - the unpacked
         # path will then point to the folder because it is ASSUMED that the
         # archive name matches the name of the asset and therefore the asset
         # is actually completely contained inside self.unpacked_path()
-        extract_archive(self.archive_path(), self._unpacked_cache_dir())
+        return self._unpacked_cache_dir()
 
 
 # --------------------------- MANAGED DATASETS ------------------------------ #
@@ -70,6 +80,15 @@ class GithubDatasetSource(DatasetSource):
 # 2. tar.gz the entire folder:
 #      > tar -zcvf dataset_name.tar.gz ./dataset_name/
 #
+#    or, for large datasets, zip it:
+#      > zip -r dataset_name.zip ./dataset_name/
+#
+#    Every member of a zip is compressed independently, so a zip is unpacked
+#    in parallel. Pass suffix='.zip' to the dataset source. Either way,
+#    datasets that only read some of an archive (e.g. the first 20 images)
+#    only unpack what they read - for a .tar.gz this still means reading
+#    the archive up to the last member needed.
+#
 # 3. Record the SHA-1 checksum of the dataset archive:
 #      > shasum dataset_name.tar.gz
 #
@@ -0,0 +1,198 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import menpobench
+from menpobench.cache import hash_of_id
+from menpobench.dataset.managed import dataset_dir
+from menpobench.utils import create_path, load_json, save_json, seeded_key
+
+# A processed dataset is stored as a folder holding two flat binary blobs
+# (all image pixels and masks, and all landmark points back to back) and an
+# index.json recording the id, image type, path, offset, shape and dtype of
+# every image, mask and landmark group. Individual images are then memory
+# mapped straight out of the blobs.
+PIXELS_FILENAME = 'pixels.bin'
+POINTS_FILENAME = 'points.bin'
+INDEX_FILENAME = 'index.json'
+
+# the menpo image types that are stored as themselves - any other is stored
+# (and so reloaded) as a plain Image
+IMAGE_TYPES = ['Image', 'MaskedImage', 'BooleanImage']
+
+
+# ----------- Cache path management ---------- #
+
+@create_path
+def processed_dataset_dir():
+    return dataset_dir() / 'processed'
+
+
+def processed_dataset_id(dataset):
+    return {
+        'dataset': dataset.id,
+        'menpobench': menpobench.__version__
+    }
+
+
+def processed_dataset_path(dataset):
+    return processed_dataset_dir() / hash_of_id(processed_dataset_id(dataset))
+
+
+def has_processed_dataset(dataset):
+    return (processed_dataset_path(dataset) / INDEX_FILENAME).is_file()
+
+
+# ----------- Writing ---------- #
+
+class ProcessedDatasetWriter(object):
+
+    def __init__(self, path, id_):
+        self.path = path
+        self.id = id_
+        # build in a private folder so concurrent menpobench processes (or a
+        # consumer that gives up half way through) never leave a partially
+        # written dataset at self.path
+        self.build_path = Path(tempfile.mkdtemp(prefix=path.name + '-',
+                                                dir=str(path.parent)))
+        self._pixels = open(str(self.build_path / PIXELS_FILENAME), 'wb')
+        self._points = open(str(self.build_path / POINTS_FILENAME), 'wb')
+        self._pixels_offset = 0
+        self._points_offset = 0
+        self.images = []
+
+    def _append_pixels(self, pixels):
+        pixels = np.ascontiguousarray(pixels)
+        self._pixels.write(pixels.tobytes())
+        entry = {'offset': self._pixels_offset, 'shape': list(pixels.shape),
+                 'dtype': pixels.dtype.str}
+        self._pixels_offset += pixels.nbytes
+        return entry
+
+    def append(self, id_, img):
+        image_type = type(img).__name__
+        path = getattr(img, 'path', None)
+        entry = {
+            'id': id_,
+            'type': image_type if image_type in IMAGE_TYPES else 'Image',
+            'path': None if path is None else str(path),
+            'pixels': self._append_pixels(img.pixels),
+            'landmarks': OrderedDict()
+        }
+        if entry['type'] == 'MaskedImage':
+            entry['mask'] = self._append_pixels(img.mask.pixels)
+        for group in img.landmarks:
+            lmg = img.landmarks[group]
+            points = np.ascontiguousarray(lmg.lms.points, dtype=np.float64)
+            self._points.write(points.tobytes())
+            # keep the semantic labels so landmark processes applied later
+            # see exactly the same landmark group as a freshly loaded image
+            labels = OrderedDict((l['label'], l['mask'])
+                                 for l in lmg.tojson()['labels'])
+            entry['landmarks'][group] = {'offset': self._points_offset,
+                                         'shape': list(points.shape),
+                                         'labels': labels}
+            self._points_offset += points.nbytes
+        self.images.append(entry)
+
+    def _close(self):
+        self._pixels.close()
+        self._points.close()
+
+    def discard(self):
+        self._close()
+        shutil.rmtree(str(self.build_path), ignore_errors=True)
+
+    def finalize(self):
+        self._close()
+        save_json({'id': self.id, 'images': self.images},
+                  str(self.build_path / INDEX_FILENAME))
+        try:
+            os.rename(str(self.build_path), str(self.path))
+        except OSError:
+            # another process finished storing the same dataset first
+            shutil.rmtree(str(self.build_path), ignore_errors=True)
+
+
+def store_processed_dataset(id_img_gen, dataset):
+    r"""Pass through a generator of (id, image) pairs, storing every image
+    to the processed dataset cache.
+
+    The cache entry is only committed once the generator is exhausted - it
+    must hold the whole dataset. A consumer that stops early (or is killed)
+    leaves nothing in the cache, and the dataset is decoded and processed
+    again in full next time. Every image is always read by a benchmark run,
+    so this only bites runs that are interrupted.
+    """
+    writer = ProcessedDatasetWriter(processed_dataset_path(dataset),
+                                    processed_dataset_id(dataset))
+    try:
+        for id_, img in id_img_gen:
+            writer.append(id_, img)
+            yield id_, img
+    except BaseException:
+        writer.discard()
+        raise
+    writer.finalize()
+
+
+# ----------- Reading ---------- #
+
+def _memmap(path, offset, shape, dtype):
+    # copy-on-write - downstream processing is free to mutate the arrays
+    # without ever touching the cache.
+    return np.memmap(str(path), dtype=np.dtype(dtype), mode='c',
+                     offset=offset, shape=tuple(shape))
+
+
+def _pixels_from_entry(path, p):
+    return _memmap(path / PIXELS_FILENAME, p['offset'], p['shape'],
+                   p['dtype'])
+
+
+def _image_from_entry(path, entry):
+    from menpo.image import Image, MaskedImage, BooleanImage
+    from menpo.landmark import LandmarkGroup
+    from menpo.shape import PointCloud
+    pixels = _pixels_from_entry(path, entry['pixels'])
+    image_type = entry.get('type', 'Image')
+    # boolean images take their pixels without the channel axis
+    if image_type == 'BooleanImage':
+        img = BooleanImage(pixels[0], copy=False)
+    elif image_type == 'MaskedImage':
+        mask = _pixels_from_entry(path, entry['mask'])
+        img = MaskedImage(pixels, mask=BooleanImage(mask[0], copy=False),
+                          copy=False)
+    else:
+        img = Image(pixels, copy=False)
+    if entry.get('path') is not None:
+        img.path = Path(entry['path'])
+    for group, lm in entry['landmarks'].items():
+        points = _memmap(path / POINTS_FILENAME, lm['offset'], lm['shape'],
+                         np.float64)
+        n_points = lm['shape'][0]
+        labels_to_masks = OrderedDict()
+        for label, indices in lm['labels'].items():
+            mask = np.zeros(n_points, dtype=bool)
+            mask[indices] = True
+            labels_to_masks[label] = mask
+        img.landmarks[group] = LandmarkGroup(PointCloud(points, copy=False),
+                                             labels_to_masks, copy=False)
+    return img
+
+
+def load_processed_dataset(dataset, keep=None, seed=None):
+    r"""Generator of (id, image) pairs streamed from the processed dataset
+    cache. If keep is given, only the images whose ids it accepts are read.
+    If seed is given, images are read in the order it fixes.
+    """
+    path = processed_dataset_path(dataset)
+    entries = load_json(path / INDEX_FILENAME)['images']
+    if keep is not None:
+        entries = [e for e in entries if keep(e['id'])]
+    if seed is not None:
+        entries = sorted(entries, key=lambda e: seeded_key(seed, e['id']))
+    for entry in entries:
+        yield entry['id'], _image_from_entry(path, entry)
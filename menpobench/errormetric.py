@@ -1,3 +1,4 @@
+from functools import partial
 import numpy as np
 from menpobench import predefined_dir
 from menpobench.utils import (load_module_with_error_messages,
@@ -17,11 +18,24 @@ def list_predefined_error_metrics():
 
 
 def retrieve_error_metric(name):
+    r"""Load an error metric module, returning the name and a batched
+    metric callable taking ``(n_images, n_points, n_dims)`` arrays of ground
+    truth and final shapes and returning an ``(n_images,)`` array of errors.
+
+    Modules may provide such a ``batch_error_metric`` directly. Otherwise
+    their per-image ``error_metric`` is applied to each image in turn.
+    """
     module = load_module_with_error_messages('error metric',
                                              predefined_error_metric_path,
                                              name)
-    metric = load_callable_with_error_messages(module, 'error_metric', name,
-                                               module_type='error metric')
+    if hasattr(module, 'batch_error_metric'):
+        metric = load_callable_with_error_messages(module,
+                                                   'batch_error_metric', name,
+                                                   module_type='error metric')
+    else:
+        per_image_metric = load_callable_with_error_messages(
+            module, 'error_metric', name, module_type='error metric')
+        metric = partial(apply_per_image, per_image_metric)
     return name, metric
 
 
@@ -31,9 +45,17 @@ def retrieve_error_metrics(error_metrics_def):
     return [retrieve_error_metric(n) for n in error_metrics_def]
 
 
+def apply_per_image(metric, gt, final):
+    return np.array([float(metric(g, f)) for g, f in zip(gt, final)])
+
+
 def mean_error(gt, final):
     return np.mean(np.sqrt(np.sum((gt - final) ** 2, axis=-1)))
 
 
+def batch_mean_error(gt, final):
+    return np.mean(np.sqrt(np.sum((gt - final) ** 2, axis=-1)), axis=-1)
+
+
 def root_mean_squared_error(target, gt_shape):
     return np.sqrt(np.mean((target.flatten() - gt_shape.flatten()) ** 2))
@@ -43,4 +43,19 @@ class MenpoCDNCredentialsMissingError(Exception):
 
 # The output dir exists and overwrite is not set
 class OutputDirExistsError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+# There is no locally cached trained model for this method and training set
+class TrainedModelNotAvailable(Exception):
+    pass
+
+
+# A command sent to Matlab failed, or Matlab itself went away
+class MatlabError(Exception):
+    pass
+
+
+# The connection dropped before the whole of a download arrived
+class IncompleteDownloadError(IOError):
+    pass
@@ -1,5 +1,6 @@
 from menpobench import predefined_dir
-from menpobench.dataset import retrieve_datasets
+from menpobench.dataset import (retrieve_datasets, DEFAULT_PREFETCH,
+                                DEFAULT_SEED)
 from menpobench.errormetric import retrieve_error_metrics
 from menpobench.exception import SchemaError
 from menpobench.method import (retrieve_trainable_method,
@@ -43,14 +44,34 @@ class Experiment(object):
         # Load the experiment and check it's schematically valid
         validate_experiment_def(c)
 
-        self.config = c
+        # the seed fixing the order images are drawn in is always recorded,
+        # so any run can be repeated exactly
+        self.config = dict(c)
+        self.config.setdefault('seed', DEFAULT_SEED)
+        c = self.config
+        self.seed = c['seed']
+
+        # (k, n) if only shard k of n of the test set is to be fitted
+        self.shard = tuple(c['shard']) if 'shard' in c else None
+        if self.shard is not None and not 1 <= self.shard[0] <= self.shard[1]:
+            raise ValueError('Invalid shard {} of {}'.format(*self.shard))
+
+        # number of processes methods may fit test images over
+        self.fit_jobs = c.get('fit_jobs', 1)
+
+        # number of images each dataset loads ahead of training and fitting
+        prefetch = c.get('prefetch', DEFAULT_PREFETCH)
 
         # prepare the error metrics
         self.error_metrics = retrieve_error_metrics(c['error_metric'])
 
         if 'training_data' in c:
-            self.training = retrieve_datasets(c['training_data'])
-        self.testing = retrieve_datasets(c['testing_data'], test=True)
+            self.training = retrieve_datasets(c['training_data'],
+                                              prefetch=prefetch,
+                                              seed=self.seed)
+        self.testing = retrieve_datasets(c['testing_data'], test=True,
+                                         prefetch=prefetch, seed=self.seed,
+                                         shard=self.shard)
 
         if 'trainable_methods' in c:
             if 'training_data' not in c:
@@ -75,13 +96,17 @@ class Experiment(object):
     def testing_id(self):
         return self.testing.id
 
-    def trainable_id(self, trainable_method):
+    def trained_model_id(self, trainable_method):
         return {
             'training': self.training_id,
-            'trainable_method': trainable_method.id,
-            'testing': self.testing.id
+            'trainable_method': trainable_method.id
         }
 
+    def trainable_id(self, trainable_method):
+        id_ = self.trained_model_id(trainable_method)
+        id_['testing'] = self.testing.id
+        return id_
+
     def untrainable_id(self, untrainable_method):
         return {
             'untrainable_method': untrainable_method.id,
@@ -108,7 +133,7 @@ class Experiment(object):
         return False
 
 
-def retrieve_experiment(experiment_name):
+def retrieve_experiment(experiment_name, shard=None):
     if experiment_name.endswith('.yml') or experiment_name.endswith('.yaml'):
         # user is giving a path to an experiment file
         try:
@@ -123,4 +148,6 @@ def retrieve_experiment(experiment_name):
         except IOError:
             raise ValueError("Requested predefined experiment configuration "
                              "'{}' does not exist".format(experiment_name))
+    if shard is not None:
+        config['shard'] = list(shard)
     return Experiment(config)
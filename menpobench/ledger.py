@@ -0,0 +1,80 @@
+import os
+import threading
+from menpobench.config import resolve_cache_dir
+from menpobench.utils import checksum, file_lock, load_json, save_json
+
+# Hashing a multi-GB archive takes a long time, so once a file in the cache has
+# been hashed the result is written to a ledger along with the file's size,
+# mtime and inode. While those are unchanged the file is taken to still have
+# the recorded SHA-1. 'menpobench cache verify' re-hashes everything
+# regardless.
+
+
+# file locks only exclude other processes - assets may also be fetched on
+# several threads at once
+_THREAD_LOCK = threading.Lock()
+
+
+# ----------- Cache path management ---------- #
+
+def ledger_path():
+    return resolve_cache_dir() / 'ledger.json'
+
+
+def ledger_lock_path():
+    return resolve_cache_dir() / 'ledger.lock'
+
+
+def ledger_key(path):
+    return str(path.relative_to(resolve_cache_dir()))
+
+
+def file_signature(path):
+    st = os.stat(str(path))
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+# ----------- Ledger ---------- #
+
+def load_ledger():
+    path = ledger_path()
+    return load_json(path) if path.is_file() else {}
+
+
+def update_ledger(verified=None, forget=()):
+    with _THREAD_LOCK, file_lock(ledger_lock_path()):
+        ledger = load_ledger()
+        for path, sha1 in (verified or {}).items():
+            ledger[ledger_key(path)] = {'signature': file_signature(path),
+                                        'sha1': sha1}
+        for path in forget:
+            ledger.pop(ledger_key(path), None)
+        # readers don't take the lock - never let them see a partial write
+        tmp_path = ledger_path().with_suffix('.json.tmp')
+        save_json(ledger, tmp_path)
+        os.rename(str(tmp_path), str(ledger_path()))
+
+
+def record_verified(path, sha1):
+    update_ledger(verified={path: sha1})
+
+
+def verified_checksum(path):
+    r"""The SHA-1 recorded for the file at path, or None if the file has
+    changed (or was never hashed) since.
+    """
+    entry = load_ledger().get(ledger_key(path))
+    if entry is None or entry['signature'] != file_signature(path):
+        return None
+    return entry['sha1']
+
+
+def ledger_checksum(path):
+    r"""The SHA-1 of the file at path, only hashing it if the file has changed
+    since it was last hashed.
+    """
+    sha1 = verified_checksum(path)
+    if sha1 is None:
+        sha1 = checksum(path)
+        record_verified(path, sha1)
+    return sha1
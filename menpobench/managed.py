@@ -1,19 +1,33 @@
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import os
 import shutil
+import tarfile
+import tempfile
+import zlib
 from pathlib import Path
 
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
-from menpobench.utils import (extract_archive, checksum, download_file,
-                              TempDirectory)
+from menpobench.blob import (has_valid_blob, link_blob, store_blob, read_ref,
+                             delete_ref)
+from menpobench.ledger import ledger_checksum
+from menpobench.timing import stage
+from menpobench.utils import (extract_archive, download_file,
+                              download_and_extract_tar, partial_download_path,
+                              select_members, tar_members, zip_members,
+                              load_json, save_json, TempDirectory, file_lock)
 
 
 # Global url for the current Menpo CDN for storing assets - datasets and
 # third party binaries
 MENPO_CDN_URL = 'http://cdn.menpo.org.s3.amazonaws.com/'
 
+# Default number of assets prefetch_assets fetches at once
+DEFAULT_ASSET_JOBS = 4
+
 
 # ----------- DatasetSource Classes ---------- #
 
@@ -22,15 +36,28 @@ class AssetSource(object):
     def __init__(self, name):
         super(AssetSource, self).__init__()
         self.name = name
-        self._unpacked_temp_dir = None
+        self._unpacked_dir = None
 
     def _download_cache_dir(self):
         raise NotImplementedError()
 
+    def _persistent_unpacked_dir(self):
+        # Assets that are never modified once unpacked can be kept unpacked
+        # between runs - such asset types return the directory to keep them in
+        return None
+
+    @property
+    def persistent(self):
+        return self._persistent_unpacked_dir() is not None
+
     def _unpacked_cache_dir(self):
-        if self._unpacked_temp_dir is None:
-            self._unpacked_temp_dir = TempDirectory.create_new()
-        return self._unpacked_temp_dir
+        if self._unpacked_dir is None:
+            if self.persistent:
+                self._unpacked_dir = (self._persistent_unpacked_dir() /
+                                      self.name)
+            else:
+                self._unpacked_dir = TempDirectory.create_new()
+        return self._unpacked_dir
 
     def unpacked_path(self):
         return self._unpacked_cache_dir() / self.name
@@ -43,6 +70,9 @@ class AssetSource(object):
     def unpack(self):
         raise NotImplementedError()
 
+    def can_unpack_members(self):
+        return False
+
 
 class WebSource(AssetSource):
 
@@ -53,23 +83,143 @@ class WebSource(AssetSource):
         self.archive_suffix = ''.join(Path(urlparse(url).path).suffixes)
 
     def cleanup_archive(self):
+        # only this name goes - the blob it shares bytes with is left for
+        # garbage collection
         self.archive_path().unlink()
+        delete_ref(self.archive_path())
 
     def archive_path(self):
         return self._download_cache_dir() / '{}{}'.format(self.name,
                                                           self.archive_suffix)
 
     def archive_checksum(self):
-        return checksum(self.archive_path())
+        # only actually re-hashed if the archive has changed since last time
+        return ledger_checksum(self.archive_path())
+
+    def validate_checksum(self, sha1):
+        return sha1 == self.sha1
 
     def validate_archive_checksum(self):
-        return self.archive_checksum() == self.sha1
+        return self.validate_checksum(self.archive_checksum())
 
-    def unpack(self):
+    def download_lock_path(self):
+        return self._download_cache_dir() / '{}.lock'.format(self.name)
+
+    def _unpack_dir(self):
         # Extracts the archive into the unpacked path - the unpacked
         # path will then point to the folder and whatever is inside the archive
         # is actually completely contained inside self.unpacked_path()
-        extract_archive(self.archive_path(), self.unpacked_path())
+        return self.unpacked_path()
+
+    def unpack(self):
+        extract_archive(self.archive_path(), self._unpack_dir())
+
+    def unpacked_marker_path(self):
+        return self._persistent_unpacked_dir() / '{}.sha1'.format(self.name)
+
+    def unpacked_lock_path(self):
+        return self._persistent_unpacked_dir() / '{}.lock'.format(self.name)
+
+    def unpacked_is_valid(self):
+        marker = self.unpacked_marker_path()
+        if not marker.is_file() or not self.unpacked_path().is_dir():
+            return False
+        with open(str(marker), 'rt') as f:
+            return f.read().strip() == self.sha1
+
+    def unpack_persistent(self, unpack=None):
+        # Unpack into a private staging folder and only move it into place
+        # (and record the archive checksum) once extraction has completed.
+        # The caller is expected to hold the unpacked lock.
+        if unpack is None:
+            unpack = self.unpack
+        unpacked_dir = self._unpacked_cache_dir()
+        marker = self.unpacked_marker_path()
+        if marker.is_file():
+            marker.unlink()
+        staging_dir = Path(tempfile.mkdtemp(
+            prefix=self.name + '-', dir=str(self._persistent_unpacked_dir())))
+        self._unpacked_dir = staging_dir
+        try:
+            unpack()
+        except BaseException:
+            shutil.rmtree(str(staging_dir), ignore_errors=True)
+            raise
+        finally:
+            self._unpacked_dir = unpacked_dir
+        if unpacked_dir.is_dir():
+            shutil.rmtree(str(unpacked_dir))
+        os.rename(str(staging_dir), str(unpacked_dir))
+        with open(str(marker), 'wt') as f:
+            f.write(self.sha1)
+
+    def can_stream_unpack(self):
+        # a persistent .tar.gz that isn't on disk in any form can be unpacked
+        # as it downloads
+        return (self.persistent and self.archive_suffix == '.tar.gz' and
+                not self.archive_path().is_file() and
+                not partial_download_path(self.archive_path()).is_file() and
+                not (self.sha1 is not None and has_valid_blob(self.sha1)))
+
+    def _download_and_unpack(self):
+        sha1 = download_and_extract_tar(self.url, self.archive_path(),
+                                        self._unpack_dir())
+        if not self.validate_checksum(sha1):
+            self.cleanup_archive()
+            raise ValueError('checksum {} != {} (actual != '
+                             'expected)'.format(sha1, self.sha1))
+        store_blob(self.archive_path(), sha1)
+
+    def member_index_path(self):
+        return self._download_cache_dir() / '{}.members.json'.format(
+            self.name)
+
+    def archive_members(self):
+        # A zip carries an index of its members. Listing the members of a
+        # .tar.gz means reading through all of it, so they are recorded
+        # alongside the archive the first time.
+        if self.archive_suffix == '.zip':
+            return zip_members(self.archive_path())
+        index_path = self.member_index_path()
+        if index_path.is_file():
+            index = load_json(index_path)
+            if index['sha1'] == self.sha1:
+                return index['members']
+        members = tar_members(self.archive_path())
+        fd, tmp_path = tempfile.mkstemp(prefix=index_path.name,
+                                        dir=str(index_path.parent))
+        os.close(fd)
+        save_json({'sha1': self.sha1, 'members': members}, tmp_path)
+        if index_path.is_file():
+            index_path.unlink()
+        os.rename(tmp_path, str(index_path))
+        return members
+
+    def can_unpack_members(self):
+        # members of a zip or .tar.gz can be extracted on their own - there
+        # is no need to if the whole asset is already kept unpacked
+        return (self.archive_suffix in ('.zip', '.tar.gz') and
+                not (self.persistent and self.unpacked_is_valid()))
+
+    def unpack_members(self, pattern, max_members=None):
+        # Extracts only the members matching pattern (relative to the
+        # unpacked path) and whatever accompanies them into a temporary
+        # unpacked dir of their own
+        self._unpacked_dir = TempDirectory.create_new()
+        unpack_dir = self._unpack_dir()
+        prefix = self.unpacked_path().relative_to(unpack_dir).as_posix()
+        if prefix != '.':
+            pattern = '{}/{}'.format(prefix, pattern)
+        members = select_members(self.archive_members(), pattern,
+                                 max_members=max_members)
+        extract_archive(self.archive_path(), unpack_dir, members=members)
+
+    def stream_unpack_persistent(self):
+        # Download and unpack in a single pass over the bytes. A failed
+        # checksum (or a stream that breaks off) rolls back everything that
+        # was extracted. The caller is expected to hold both the download and
+        # unpacked locks.
+        self.unpack_persistent(unpack=self._download_and_unpack)
 
 
 class LocalSource(AssetSource):
@@ -94,45 +244,166 @@ def get_asset(name, asset_set):
         return asset_set[name]()
 
 
-def download_asset_if_needed(asset, verbose=False, checksum_fail=False):
-    if asset.archive_path().is_file():
-        if not asset.validate_archive_checksum():
-            if verbose:
-                print("Warning: cached version of '{}' failed checksum - "
-                      "clearing cache".format(asset.name))
+def download_asset_if_needed(asset, verbose=False):
+    # Serialise downloads of the same asset across menpobench processes - they
+    # would otherwise all append to the same partial download.
+    with file_lock(asset.download_lock_path()):
+        _download_asset_if_needed(asset, verbose=verbose)
 
-            actual_checksum = asset.archive_checksum()
-            asset.cleanup_archive()
 
-            if not checksum_fail:
-                download_asset_if_needed(asset, verbose=verbose,
-                                         checksum_fail=True)
-            else:
-                raise ValueError('Unable to download asset - checksum does '
-                                 'not match expected: {} != {} '
-                                 '(actual != expected)'.format(actual_checksum,
-                                                               asset.sha1))
-        else:
+def _download_asset_if_needed(asset, verbose=False, checksum_fail=False):
+    # if we know what the archive should hash to (or recorded what it hashed
+    # to last time), validating it is just a lookup in the blob store - a
+    # blob that has changed on disk since it was stored is re-hashed first
+    sha1 = (asset.sha1 if asset.sha1 is not None else
+            read_ref(asset.archive_path()))
+    if (sha1 is not None and asset.validate_checksum(sha1) and
+            link_blob(sha1, asset.archive_path())):
+        return
+    if asset.archive_path().is_file():
+        actual_checksum = asset.archive_checksum()
+        if asset.validate_checksum(actual_checksum):
+            store_blob(asset.archive_path(), actual_checksum)
             return
+        if verbose:
+            print("Warning: cached version of '{}' failed checksum - "
+                  "clearing cache".format(asset.name))
+        asset.cleanup_archive()
+    elif verbose:
+        print("'{}' managed asset is not cached - "
+              "downloading...".format(asset.name))
+    # the checksum is computed as the bytes arrive, so a fresh download never
+    # needs to be read back in to be validated
+    actual_checksum = download_file(asset.url, asset.archive_path())
+    if asset.validate_checksum(actual_checksum):
+        store_blob(asset.archive_path(), actual_checksum)
+        return
+    asset.cleanup_archive()
+    if not checksum_fail:
+        if verbose:
+            print("Warning: downloaded version of '{}' failed checksum - "
+                  "downloading again".format(asset.name))
+        _download_asset_if_needed(asset, verbose=verbose, checksum_fail=True)
     else:
+        raise ValueError('Unable to download asset - checksum does '
+                         'not match expected: {} != {} '
+                         '(actual != expected)'.format(actual_checksum,
+                                                       asset.sha1))
+
+
+def unpack_asset_if_needed(asset, verbose=False):
+    if not asset.persistent:
         if verbose:
-            print("'{}' managed asset is not cached - "
-                  "downloading...".format(asset.name))
-        download_file(asset.url, asset.archive_path())
-    download_asset_if_needed(asset, verbose=verbose,
-                             checksum_fail=checksum_fail)
+            print("Unpacking cached asset '{}'".format(asset.name))
+        asset.unpack()
+        return
+    # Hold the lock while checking, so concurrent menpobench processes wait
+    # for an in-progress unpack rather than seeing a half-extracted tree
+    with file_lock(asset.unpacked_lock_path()):
+        if asset.unpacked_is_valid():
+            if verbose:
+                print("Using unpacked asset '{}'".format(asset.name))
+        else:
+            if verbose:
+                print("Unpacking cached asset '{}' (will be kept for future "
+                      "runs)".format(asset.name))
+            asset.unpack_persistent()
+
+
+# What a streamed unpack raises when the download breaks off or is corrupt
+STREAM_UNPACK_ERRORS = (ValueError, IOError, EOFError, tarfile.TarError,
+                        zlib.error)
+
+
+def stream_unpack_asset_if_possible(asset, verbose=False):
+    r"""Download and unpack a persistent .tar.gz asset in one pass if it
+    isn't cached in any form. Returns True if the asset was streamed. If the
+    stream breaks off whatever was downloaded is kept, so the normal download
+    that follows resumes from it.
+    """
+    if not (isinstance(asset, WebSource) and asset.can_stream_unpack()):
+        return False
+    with file_lock(asset.download_lock_path()):
+        with file_lock(asset.unpacked_lock_path()):
+            # another process may have fetched the asset while we waited
+            if asset.unpacked_is_valid() or not asset.can_stream_unpack():
+                return False
+            if verbose:
+                print("'{}' managed asset is not cached - downloading and "
+                      "unpacking...".format(asset.name))
+            try:
+                with stage('download_unpack', asset=asset.name):
+                    asset.stream_unpack_persistent()
+            except STREAM_UNPACK_ERRORS as e:
+                if verbose:
+                    print('Warning: streamed download of {} failed ({}) - '
+                          'downloading again'.format(asset.name, e))
+                return False
+            return True
+
+
+def download_and_unpack_asset_if_needed(asset, verbose=False):
+    if stream_unpack_asset_if_possible(asset, verbose=verbose):
+        return
+    with stage('download', asset=asset.name):
+        download_asset_if_needed(asset, verbose=verbose)
+    with stage('unpack', asset=asset.name):
+        unpack_asset_if_needed(asset, verbose=verbose)
 
 
 @contextmanager
-def managed_asset(asset_set, name, verbose=True, cleanup=True):
+def managed_asset(asset_set, name, verbose=True, cleanup=True, pattern=None,
+                  max_members=None):
+    r"""Context manager yielding the path of an unpacked managed asset.
+    If the caller will only read the files matching pattern (or the first
+    max_members of them) and the asset's archive allows it, only those files
+    and whatever accompanies them are unpacked.
+    """
     asset = get_asset(name, asset_set)
     # Ensure the asset in question is cached locally
-    download_asset_if_needed(asset, verbose=verbose)
-    if verbose:
-        print("Unpacking cached asset '{}'".format(name))
-    asset.unpack()
+    members_only = pattern is not None and asset.can_unpack_members()
+    if members_only:
+        with stage('download', asset=name):
+            download_asset_if_needed(asset, verbose=verbose)
+        with stage('unpack_members', asset=name):
+            asset.unpack_members(pattern, max_members=max_members)
+    else:
+        download_and_unpack_asset_if_needed(asset, verbose=verbose)
     try:
         yield asset.unpacked_path()
     finally:
-        if cleanup:
+        # persistent unpacks are kept for the next run
+        if cleanup and (members_only or not asset.persistent):
             asset.cleanup_unpacked_data_if_present()
+
+
+def fetch_asset(asset_set, name):
+    asset = get_asset(name, asset_set)
+    with stage('prefetch', asset=name):
+        if asset.persistent:
+            # kept unpacked - a cold .tar.gz is streamed in a single pass,
+            # rather than left to be unpacked mid-benchmark. Only a caller
+            # of managed_asset reading part of an asset unpacks members.
+            download_and_unpack_asset_if_needed(asset)
+        else:
+            # other assets are unpacked to a temporary dir each time they
+            # are used, so there is nothing to unpack ahead of time
+            download_asset_if_needed(asset)
+    return name
+
+
+def prefetch_assets(assets, n_jobs=DEFAULT_ASSET_JOBS):
+    r"""Make sure every (asset set, name) pair given is downloaded (and if
+    kept unpacked, unpacked), fetching up to n_jobs assets concurrently.
+    """
+    assets = list(assets)
+    if len(assets) == 0:
+        return
+    pool = ThreadPool(processes=min(n_jobs, len(assets)))
+    try:
+        for name in pool.imap_unordered(lambda a: fetch_asset(*a), assets):
+            print("Asset '{}' is ready".format(name))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
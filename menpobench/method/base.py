@@ -5,6 +5,7 @@ from menpobench.lmprocess import (retrieve_lm_processes,
 from menpobench.utils import (load_module_with_error_messages, load_schema,
                               memoize, load_callable_with_error_messages,
                               predefined_module)
+from menpobench.timing import stage, timed_iter
 
 
 
@@ -100,9 +101,13 @@ class Train(Method):
         if self.lm_pre_train is not None:
             img_gen = wrap_img_gen_with_lm_process(img_gen, self.lm_pre_train)
         # Call the train method with our (potentially wrapped) generator
-        test = self.train(img_gen)
+        with stage('train', method=self.name):
+            test = self.train(img_gen)
         # finally wrap the test method returned with our test landmark process
         # steps
+        return self.wrap_test(test)
+
+    def wrap_test(self, test):
         return Test(test, self.name, self.metadata, self.lm_pre_test,
                     self.lm_post_test)
 
@@ -127,14 +132,24 @@ class Test(Method):
         self.lm_pre_test = lm_pre_test
         self.lm_post_test = lm_post_test
 
-    def __call__(self, img_gen):
+    def __call__(self, img_gen, n_jobs=1):
         # Invoke the test method we hold, but make sure we apply the landmark
         # parsing around the callable
         if self.lm_pre_test is not None:
             img_gen = wrap_img_gen_with_lm_process(img_gen, self.lm_pre_test)
-        results = self.test(img_gen)
+        kwargs = {}
+        if n_jobs > 1:
+            if getattr(self.test, 'supports_n_jobs', False):
+                kwargs['n_jobs'] = n_jobs
+            else:
+                print("'{}' does not support parallel fitting - fitting "
+                      "serially".format(self.name))
+        # record how long each result takes to come out of the method
+        results = timed_iter(self.test(img_gen, **kwargs), 'fit',
+                             method=self.name)
         if self.lm_post_test is not None:
-            results = [r.apply_lm_process(self.lm_post_test) for r in results]
+            results = (r.apply_lm_process(self.lm_post_test)
+                       for r in results)
         return results
 
     @property
@@ -189,9 +204,11 @@ def retrieve_untrainable_method(method_def):
 
 class BenchResult(object):
 
-    def __init__(self, final_shape, inital_shape=None):
+    def __init__(self, final_shape, inital_shape=None, fit_time=None):
         self.final_shape = final_shape
         self.initial_shape = inital_shape
+        # seconds taken to fit the image, if the method measured it
+        self.fit_time = fit_time
 
     @property
     def has_initial_shape(self):
@@ -201,10 +218,13 @@ class BenchResult(object):
         d = {'final': self.final_shape.points.tolist()}
         if self.has_initial_shape:
             d['initial'] = self.initial_shape.points.tolist()
+        if self.fit_time is not None:
+            d['fit_time'] = self.fit_time
         return d
 
     def apply_lm_process(self, lm_process):
         final_shape = lm_process(self.final_shape)
         initial_shape = (lm_process(self.initial_shape) if
                          self.has_initial_shape else None)
-        return BenchResult(final_shape, inital_shape=initial_shape)
+        return BenchResult(final_shape, inital_shape=initial_shape,
+                           fit_time=self.fit_time)
@@ -0,0 +1,81 @@
+import os
+import tempfile
+from contextlib import contextmanager
+try:
+    import cPickle as pickle  # Py2
+except ImportError:
+    import pickle  # Py3
+import menpobench
+from menpobench.cache import hash_of_id
+from menpobench.config import resolve_cache_dir
+from menpobench.exception import TrainedModelNotAvailable
+from menpobench.utils import create_path, file_lock
+
+
+# ----------- Cache path management ---------- #
+
+@create_path
+def model_dir():
+    return resolve_cache_dir() / 'models'
+
+
+def model_path(id_):
+    # pickled models are tied to the versions of the libraries that built them
+    # - key on the menpobench version as well as the training id.
+    key = {'model': id_, 'menpobench': menpobench.__version__}
+    return model_dir() / '{}.pkl'.format(hash_of_id(key))
+
+
+def model_lock_path(id_):
+    return model_path(id_).with_suffix('.lock')
+
+
+# ----------- Trained model storage ---------- #
+
+# What pickle raises for a model it can't pickle - e.g. one holding a lambda,
+# an open file or a handle on another process
+PICKLING_ERRORS = (pickle.PicklingError, TypeError, AttributeError)
+
+# What pickle raises for a cached model it can't load - e.g. one pickled
+# against classes that have since moved
+UNPICKLING_ERRORS = (pickle.UnpicklingError, EOFError, AttributeError,
+                     ImportError)
+
+
+def retrieve_trained_model(id_):
+    path = model_path(id_)
+    if not path.is_file():
+        raise TrainedModelNotAvailable('No cached model available')
+    with open(str(path), 'rb') as f:
+        try:
+            return pickle.load(f)
+        except UNPICKLING_ERRORS as e:
+            raise TrainedModelNotAvailable(
+                'Cached model cannot be loaded ({})'.format(e))
+
+
+@contextmanager
+def trained_model_lock(id_):
+    r"""Hold the lock on training the model with the given id, so that
+    concurrent menpobench processes needing the same model train it once -
+    the rest wait and then load it from the cache.
+    """
+    with file_lock(model_lock_path(id_)):
+        yield
+
+
+def save_trained_model(test, id_):
+    path = model_path(id_)
+    # write to a temporary file first so a crash (or a concurrent reader)
+    # never sees a truncated pickle
+    fd, tmp_path = tempfile.mkstemp(prefix=path.stem, dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(test, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if path.is_file():
+            path.unlink()
+        os.rename(tmp_path, str(path))
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
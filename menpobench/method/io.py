@@ -9,27 +9,50 @@ def save_landmarks_to_dir(images, label, out_path, output_ext='.pts'):
                                  out_path / '{}{}'.format(k, output_ext))
 
 
-def images_to_mat(images, out_path, attach_ground_truth=False):
+def image_to_mat_dict(im, attach_ground_truth=False):
     import numpy as np
-    from scipy.io import savemat
     as_fortran = np.asfortranarray
+    bbox = im.landmarks['bbox'].lms.bounds()
+    i_dict = {'pixels': as_fortran(im.rolled_channels()),
+              'bbox': as_fortran(np.array(bbox).ravel())}
+    if attach_ground_truth:
+        i_dict['gt'] = as_fortran(im.landmarks['gt'].lms.points)
+    return i_dict
+
 
-    image_dicts = []
-    for im in images:
-        bbox = im.landmarks['bbox'].lms.bounds()
-        i_dict = {'pixels': as_fortran(im.rolled_channels()),
-                  'bbox': as_fortran(np.array(bbox).ravel())}
-        if attach_ground_truth:
-            i_dict['gt'] = as_fortran(im.landmarks['gt'].lms.points)
-        image_dicts.append(i_dict)
+def images_to_mat(images, out_path, attach_ground_truth=False,
+                  name='menpobench_images'):
+    from scipy.io import savemat
+    image_dicts = [image_to_mat_dict(im,
+                                     attach_ground_truth=attach_ground_truth)
+                   for im in images]
 
     if not out_path.exists():
         out_path.mkdir(parents=True)
-    mat_out_path = out_path / 'menpobench_images.mat'
+    mat_out_path = out_path / '{}.mat'.format(name)
     print('Serializing image data to Matlab file: {}'.format(mat_out_path))
     savemat(str(mat_out_path), {'menpobench_images': image_dicts})
 
 
+def images_to_mat_shards(images, out_path, chunk_size,
+                         attach_ground_truth=False):
+    r"""Write images to a sequence of .mat files of at most chunk_size images
+    each, yielding the name of each shard once it has been written. Only one
+    shard's worth of images is held in memory at a time.
+    """
+    from itertools import count, islice
+    images = iter(images)
+    for k in count():
+        chunk = list(islice(images, chunk_size))
+        if len(chunk) == 0:
+            break
+        name = 'menpobench_images_{}'.format(k)
+        images_to_mat(chunk, out_path,
+                      attach_ground_truth=attach_ground_truth, name=name)
+        del chunk
+        yield name
+
+
 def save_images_to_dir(images, out_path, output_ext='.jpg'):
     from menpo.visualize import print_progress
     import menpo.io as mio
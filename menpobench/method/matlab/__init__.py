@@ -1 +1,2 @@
-from .base import train_matlab_method, MatlabWrapper
+from .base import (train_matlab_method, MatlabWrapper, MatlabSession,
+                   close_matlab_session)
@@ -1,13 +1,15 @@
 import os
+import subprocess
+import sys
 from subprocess import CalledProcessError
 from pathlib import Path
 import shutil
 from menpobench import configure_matlab_bin_path
 from menpobench.config import load_config
-from menpobench.exception import MissingConfigKeyError
+from menpobench.exception import MissingConfigKeyError, MatlabError
 from menpobench.method.base import (predefined_trainable_method_dir,
                                     BenchResult)
-from menpobench.method.io import images_to_mat
+from menpobench.method.io import images_to_mat_shards
 from menpobench.utils import (invoke_process, TempDirectory, memoize,
                               is_windows, is_osx, is_linux)
 
@@ -82,35 +84,141 @@ def resolve_matlab_bin_path(verbose=False):
     return matlab_bin_path
 
 
+# Printed by Matlab once a command sent to a session has finished, followed by
+# 'ok' or 'error <message>'
+_SESSION_MARKER = '__menpobench_matlab__'
+
+_SESSION_COMMAND = ("try, {command} fprintf('\\n{marker} ok\\n'); "
+                    "catch e, fprintf('\\n{marker} error %s\\n', "
+                    "strrep(e.message, sprintf('\\n'), ' ')); end\n")
+
+
+class MatlabSession(object):
+    r"""A long-lived Matlab process that commands are sent to over stdin, so
+    that Matlab's startup cost is only paid once per menpobench run.
+
+    Each command is written as a single line wrapped in a try/catch that, once
+    the command has finished, prints a line containing _SESSION_MARKER
+    followed by either 'ok' or 'error <message>'. Everything printed before
+    that line is echoed through. Any executable that speaks this line
+    protocol can stand in for Matlab.
+    """
+
+    def __init__(self, matlab_bin_path):
+        self.matlab_bin_path = matlab_bin_path
+        self.process = None
+
+    @property
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        print('Starting Matlab session: {}'.format(self.matlab_bin_path))
+        self.process = subprocess.Popen(
+            ['{}'.format(self.matlab_bin_path),
+             '-nosplash', '-nodesktop', '-nojvm'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True, bufsize=1)
+        self.run("addpath('{}');".format(matlab_functions_dir()))
+
+    def run(self, command):
+        if not self.is_running:
+            self.start()
+        self.process.stdin.write(_SESSION_COMMAND.format(
+            command=command, marker=_SESSION_MARKER))
+        self.process.stdin.flush()
+        for line in iter(self.process.stdout.readline, ''):
+            i = line.find(_SESSION_MARKER)
+            if i == -1:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                continue
+            status = line[i + len(_SESSION_MARKER):].strip()
+            if status == 'ok':
+                return
+            message = status[len('error'):].strip()
+            raise MatlabError('Matlab command failed: {}\n'
+                              '{}'.format(command, message))
+        # stdout closed before we were told the command finished
+        self.process = None
+        raise MatlabError('Matlab session exited while running: '
+                          '{}'.format(command))
+
+    def close(self):
+        if self.is_running:
+            self.process.stdin.write('exit\n')
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+
+# One Matlab session per menpobench process, started on first use
+_SESSION = {'session': None}
+
+
+def matlab_session():
+    if _SESSION['session'] is None:
+        _SESSION['session'] = MatlabSession(resolve_matlab_bin_path())
+    return _SESSION['session']
+
+
+def close_matlab_session():
+    if _SESSION['session'] is not None:
+        _SESSION['session'].close()
+        _SESSION['session'] = None
+
+
 def invoke_matlab(command):
-    matlab_bin_path = resolve_matlab_bin_path()
-    invoke_process(['{}'.format(matlab_bin_path),
-                    '-nosplash', '-nodesktop', '-nojvm', '-r',
-                    '{}'.format(command)])
+    if not is_windows():
+        matlab_session().run(command)
+    else:
+        # Matlab on Windows doesn't read commands from stdin - start a fresh
+        # process for the command
+        matlab_bin_path = resolve_matlab_bin_path()
+        invoke_process(['{}'.format(matlab_bin_path),
+                        '-nosplash', '-nodesktop', '-nojvm', '-r',
+                        "addpath('{}'); try, {} catch e, disp(getReport(e)); "
+                        "exit(1); end; exit(0);".format(matlab_functions_dir(),
+                                                        command)])
 
 
-def load_matlab_results(results_path):
+def load_matlab_results(results_path, name='menpobench_test_results'):
     from menpo.shape import PointCloud
     from scipy.io import loadmat
-    results = loadmat(str(results_path / 'menpobench_test_results.mat'))
-    return [BenchResult(PointCloud(r[0])) for r in results['results']]
+    results = loadmat(str(results_path / '{}.mat'.format(name)))
+    # older fit scripts don't time each image
+    fit_times = (results['fit_times'].ravel() if 'fit_times' in results else
+                 [None] * len(results['results']))
+    return [BenchResult(PointCloud(r[0]),
+                        fit_time=None if t is None else float(t))
+            for r, t in zip(results['results'], fit_times)]
+
+
+# Number of test images handed over to Matlab at a time
+MATLAB_CHUNK_SIZE = 100
 
 
 class MatlabWrapper(object):
 
-    def __init__(self, method_path):
+    def __init__(self, method_path, chunk_size=MATLAB_CHUNK_SIZE):
         self.method_path = method_path
+        self.chunk_size = chunk_size
 
     def __call__(self, img_generator):
         test_path = TempDirectory.create_new() / 'menpobench_test_images'
-        # Save images down to mat file
-        images_to_mat(img_generator, test_path)
-
-        # Call matlab bridge to test file - will drop out a result mat
-        invoke_matlab("addpath('{}'); menpobench_matlab_fit('{}', '{}');".format(
-            matlab_functions_dir(), self.method_path, test_path))
-        
-        return load_matlab_results(test_path)
+        # Save images down to a series of mat files, fitting each one as soon
+        # as it is written. Only one chunk of images (and results) is ever
+        # held in memory or on disk.
+        for shard in images_to_mat_shards(img_generator, test_path,
+                                          self.chunk_size):
+            # Call matlab bridge to test file - will drop out a result mat
+            invoke_matlab("menpobench_matlab_fit('{}', '{}', '{}');".format(
+                self.method_path, test_path, shard))
+            results_name = '{}_results'.format(shard)
+            for result in load_matlab_results(test_path, name=results_name):
+                yield result
+            for name in (shard, results_name):
+                (test_path / '{}.mat'.format(name)).unlink()
 
 
 def train_matlab_method(method_path, matlab_train_filename,
@@ -122,5 +230,5 @@ def train_matlab_method(method_path, matlab_train_filename,
                     str(method_path / 'menpobench_namespace.m'))
 
     # Call matlab bridge to train file - will drop out a model file
-    invoke_matlab("addpath('{}'); menpobench_matlab_train('{}', '{}');".format(
-        matlab_functions_dir(), method_path, training_images_path))
+    invoke_matlab("menpobench_matlab_train('{}', '{}');".format(
+        method_path, training_images_path))
@@ -1,27 +1,48 @@
-function menpobench_matlab_fit(method_path, testing_images_path)
+function menpobench_matlab_fit(method_path, testing_images_path, shard_name)
+
+    % The model is kept between calls so a test set sent over in several
+    % shards to a persistent Matlab session only sets up the model once.
+    persistent model model_path;
+
+    if nargin < 3
+        shard_name = 'menpobench_images';
+        results_name = 'menpobench_test_results';
+    else
+        results_name = [shard_name '_results'];
+    end
 
     menpobench_addpath_recurse(method_path);
+    % leave the path as we found it however this call ends (even on error) -
+    % a persistent Matlab session may go on to run other methods with their
+    % own menpobench_namespace
+    restore_path = onCleanup(@() menpobench_addpath_recurse(method_path, ...
+                                                            {''}, 'begin', true));
     menpobench = menpobench_namespace();
 
-    display('Setting up model...');
-    model = menpobench.setup(method_path);
+    if isempty(model_path) || ~strcmp(model_path, method_path)
+        display('Setting up model...');
+        model = menpobench.setup(method_path);
+        model_path = method_path;
+    end
 
     display('Loading test data...');
-    image_data_array = menpobench_read_images_struct(testing_images_path);
+    image_data_array = menpobench_read_images_struct(testing_images_path, ...
+                                                     shard_name);
     n_images = length(image_data_array);
 
     results = cell(n_images, 1);
+    fit_times = zeros(n_images, 1);
     menpobench_progressbar('Fitting test images: ');
     for i=1:n_images
         menpobench_progressbar((i / n_images) * 100);
         image_data = image_data_array{i}.pixels;
         bbox = image_data_array{i}.bbox;
+        fit_start = tic;
         results{i} = menpobench.fit(image_data, bbox, model);
+        fit_times(i) = toc(fit_start);
     end
     menpobench_progressbar('done');
 
     display('Saving results...');
-    save(fullfile(testing_images_path, 'menpobench_test_results.mat'), 'results');
-
-    exit(0);
+    save(fullfile(testing_images_path, [results_name '.mat']), 'results', 'fit_times');
 end
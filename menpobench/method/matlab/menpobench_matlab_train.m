@@ -1,6 +1,11 @@
 function menpobench_matlab_train(method_path, training_images_path)
 
     menpobench_addpath_recurse(method_path);
+    % leave the path as we found it however this call ends (even on error) -
+    % a persistent Matlab session may go on to run other methods with their
+    % own menpobench_namespace
+    restore_path = onCleanup(@() menpobench_addpath_recurse(method_path, ...
+                                                            {''}, 'begin', true));
     menpobench = menpobench_namespace();
 
     display('Training method...');
@@ -8,6 +13,4 @@ function menpobench_matlab_train(method_path, training_images_path)
 
     display('Saving model...');
     save(fullfile(method_path, 'model.mat'), 'model');
-
-    exit(0);
 end
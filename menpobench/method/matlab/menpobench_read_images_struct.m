@@ -1,5 +1,8 @@
-function menpobench_images = menpobench_read_images_struct(base_path)
+function menpobench_images = menpobench_read_images_struct(base_path, name)
 
-    images_struct_path = fullfile(base_path, 'menpobench_images.mat');
+    if nargin < 2
+        name = 'menpobench_images';
+    end
+    images_struct_path = fullfile(base_path, [name '.mat']);
     load(images_struct_path);
 end
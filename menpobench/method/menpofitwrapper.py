@@ -1,29 +1,91 @@
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, current_process
+import time
 from menpobench.imgprocess import menpo_img_process
 from .base import BenchResult
 
 
-def menpofit_to_result(fr):
-    return BenchResult(fr.final_shape, inital_shape=fr.initial_shape)
+def menpofit_to_result(fr, fit_time=None):
+    return BenchResult(fr.final_shape, inital_shape=fr.initial_shape,
+                       fit_time=fit_time)
+
+
+def fit_image(fitter, img):
+    from menpo.transform import AlignmentSimilarity
+    # note that we don't want to crop the image in our preprocessing
+    # that's because the gt on the image we are passed is what will
+    # be used for assessment - we will introduce large errors if this
+    # is modified in size.
+    img = menpo_img_process(img, crop=False)
+    bbox = img.landmarks['bbox'].lms
+    ref_shape = fitter.reference_shape
+    shape_bb = ref_shape.bounding_box()
+    init_shape = AlignmentSimilarity(shape_bb, bbox).apply(ref_shape)
+    # only the fit itself is timed - not loading or preparing the image
+    start = time.time()
+    fr = fitter.fit(img, init_shape)
+    return menpofit_to_result(fr, fit_time=time.time() - start)
+
+
+# Each worker of a parallel fit holds its own copy of the fitter, handed over
+# once as the worker starts rather than being pickled with every image.
+_WORKER_STATE = {'fitter': None}
+
+# Images handed to a pool of fitting processes ahead of the results being
+# consumed, per process. Enough to keep every process busy - any more and the
+# test set is drawn into memory faster than it is fitted.
+IMAGES_IN_FLIGHT_PER_JOB = 2
+
+
+def _init_fit_worker(fitter):
+    _WORKER_STATE['fitter'] = fitter
+
+
+def _fit_image_in_worker(img):
+    return fit_image(_WORKER_STATE['fitter'], img)
 
 
 class MenpoFitWrapper(object):
 
+    # Test will pass through the number of fitting processes to use
+    supports_n_jobs = True
+
     def __init__(self, fitter):
         self.fitter = fitter
 
-    def __call__(self, img_generator):
-        from menpo.transform import AlignmentSimilarity
-        results = []
-        ref_shape = self.fitter.reference_shape
-        for img in img_generator:
-            # note that we don't want to crop the image in our preprocessing
-            # that's because the gt on the image we are passed is what will
-            # be used for assessment - we will introduce large errors if this
-            # is modified in size.
-            img = menpo_img_process(img, crop=False)
-            bbox = img.landmarks['bbox'].lms
-            shape_bb = ref_shape.bounding_box()
-            init_shape = AlignmentSimilarity(shape_bb, bbox).apply(ref_shape)
-            menpofit_fr = self.fitter.fit(img, init_shape)
-            results.append(menpofit_to_result(menpofit_fr))
-        return results
+    def __call__(self, img_generator, n_jobs=1):
+        if n_jobs > 1 and current_process().daemon:
+            # we are already a worker of a --jobs pool, which cannot have
+            # child processes of its own
+            print('Parallel fitting is unavailable inside a method worker '
+                  '- fitting serially')
+            n_jobs = 1
+        if n_jobs == 1:
+            # results are yielded as they are produced so they can be
+            # streamed straight to disk
+            return (fit_image(self.fitter, img) for img in img_generator)
+        else:
+            return self._fit_in_pool(img_generator, n_jobs)
+
+    def _fit_in_pool(self, img_generator, n_jobs):
+        pool = Pool(processes=n_jobs, initializer=_init_fit_worker,
+                    initargs=(self.fitter,))
+        try:
+            # a bounded window of images is in the pool at once. Results are
+            # handed back in input order, so they line up with the ids
+            # collected as the generator is consumed
+            imgs = iter(img_generator)
+            window = IMAGES_IN_FLIGHT_PER_JOB * n_jobs
+            pending = deque(pool.apply_async(_fit_image_in_worker, (img,))
+                            for img in islice(imgs, window))
+            while len(pending) > 0:
+                result = pending.popleft().get()
+                for img in islice(imgs, 1):
+                    pending.append(pool.apply_async(_fit_image_in_worker,
+                                                    (img,)))
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
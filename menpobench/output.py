@@ -1,33 +1,384 @@
+import json
+import os
+import shutil
+import tempfile
+import zipfile
 import numpy as np
 from pathlib import Path
 from collections import namedtuple
-from menpobench.utils import save_json, load_json
+from menpobench.timing import stage, timed, recorded_stages
+from menpobench.utils import save_json, load_json, norm_path
 
 ErrorResult = namedtuple('ErrorResult', ['errors', 'path'])
 
 
-def save_test_results(results, method_name, output_dir, matlab=False):
-    save_json(results, str(output_dir / '{}.json'.format(method_name)),
-              pretty=True)
+class ResultsLog(object):
+    r"""An append-only log of per-image test results on disk, one JSON object
+    per line. Results are written as soon as they are produced, so memory use
+    does not grow with the size of the test set.
+
+    Offers the read-only parts of the dict interface that the output stage
+    uses, streaming results back off disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return self.path.is_file()
+
+    def recorded_ids(self):
+        r"""The set of ids already in the log. Any partially written final
+        entry (from a run that was killed mid-write) is dropped.
+        """
+        with open(norm_path(self.path), 'r+b') as f:
+            content = f.read()
+            complete = content.rfind(b'\n') + 1
+            if complete != len(content):
+                f.truncate(complete)
+        return set(self.keys())
+
+    def extend(self, id_result_gen, append=False):
+        with open(norm_path(self.path), 'at' if append else 'wt') as f:
+            for id_, result in id_result_gen:
+                f.write(json.dumps({'id': id_, 'result': result}) + '\n')
+                f.flush()
+
+    def items(self):
+        with open(norm_path(self.path), 'rt') as f:
+            for line in f:
+                entry = json.loads(line)
+                yield entry['id'], entry['result']
+
+    def keys(self):
+        return (id_ for id_, _ in self.items())
+
+    def values(self):
+        return (r for _, r in self.items())
+
+    def delete(self):
+        if self.path.is_file():
+            self.path.unlink()
+
+
+class ArrayResults(object):
+    r"""Test results held as contiguous arrays - the ids and the ground
+    truth, initial and final shapes of every image stacked into
+    ``(n_images, n_points, n_dims)`` arrays. Stored on disk as a .npz file, so
+    results can be reloaded without parsing JSON.
+
+    Offers the same read-only dict interface as ResultsLog.
+
+    Where only some results have an initial shape or fit time, the missing
+    entries are NaN and a boolean mask (has_initial, has_fit_time) records
+    which are real. The masks are None when every result has one.
+    """
+
+    def __init__(self, ids, gt, final, initial=None, fit_time=None,
+                 has_initial=None, has_fit_time=None):
+        self.ids = ids
+        self.gt = gt
+        self.final = final
+        self.initial = initial
+        self.fit_time = fit_time
+        self.has_initial = has_initial
+        self.has_fit_time = has_fit_time
+
+    @classmethod
+    def from_results(cls, results):
+        r"""Build from any results mapping. Raises ValueError if the shapes
+        can't be stacked (e.g. images have different numbers of points).
+        """
+        ids, gt, final, initial, fit_time = [], [], [], [], []
+        for id_, r in results.items():
+            ids.append(id_)
+            gt.append(r['gt'])
+            final.append(r['result']['final'])
+            initial.append(r['result'].get('initial'))
+            fit_time.append(r['result'].get('fit_time'))
+        gt = np.array(gt, dtype=np.float64)
+        final = np.array(final, dtype=np.float64)
+        for a in (gt, final):
+            if a.ndim != 3 and len(ids) > 0:
+                raise ValueError('Results have shapes with differing numbers '
+                                 'of points - cannot store as arrays')
+        initial, has_initial = _masked_array(initial, final.shape[1:])
+        fit_time, has_fit_time = _masked_array(fit_time, ())
+        return cls(np.array(ids), gt, final, initial=initial,
+                   fit_time=fit_time, has_initial=has_initial,
+                   has_fit_time=has_fit_time)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(norm_path(filepath)) as f:
+            optional = dict((k, f[k] if k in f else None)
+                            for k in ['initial', 'fit_time', 'has_initial',
+                                      'has_fit_time'])
+            return cls(f['ids'], f['gt'], f['final'], **optional)
+
+    def save(self, filepath):
+        arrays = {'ids': self.ids, 'gt': self.gt, 'final': self.final}
+        for k in ['initial', 'fit_time', 'has_initial', 'has_fit_time']:
+            if getattr(self, k) is not None:
+                arrays[k] = getattr(self, k)
+        np.savez(norm_path(filepath), **arrays)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def items(self):
+        for i, id_ in enumerate(self.ids):
+            result = {'final': self.final[i].tolist()}
+            if _has(self.initial, self.has_initial, i):
+                result['initial'] = self.initial[i].tolist()
+            if _has(self.fit_time, self.has_fit_time, i):
+                result['fit_time'] = float(self.fit_time[i])
+            yield str(id_), {'gt': self.gt[i].tolist(), 'result': result}
+
+    def keys(self):
+        return (str(id_) for id_ in self.ids)
+
+    def values(self):
+        return (r for _, r in self.items())
+
+
+def _masked_array(values, shape):
+    # values (some of which may be None) as an array, and a mask of which
+    # are present - None if all are. Both are None if none are present.
+    present = np.array([v is not None for v in values], dtype=bool)
+    if not np.any(present):
+        return None, None
+    array = np.full((len(values),) + tuple(shape), np.nan)
+    for i, v in enumerate(values):
+        if v is None:
+            continue
+        if np.shape(v) != tuple(shape):
+            raise ValueError('Results have shapes with differing numbers '
+                             'of points - cannot store as arrays')
+        array[i] = v
+    return array, None if np.all(present) else present
+
+
+def _has(array, mask, i):
+    return array is not None and (mask is None or bool(mask[i]))
+
+
+def _results_array_layout(results):
+    # a pass over the results finding the shape and dtype of every array
+    # needed to store them - None if there are no results
+    n, id_len, gt_shape, final_shape = 0, 1, None, None
+    n_initial, n_fit_time = 0, 0
+    for id_, r in results.items():
+        if n == 0:
+            gt_shape, final_shape = (np.shape(r['gt']),
+                                     np.shape(r['result']['final']))
+        initial = r['result'].get('initial')
+        if (len(gt_shape) != 2 or len(final_shape) != 2 or
+                np.shape(r['gt']) != gt_shape or
+                np.shape(r['result']['final']) != final_shape or
+                (initial is not None and np.shape(initial) != final_shape)):
+            raise ValueError('Results have shapes with differing numbers '
+                             'of points - cannot store as arrays')
+        n += 1
+        id_len = max(id_len, len(id_))
+        n_initial += initial is not None
+        n_fit_time += r['result'].get('fit_time') is not None
+    if n == 0:
+        return None
+    arrays = {'ids': ((n,), 'U{}'.format(id_len)),
+              'gt': ((n,) + gt_shape, np.float64),
+              'final': ((n,) + final_shape, np.float64)}
+    for name, shape, n_present in [('initial', final_shape, n_initial),
+                                   ('fit_time', (), n_fit_time)]:
+        if n_present > 0:
+            arrays[name] = ((n,) + shape, np.float64)
+        if 0 < n_present < n:
+            arrays['has_' + name] = ((n,), bool)
+    return arrays
+
+
+def write_results_array(results, filepath):
+    r"""Save results as the .npz file ArrayResults.load reads. Results that
+    aren't already arrays are written straight into arrays on disk over two
+    passes, so a results log is never held in memory. Raises ValueError if
+    the shapes can't be stacked.
+    """
+    if isinstance(results, ArrayResults):
+        results.save(filepath)
+        return
+    layout = _results_array_layout(results)
+    if layout is None:
+        ArrayResults.from_results({}).save(filepath)
+        return
+    build_dir = tempfile.mkdtemp()
+    try:
+        arrays = dict((name, np.lib.format.open_memmap(
+            os.path.join(build_dir, name + '.npy'), mode='w+', dtype=dtype,
+            shape=shape)) for name, (shape, dtype) in layout.items())
+        for i, (id_, r) in enumerate(results.items()):
+            arrays['ids'][i] = id_
+            arrays['gt'][i] = r['gt']
+            arrays['final'][i] = r['result']['final']
+            for name in ['initial', 'fit_time']:
+                if name not in arrays:
+                    continue
+                value = r['result'].get(name)
+                arrays[name][i] = np.nan if value is None else value
+                if 'has_' + name in arrays:
+                    arrays['has_' + name][i] = value is not None
+        for a in arrays.values():
+            a.flush()
+        del arrays
+        # laid out as np.savez would
+        with zipfile.ZipFile(norm_path(filepath), 'w', zipfile.ZIP_STORED,
+                             allowZip64=True) as z:
+            for name in layout:
+                z.write(os.path.join(build_dir, name + '.npy'),
+                        name + '.npy')
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def write_results_json(results, write, pretty=True):
+    r"""Write a results mapping out as JSON one entry at a time through the
+    write callable. The output matches json.dumps(dict(results.items())) -
+    if pretty, as save_json(..., pretty=True) writes it.
+    """
+    if pretty:
+        dumps = lambda x: json.dumps(x, indent=4, separators=(',', ': '))
+        indent, separator, end = '    ', ',\n', '\n}'
+    else:
+        dumps, indent, separator, end = json.dumps, '', ', ', '}'
+    write('{')
+    first = True
+    for id_, result in results.items():
+        if first:
+            write('\n' if pretty else '')
+        else:
+            write(separator)
+        write('{}{}: '.format(indent, dumps(id_)))
+        write(dumps(result).replace('\n', '\n' + indent))
+        first = False
+    write('}' if first else end)
+
+
+def save_results_json(results, filepath):
+    r"""Write a results mapping out as JSON one entry at a time. The output
+    matches save_json(dict(results.items()), pretty=True).
+    """
+    with open(norm_path(filepath), 'wt') as f:
+        write_results_json(results, f.write)
+
+
+def save_results_array(results, filepath):
+    try:
+        write_results_array(results, filepath)
+    except ValueError as e:
+        print('Warning: not saving binary results - {}'.format(e))
+
+
+def save_test_results(results, method_name, output_dir, matlab=False,
+                      binary=False):
+    path = output_dir / '{}.json'.format(method_name)
+    with stage('save_results', method=method_name):
+        if isinstance(results, dict):
+            save_json(results, str(path), pretty=True)
+        else:
+            # stream results that aren't in memory straight out
+            save_results_json(results, path)
+        if binary:
+            save_results_array(results,
+                               output_dir / '{}.npz'.format(method_name))
     if matlab:
         print('TODO: export .mat file here.')
 
 
-def compute_and_save_errors(results, error_metrics, method_name, output_dir):
-    json = {}
-    for error_name, error_metric in error_metrics:
-        # error_name may be a path or a predefined
-        name = Path(error_name).name.replace('.', '_')
-        json[name] = [float(error_metric(np.array(r['gt']),
-                                         np.array(r['result']['final'])))
-                      for r in results.values()]
-    save_json(json, str(output_dir / '{}.json'.format(method_name)),
-              pretty=True)
+# Results that aren't already held as arrays are stacked this many images at a
+# time, so computing errors over a results log streamed off disk only ever
+# holds this many shapes in memory
+ERRORS_CHUNK_SIZE = 1000
+
+
+def iter_stacked_shapes(results):
+    r"""Gather the ground truth and final shapes of the results into pairs
+    of ``(n_images, n_points, n_dims)`` arrays, ERRORS_CHUNK_SIZE images at a
+    time, in a single pass over the results. If the images of a chunk don't all
+    have the same number of points, lists of per-image arrays are yielded
+    instead.
+    """
+    if isinstance(results, ArrayResults):
+        yield results.gt, results.final
+        return
+    chunk = []
+    for r in results.values():
+        chunk.append(r)
+        if len(chunk) == ERRORS_CHUNK_SIZE:
+            yield _stack_shapes(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        yield _stack_shapes(chunk)
+
+
+def _stack_shapes(values):
+    gt, final = [], []
+    for r in values:
+        gt.append(np.array(r['gt']))
+        final.append(np.array(r['result']['final']))
+    if (len(set(g.shape for g in gt)) == 1 and
+            len(set(f.shape for f in final)) == 1):
+        return np.array(gt), np.array(final)
+    else:
+        return gt, final
+
+
+def compute_errors(gt, final, error_metric):
+    if isinstance(gt, np.ndarray):
+        return error_metric(gt, final)
+    else:
+        # ragged - evaluate each image as a batch of one
+        return np.array([error_metric(g[None], f[None])[0]
+                         for g, f in zip(gt, final)])
 
 
+def compute_and_save_errors(results, error_metrics, method_name, output_dir,
+                            binary=False):
+    # error_name may be a path or a predefined
+    names = [Path(error_name).name.replace('.', '_')
+             for error_name, _ in error_metrics]
+    errors = dict((name, []) for name in names)
+    with stage('errors', method=method_name):
+        # every metric is computed on each chunk of results as it is read
+        for gt, final in iter_stacked_shapes(results):
+            for name, (_, error_metric) in zip(names, error_metrics):
+                errors[name].append(compute_errors(gt, final, error_metric))
+        errors = dict((name, np.concatenate(e) if len(e) > 0 else
+                       np.array([])) for name, e in errors.items())
+    save_json({k: v.tolist() for k, v in errors.items()},
+              str(output_dir / '{}.json'.format(method_name)), pretty=True)
+    if binary:
+        np.savez(str(output_dir / '{}.npz'.format(method_name)), **errors)
+
+
+def load_errors(path):
+    if path.suffix == '.npz':
+        with np.load(str(path)) as f:
+            return {k: f[k] for k in f.files}
+    else:
+        return load_json(path)
+
+
+def error_paths(output_dir):
+    # where a method has errors saved in both formats, prefer the binary
+    paths = {}
+    for ext in ['json', 'npz']:
+        for p in (output_dir / 'errors').glob('**/*.{}'.format(ext)):
+            paths[p.with_suffix('')] = p
+    return sorted(paths.values())
+
+
+@timed('plot')
 def plot_ceds(output_dir):
-    results = [ErrorResult(load_json(e), e)
-               for e in (output_dir / 'errors').glob('**/*.json')]
+    results = [ErrorResult(load_errors(e), e) for e in error_paths(output_dir)]
     metrics = results[0].errors.keys()
     for metric in metrics:
         errors, method_names = [], []
@@ -51,5 +402,113 @@ def plot_ced(errors, method_names, error_metric_name, output_dir):
     plt.clf()
 
 
+def load_results(path):
+    if path.suffix == '.npz':
+        return ArrayResults.load(path)
+    else:
+        return load_json(path)
+
+
+def fit_times(results):
+    r"""The time taken to fit each image, or None if the method didn't
+    record fit times.
+    """
+    if isinstance(results, ArrayResults):
+        return results.fit_time if results.has_fit_time is None else None
+    times = [r['result'].get('fit_time') for r in results.values()]
+    if len(times) == 0 or any(t is None for t in times):
+        return None
+    return np.array(times)
+
+
+def speed_summary(times, fit_wall=None):
+    r"""Summarise per-image fit times. fit_wall is the (n_images, seconds)
+    that fitting took by the clock in this run, if it was fitted in this run -
+    with fit jobs > 1 images are fitted side by side, so only this gives the
+    throughput achieved.
+    """
+    total = float(np.sum(times))
+    summary = {
+        'n_images': len(times),
+        'mean': float(np.mean(times)),
+        'p50': float(np.percentile(times, 50)),
+        'p95': float(np.percentile(times, 95)),
+        'p99': float(np.percentile(times, 99)),
+        'total': total,
+        # images per second fitting one image at a time
+        'serial_throughput': len(times) / total if total > 0 else None,
+        'throughput': None
+    }
+    if fit_wall is not None and fit_wall[1] > 0:
+        summary['throughput'] = fit_wall[0] / fit_wall[1]
+    return summary
+
+
+def output_name(path, section_dir):
+    # e.g. 'trainable_methods/aam' - method names are only unique within a
+    # section
+    return path.relative_to(section_dir).with_suffix('').as_posix()
+
+
+def results_paths(output_dir):
+    # where a method has results saved in both formats, prefer the binary
+    paths = {}
+    for ext in ['json', 'npz']:
+        for p in (output_dir / 'results').glob('**/*.{}'.format(ext)):
+            paths[p.with_suffix('')] = p
+    return sorted(paths.values())
+
+
+def fit_wall(name):
+    r"""The (n_images, seconds) fitting the method with the given output
+    name took by the clock in this run, or None if it wasn't fitted.
+    """
+    section, method = name.rsplit('/', 1)
+    records = recorded_stages('fit', method=method, section=section)
+    if len(records) == 0:
+        return None
+    return (sum(r['n_items'] for r in records),
+            sum(r['wall'] for r in records))
+
+
+def summarise_speed(output_dir):
+    r"""Summarise the fit latency of every method in an output dir into
+    speed.json, and plot accuracy against speed next to the CED curves.
+    """
+    speed = {}
+    for path in results_paths(output_dir):
+        times = fit_times(load_results(path))
+        if times is not None:
+            name = output_name(path, output_dir / 'results')
+            speed[name] = speed_summary(times, fit_wall=fit_wall(name))
+    if len(speed) == 0:
+        return
+    save_json(speed, str(output_dir / 'speed.json'), pretty=True)
+    plot_accuracy_vs_speed(speed, output_dir)
+
+
+@timed('plot')
+def plot_accuracy_vs_speed(speed, output_dir):
+    from matplotlib import pyplot as plt
+    errors_dir = output_dir / 'errors'
+    results = [ErrorResult(load_errors(e), e) for e in error_paths(output_dir)
+               if output_name(e, errors_dir) in speed]
+    if len(results) == 0:
+        return
+    for metric in results[0].errors.keys():
+        for result in results:
+            name = output_name(result.path, errors_dir)
+            x = speed[name]['p50']
+            y = np.median(result.errors[metric])
+            plt.plot(x, y, 'o')
+            plt.annotate(name, (x, y), xytext=(4, 4),
+                         textcoords='offset points')
+        plt.xscale('log')
+        plt.xlabel('Median fit time per image (s)')
+        plt.ylabel('Median error ({})'.format(metric))
+        plt.savefig(str(output_dir / '{}_vs_speed.pdf'.format(metric)))
+        plt.clf()
+
+
 def _unique_stems(paths):
     return len(set(p.stem for p in paths)) == len(paths)
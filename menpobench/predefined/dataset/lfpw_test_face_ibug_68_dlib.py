@@ -1,10 +1,10 @@
-import menpo.io as mio
 from menpo.landmark.labels import ibug_face_68
-from menpobench.dataset import managed_dataset
+from menpobench.dataset import managed_dataset, import_images
 
 metadata = {
     'display_name': 'Labelled Face Parts in the Wild Testset with iBUG68 landmarks and DLIB bounding boxes',
-    'display_name_short': 'LFPW test'
+    'display_name_short': 'LFPW test',
+    'managed_assets': ['lfpw-test']
 }
 
 
@@ -16,10 +16,10 @@ def _resolver(img):
     }
 
 
-def generate_dataset():
+def generate_dataset(keep=None, seed=None):
     with managed_dataset('lfpw-test') as p:
-        for img in mio.import_images(p / '*.png',
-                                     normalise=False, shuffle=True,
-                                     landmark_resolver=_resolver):
+        for img in import_images(p / '*.png', keep=keep, seed=seed,
+                                 normalise=False,
+                                 landmark_resolver=_resolver):
             img.landmarks['gt'] = ibug_face_68(img.landmarks['gt'])[1]
             yield img.path.stem, img
@@ -1,10 +1,12 @@
-import menpo.io as mio
 from menpo.landmark.labels import ibug_face_68
-from menpobench.dataset import managed_dataset
+from menpobench.dataset import managed_dataset, import_images
 
 metadata = {
     'display_name': 'Labelled Face Parts in the Wild Trainset with iBUG68 landmarks and DLIB bounding boxes',
-    'display_name_short': 'LFPW train'
+    'display_name_short': 'LFPW train',
+    'managed_assets': ['lfpw-train'],
+    # 2: the first 20 images rather than a random 20
+    'version': 2
 }
 
 
@@ -16,10 +18,11 @@ def _resolver(img):
     }
 
 
-def generate_dataset():
-    with managed_dataset('lfpw-train') as p:
-        for img in mio.import_images(p / '*.png', max_images=20,
-                                     normalise=False, shuffle=True,
-                                     landmark_resolver=_resolver):
+def generate_dataset(keep=None, seed=None):
+    # only the images read (and their landmarks) need be unpacked
+    with managed_dataset('lfpw-train', pattern='*.png', max_members=20) as p:
+        for img in import_images(p / '*.png', max_images=20, keep=keep,
+                                 seed=seed, normalise=False,
+                                 landmark_resolver=_resolver):
             img.landmarks['gt'] = ibug_face_68(img.landmarks['gt'])[1]
             yield img.path.stem, img
@@ -1,4 +1,8 @@
-from menpobench.errormetric import mean_error
+from menpobench.errormetric import mean_error, batch_mean_error
 
 def error_metric(gt, final):
     return mean_error(gt, final)
+
+
+def batch_error_metric(gt, final):
+    return batch_mean_error(gt, final)
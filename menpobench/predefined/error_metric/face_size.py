@@ -1,6 +1,11 @@
 import numpy as np
-from menpobench.errormetric import mean_error
+from menpobench.errormetric import mean_error, batch_mean_error
 
 def error_metric(gt, final):
     normalizer = np.mean(np.max(gt, axis=0) - np.min(gt, axis=0))
     return mean_error(gt, final) / normalizer
+
+
+def batch_error_metric(gt, final):
+    normalizer = np.mean(np.max(gt, axis=1) - np.min(gt, axis=1), axis=-1)
+    return batch_mean_error(gt, final) / normalizer
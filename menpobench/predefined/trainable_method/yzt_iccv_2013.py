@@ -5,7 +5,8 @@ from menpobench.method import (save_images_to_dir, save_landmarks_to_dir,
 metadata = {
     'display_name': 'YZT AAM (ICCV 2013)',
     'display_name_short': 'YZT AAM',
-    'dependencies': ['matlab']
+    'dependencies': ['matlab'],
+    'managed_assets': ['yzt_iccv_2013']
 }
 
 
@@ -1,4 +1,5 @@
-from pyrx import StrType, RecType, ArrType, AnyType
+from numbers import Number
+from pyrx import StrType, RecType, ArrType, AnyType, IntType
 
 
 class RxParseError(ValueError):
@@ -59,7 +60,7 @@ def _recursive_check(s, c):
             try:
                 _recursive_check(s_n, c_n)
             except RxParseError as e:
-                key_error_str = "{}: {} <- {}".format(key, c_n, e.message)
+                key_error_str = "{}: {} <- {}".format(key, c_n, str(e))
                 errors.append(key_error_str)
         if len(errors) > 0:
             raise RxParseError("\n".join(errors))
@@ -75,6 +76,14 @@ def _recursive_check(s, c):
         raise RxParseError("Something wrong with str {} but "
                            "don't know what".format(_f(c)))
 
+    elif isinstance(s, IntType):
+        if (not isinstance(c, Number) or isinstance(c, bool) or
+                c % 1 != 0):
+            raise RxParseError(_expected_found_str('int', c))
+        if s.range is not None and not s.range(c):
+            raise RxParseError('{} is out of range'.format(c))
+        raise RxParseError("{} != {}".format(c, s.value))
+
     elif isinstance(s, ArrType):
         if not isinstance(c, list):
             raise RxParseError(_expected_found_str('list', c))
@@ -91,7 +100,7 @@ def _recursive_check(s, c):
             except RxParseError as e:
                 # this any branch is not allowed
                 # save the error messages up
-                errors.add(e.message)
+                errors.add(str(e))
                 pass
             else:
                 # shouldn't ever hit this - we are only here because there is
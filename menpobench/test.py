@@ -48,13 +48,14 @@ def generate_test_suite():
     return ''.join(ts)
 
 
-# build a test suite, run it through nose, and clear up after ourselves.
+# build a test suite, run it through nose along with the unit tests in
+# menpobench.tests, and clear up after ourselves.
 def run_test_suite(verbose=False):
     ts = generate_test_suite()
     path = str(TempDirectory.create_new() / 'mb.py')
     with open(path, 'wt') as f:
         f.write(ts)
-    args = ['', path]
+    args = ['', path, 'menpobench.tests']
     if verbose:
         args.append('-v')
     tests_passed = nose.run(argv=args)
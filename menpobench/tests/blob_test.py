@@ -0,0 +1,33 @@
+import hashlib
+import os
+import time
+from multiprocessing import Process
+from menpobench.blob import (blob_path, blob_lock_path, collect_garbage,
+                             has_blob, write_ref)
+from menpobench.config import resolve_cache_dir
+from menpobench.utils import file_lock
+from menpobench.tests.standin import temp_config
+
+DATA = os.urandom(1024)
+SHA1 = hashlib.sha1(DATA).hexdigest()
+
+
+def test_garbage_collection_waits_for_blobs_being_stored():
+    with temp_config():
+        archive = resolve_cache_dir() / 'a.tar.gz'
+        # only the file lock - a forked child would inherit a held thread lock
+        with file_lock(blob_lock_path()):
+            # a blob is stored before the ref to it is written
+            blob = blob_path(SHA1)
+            os.makedirs(str(blob.parent))
+            with open(str(blob), 'wb') as f:
+                f.write(DATA)
+            gc = Process(target=collect_garbage, kwargs={'verbose': False})
+            gc.start()
+            time.sleep(0.2)
+            assert gc.is_alive()
+            os.link(str(blob), str(archive))
+            write_ref(archive, SHA1)
+        gc.join()
+        assert gc.exitcode == 0
+        assert has_blob(SHA1)
@@ -0,0 +1,179 @@
+import gzip
+import json
+import os
+import time
+from io import BytesIO
+import menpobench.cache as cache
+from menpobench.cache import (cache_version, hash_of_id, load_cdn_misses,
+                              prefetch_cdn_misses, update_cdn_misses,
+                              upload_results, flush_uploads, close_uploads,
+                              retrieve_results, defer_cdn_index_updates,
+                              publish_cdn_index, results_may_be_cached,
+                              save_local_results, retrieve_local_results,
+                              local_results_paths, evict_local_results)
+from menpobench.tests.standin import (StandInHTTPServer, temp_config,
+                                      localhost_subdomains)
+
+HELD = {'method': 'held'}
+MISSING = {'method': 'missing'}
+
+RESULTS = {
+    'image_0001': {'gt': [[0.0, 0.0], [1.0, 1.0]],
+                   'result': {'final': [[0.5, 0.0], [1.0, 1.5]],
+                              'initial': [[0.0, 0.5], [1.5, 1.0]],
+                              'fit_time': 0.25}},
+    'image_0002': {'gt': [[2.0, 2.0], [3.0, 3.0]],
+                   'result': {'final': [[2.5, 2.0], [3.0, 3.5]],
+                              'initial': [[2.0, 2.5], [3.5, 3.0]],
+                              'fit_time': 0.5}}
+}
+
+
+def experiment_key(id_):
+    return 'experiments/{}/{}.json.gz'.format(cache_version(), hash_of_id(id_))
+
+
+def index_key():
+    return 'experiments/{}/index.json'.format(cache_version())
+
+
+def stand_in_index(server):
+    return set(json.loads(server.files[index_key()].decode('utf-8')))
+
+
+def test_index_is_trusted_without_head_requests():
+    files = {experiment_key(HELD): b'{}',
+             index_key(): json.dumps([hash_of_id(HELD)]).encode('utf-8')}
+    with StandInHTTPServer(files) as server, localhost_subdomains():
+        with temp_config(**server.s3_config()):
+            prefetch_cdn_misses([HELD, MISSING])
+            misses = load_cdn_misses(cache_version())
+        assert [r[0] for r in server.requests] == ['GET']
+    assert hash_of_id(MISSING) in misses
+    assert hash_of_id(HELD) not in misses
+
+
+def test_experiments_are_checked_when_there_is_no_index():
+    files = {experiment_key(HELD): b'{}'}
+    with StandInHTTPServer(files) as server, localhost_subdomains():
+        with temp_config(**server.s3_config()):
+            prefetch_cdn_misses([HELD, MISSING])
+            misses = load_cdn_misses(cache_version())
+        assert sorted(r[0] for r in server.requests) == ['GET', 'HEAD',
+                                                          'HEAD']
+    assert hash_of_id(MISSING) in misses
+    assert hash_of_id(HELD) not in misses
+
+
+def test_unreadable_index_is_not_overwritten():
+    files = {index_key(): json.dumps([hash_of_id(MISSING)]).encode('utf-8')}
+    with StandInHTTPServer(files) as server, localhost_subdomains():
+        server.status[index_key()] = 403
+        with temp_config(**server.s3_config()):
+            try:
+                upload_results(RESULTS, HELD)
+                assert flush_uploads() == [hash_of_id(HELD)]
+            finally:
+                close_uploads()
+        assert stand_in_index(server) == set([hash_of_id(MISSING)])
+        assert ('PUT', index_key(), None) not in server.requests
+
+
+def test_update_cdn_misses():
+    with temp_config():
+        version = cache_version()
+        update_cdn_misses(version, add=['a', 'b'])
+        update_cdn_misses(version, remove=['a'])
+        assert sorted(load_cdn_misses(version)) == ['b']
+        assert not cache.cdn_misses_path(version).with_suffix(
+            '.json.tmp').exists()
+
+
+def test_cdn_is_read_from_configured_endpoint():
+    with temp_config(MENPO_CDN_S3_ENDPOINT='localhost:9000',
+                     MENPO_CDN_S3_BUCKET='bucket', MENPO_CDN_S3_TLS='False'):
+        assert (cache.cdn_index_url('v1') ==
+                'http://bucket.localhost:9000/experiments/v1/index.json')
+    with temp_config():
+        assert cache.cdn_index_url('v1').startswith(cache.MENPO_CDN_URL)
+
+
+def test_uploaded_results_can_be_retrieved():
+    with StandInHTTPServer() as server, localhost_subdomains():
+        with temp_config(**server.s3_config()):
+            # a miss that the upload should clear
+            update_cdn_misses(cache_version(), add=[hash_of_id(HELD)])
+            try:
+                upload_results(RESULTS, HELD)
+                assert flush_uploads() == [hash_of_id(HELD)]
+            finally:
+                close_uploads()
+            uploaded = BytesIO(server.files[experiment_key(HELD)])
+            with gzip.GzipFile(fileobj=uploaded, mode='rb') as f:
+                assert json.loads(f.read().decode('utf-8')) == RESULTS
+            assert stand_in_index(server) == set([hash_of_id(HELD)])
+            assert hash_of_id(HELD) not in load_cdn_misses(cache_version())
+            results = retrieve_results(HELD, local=False)
+            assert dict(results.items()) == RESULTS
+
+
+def test_deferred_index_updates_are_published_once():
+    with StandInHTTPServer() as server, localhost_subdomains():
+        with temp_config(**server.s3_config()):
+            defer_cdn_index_updates()
+            try:
+                upload_results(RESULTS, HELD)
+                uploaded = flush_uploads()
+            finally:
+                defer_cdn_index_updates(False)
+                close_uploads()
+            assert index_key() not in server.files
+            publish_cdn_index(uploaded)
+            assert stand_in_index(server) == set([hash_of_id(HELD)])
+
+
+def test_only_known_misses_are_not_cached():
+    with temp_config():
+        version = cache_version()
+        update_cdn_misses(version, add=[hash_of_id(MISSING)])
+        assert results_may_be_cached(HELD)
+        assert not results_may_be_cached(MISSING)
+        save_local_results(RESULTS, MISSING)
+        assert results_may_be_cached(MISSING)
+        assert not results_may_be_cached(MISSING, local=False)
+
+
+def test_local_results_round_trip_as_arrays():
+    with temp_config():
+        save_local_results(RESULTS, HELD)
+        array_path, json_path = local_results_paths(HELD)
+        assert array_path.is_file() and not json_path.is_file()
+        assert dict(retrieve_local_results(HELD).items()) == RESULTS
+
+
+def test_local_results_round_trip_as_json():
+    # a differing number of landmarks can't be stored as arrays
+    ragged = dict(RESULTS, image_0003={'gt': [[0.0, 0.0]],
+                                       'result': {'final': [[0.5, 0.5]]}})
+    with temp_config():
+        save_local_results(ragged, HELD)
+        array_path, json_path = local_results_paths(HELD)
+        assert json_path.is_file() and not array_path.is_file()
+        assert retrieve_local_results(HELD) == ragged
+
+
+def test_least_recently_used_local_results_are_evicted_first():
+    ids = [{'method': m} for m in ('a', 'b', 'c')]
+    with temp_config():
+        now = time.time()
+        for i, id_ in enumerate(ids):
+            save_local_results(RESULTS, id_)
+            # saved a minute apart, oldest first
+            t = now - 60 * (len(ids) - i)
+            os.utime(str(local_results_paths(id_)[0]), (t, t))
+        # reading the oldest makes it the most recently used
+        retrieve_local_results(ids[0])
+        size = local_results_paths(ids[0])[0].stat().st_size
+        evict_local_results(2 * size)
+        cached = [local_results_paths(id_)[0].is_file() for id_ in ids]
+    assert cached == [True, False, True]
@@ -0,0 +1,148 @@
+import threading
+import menpobench.dataset.base as dataset_base
+from menpobench.dataset.base import Dataset, DatasetChain
+from menpobench.utils import in_shard, seeded_key
+
+IDS = ['image_{:02d}'.format(i) for i in range(20)]
+
+
+class FakeImage(object):
+
+    def __init__(self, id_):
+        self.id = id_
+
+
+def fake_dataset(ids):
+    def generate_dataset():
+        for id_ in ids:
+            yield id_, FakeImage(id_)
+    # a custom (path) name - custom datasets are never cached
+    return Dataset(generate_dataset, 'standin.py', {})
+
+
+def fake_dataset_with_options(ids, decoded):
+    # stands in for a dataset module using import_images
+    def generate_dataset(keep=None, seed=None):
+        selected = [i for i in ids if keep is None or keep(i)]
+        if seed is not None:
+            selected.sort(key=lambda i: seeded_key(seed, i))
+        for id_ in selected:
+            decoded.append(id_)
+            yield id_, FakeImage(id_)
+    return Dataset(generate_dataset, 'standin_options.py', {})
+
+
+def ids_of(chain, **kwargs):
+    basic_img_process = dataset_base.basic_img_process
+    dataset_base.basic_img_process = lambda img: img
+    try:
+        return [img.id for img in chain(**kwargs)]
+    finally:
+        dataset_base.basic_img_process = basic_img_process
+
+
+def test_skipped_ids_are_never_processed():
+    processed = []
+
+    def process(img):
+        processed.append(img.id)
+        return img
+
+    basic_img_process = dataset_base.basic_img_process
+    dataset_base.basic_img_process = process
+    try:
+        chain = DatasetChain([fake_dataset(['a', 'b', 'c', 'd'])],
+                             prefetch=0)
+        images = list(chain(skip_ids=['b', 'd']))
+    finally:
+        dataset_base.basic_img_process = basic_img_process
+    assert [img.id for img in images] == ['a', 'c']
+    assert processed == ['a', 'c']
+
+
+def test_only_images_in_shard_are_decoded():
+    decoded = []
+    chain = DatasetChain([fake_dataset_with_options(IDS, decoded)],
+                         prefetch=0, shard=(2, 3))
+    ids = ids_of(chain, skip_ids=['image_00'])
+    expected = [i for i in IDS if in_shard(i, 2, 3) and i != 'image_00']
+    assert sorted(ids) == expected
+    assert sorted(decoded) == expected
+
+
+def test_seed_orders_a_single_dataset():
+    orders = [ids_of(DatasetChain([fake_dataset_with_options(IDS, [])],
+                                  prefetch=0, seed=seed))
+              for seed in (0, 0, 1)]
+    assert orders[0] == orders[1]
+    assert orders[0] != orders[2]
+    assert sorted(orders[2]) == IDS
+
+
+def test_testset_wrapper_only_holds_shapes_awaiting_results():
+    class Landmarks(object):
+        # the ground truth 'gt' group of a test image
+        def __init__(self, id_):
+            self.gt = FakeImage(id_)
+            self.gt.lms = id_
+
+        def pop(self, group):
+            return getattr(self, group)
+
+    def image(id_):
+        img = FakeImage(id_)
+        img.landmarks = Landmarks(id_)
+        return img
+
+    wrapper = dataset_base.TestsetWrapper((id_, image(id_))
+                                          for id_ in IDS[:3])
+    next(wrapper)
+    next(wrapper)
+    assert wrapper.pop_oldest() == (IDS[0], IDS[0])
+    next(wrapper)
+    assert list(wrapper.ids) == IDS[1:3]
+
+
+def test_prefetch_keeps_the_order_of_the_chain():
+    datasets = [fake_dataset(IDS[:7]), fake_dataset(IDS[7:])]
+    in_line = ids_of(DatasetChain(datasets, prefetch=0))
+    assert sorted(in_line) == IDS
+    for n in (1, 3, 50):
+        assert ids_of(DatasetChain(datasets, prefetch=n)) == in_line
+
+
+def test_prefetch_reraises_errors_in_the_consumer():
+    def failing():
+        yield 'a', FakeImage('a')
+        raise IOError('unreadable image')
+
+    consumer = dataset_base.prefetch(failing(), 2)
+    assert next(consumer)[0] == 'a'
+    try:
+        next(consumer)
+    except IOError as e:
+        assert str(e) == 'unreadable image'
+    else:
+        assert False, 'expected the IOError to reach the consumer'
+
+
+def test_closing_prefetch_early_stops_the_source():
+    closed = []
+
+    def endless():
+        try:
+            i = 0
+            while True:
+                yield i, FakeImage(i)
+                i += 1
+        finally:
+            closed.append(threading.current_thread())
+
+    n_threads = threading.active_count()
+    consumer = dataset_base.prefetch(endless(), 2)
+    assert [next(consumer)[0] for _ in range(3)] == [0, 1, 2]
+    consumer.close()
+    # the producer thread has been joined by the time close returns
+    assert threading.active_count() == n_threads
+    assert len(closed) == 1
+    assert closed[0] is not threading.current_thread()
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from menpobench.exception import IncompleteDownloadError
+from menpobench.utils import download_file, partial_download_path
+from menpobench.tests.standin import StandInHTTPServer
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+SHA1 = hashlib.sha1(DATA).hexdigest()
+
+
+def setup_dest():
+    return Path(tempfile.mkdtemp()) / 'asset.tar.gz'
+
+
+def teardown_dest(dest):
+    shutil.rmtree(str(dest.parent))
+
+
+def read(path):
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+def write_part(dest, data):
+    with open(str(partial_download_path(dest)), 'wb') as f:
+        f.write(data)
+
+
+def test_download():
+    dest = setup_dest()
+    try:
+        with StandInHTTPServer({'a': DATA}) as server:
+            assert download_file(server.url('a'), dest) == SHA1
+        assert read(dest) == DATA
+        assert not partial_download_path(dest).exists()
+    finally:
+        teardown_dest(dest)
+
+
+def test_download_resumes_from_partial_file():
+    dest = setup_dest()
+    try:
+        write_part(dest, DATA[:1024 * 1024])
+        with StandInHTTPServer({'a': DATA}) as server:
+            assert download_file(server.url('a'), dest) == SHA1
+            assert server.requests == [('GET', 'a', 'bytes=1048576-')]
+        assert read(dest) == DATA
+    finally:
+        teardown_dest(dest)
+
+
+def test_partial_file_larger_than_download_starts_again():
+    dest = setup_dest()
+    try:
+        write_part(dest, DATA + b'extra')
+        with StandInHTTPServer({'a': DATA}) as server:
+            assert download_file(server.url('a'), dest) == SHA1
+        assert read(dest) == DATA
+    finally:
+        teardown_dest(dest)
+
+
+def test_short_read_is_resumed():
+    dest = setup_dest()
+    try:
+        with StandInHTTPServer({'a': DATA}) as server:
+            server.cut_short['a'] = [700000]
+            assert download_file(server.url('a'), dest) == SHA1
+            assert server.requests == [('GET', 'a', None),
+                                       ('GET', 'a', 'bytes=700000-')]
+        assert read(dest) == DATA
+    finally:
+        teardown_dest(dest)
+
+
+def test_repeated_short_reads_keep_partial_file():
+    dest = setup_dest()
+    try:
+        with StandInHTTPServer({'a': DATA}) as server:
+            server.cut_short['a'] = [1000] * 3
+            try:
+                download_file(server.url('a'), dest, retries=2)
+            except IncompleteDownloadError:
+                pass
+            else:
+                assert False, 'expected the download to be incomplete'
+            assert not dest.exists()
+            assert read(partial_download_path(dest)) == DATA[:3000]
+            # the next attempt picks up where the last left off
+            assert download_file(server.url('a'), dest) == SHA1
+            assert server.requests[-1] == ('GET', 'a', 'bytes=3000-')
+        assert read(dest) == DATA
+    finally:
+        teardown_dest(dest)
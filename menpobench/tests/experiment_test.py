@@ -0,0 +1,16 @@
+from menpobench.exception import SchemaError
+from menpobench.experiment import validate_experiment_def
+
+CONFIG = {'testing_data': ['lfpw_test'], 'error_metric': ['me']}
+
+
+def test_fit_jobs_must_be_positive():
+    validate_experiment_def(dict(CONFIG, fit_jobs=1))
+    for fit_jobs in (0, -2, 1.5):
+        try:
+            validate_experiment_def(dict(CONFIG, fit_jobs=fit_jobs))
+        except SchemaError:
+            pass
+        else:
+            assert False, 'expected fit_jobs {} to be rejected'.format(
+                fit_jobs)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+r"""Stands in for a Matlab session started by MatlabSession.
+
+Reads the commands MatlabSession writes to stdin - one per line, each wrapped
+in a try/catch that reports back with a marker line - and runs a tiny subset
+of Matlab on them:
+
+    disp('text');     prints text
+    error('text');    fails with the message text
+    crash;            exits abruptly, as if Matlab had died
+    exit              ends the session
+
+    menpobench_matlab_fit('method', 'path', 'shard');
+                      'fits' each image of a shard written by MatlabWrapper,
+                      taking the corners of its bounding box as the result
+
+Anything else (e.g. addpath(...)) succeeds without doing anything.
+"""
+import os
+import re
+import sys
+
+WRAPPED = re.compile(r"^try, (?P<command>.*) fprintf\('\\n(?P<marker>\S+) ok"
+                     r"\\n'\); catch e, .* end$")
+STATEMENT = re.compile(r"^(?P<f>\w+)(\((?P<args>'[^']*'(, '[^']*')*)\))?$")
+
+
+def fit(method_path, images_path, shard):
+    import numpy as np
+    from scipy.io import loadmat, savemat
+    images = np.atleast_1d(loadmat(os.path.join(images_path, shard),
+                                   squeeze_me=True, struct_as_record=False)
+                           ['menpobench_images'])
+    # an n x 1 cell array of 2 x 2 point sets, as Matlab would save it
+    results = np.empty((len(images), 1), dtype=object)
+    for i, image in enumerate(images):
+        results[i, 0] = np.asarray(image.bbox, dtype=float).reshape(2, 2)
+    savemat(os.path.join(images_path, '{}_results.mat'.format(shard)),
+            {'results': results, 'fit_times': np.zeros((len(images), 1))})
+
+
+def run(command):
+    for statement in command.split(';'):
+        m = STATEMENT.match(statement.strip())
+        if m is None:
+            continue
+        f = m.group('f')
+        args = re.findall(r"'([^']*)'", m.group('args') or '')
+        if f == 'disp':
+            sys.stdout.write(args[0] + '\n')
+        elif f == 'error':
+            raise RuntimeError(args[0])
+        elif f == 'crash':
+            sys.exit(1)
+        elif f == 'menpobench_matlab_fit':
+            fit(*args)
+
+
+def main():
+    for line in iter(sys.stdin.readline, ''):
+        line = line.strip()
+        if line == 'exit':
+            break
+        m = WRAPPED.match(line)
+        if m is None:
+            continue
+        marker = m.group('marker')
+        try:
+            run(m.group('command'))
+            sys.stdout.write('\n{} ok\n'.format(marker))
+        except RuntimeError as e:
+            sys.stdout.write('\n{} error {}\n'.format(marker, e))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import hashlib
+import io
+import os
+import tarfile
+from menpobench.blob import has_blob, blob_path
+from menpobench.config import resolve_cache_dir
+from menpobench.managed import (WebSource, managed_asset,
+                               download_asset_if_needed, prefetch_assets,
+                               download_and_unpack_asset_if_needed)
+from menpobench.utils import partial_download_path
+from menpobench.tests.standin import StandInHTTPServer, temp_config
+
+IMAGES = dict(('image_{:04d}.png'.format(i), os.urandom(64 * 1024))
+              for i in range(1, 31))
+
+
+def tar_gz(name, files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for filename, data in sorted(files.items()):
+            info = tarfile.TarInfo('{}/{}'.format(name, filename))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+ARCHIVE = tar_gz('lfpw', IMAGES)
+
+
+def mkdir(path):
+    if not path.is_dir():
+        path.mkdir()
+    return path
+
+
+class StandInSource(WebSource):
+    # a dataset-like asset that is kept unpacked
+
+    def __init__(self, url, sha1=hashlib.sha1(ARCHIVE).hexdigest()):
+        super(StandInSource, self).__init__('lfpw', url, sha1)
+
+    def _download_cache_dir(self):
+        return mkdir(resolve_cache_dir() / 'dlcache')
+
+    def _persistent_unpacked_dir(self):
+        return mkdir(resolve_cache_dir() / 'unpacked')
+
+    def _unpack_dir(self):
+        return self._unpacked_cache_dir()
+
+
+def assert_unpacked(asset):
+    assert asset.unpacked_is_valid()
+    path = asset.unpacked_path()
+    assert sorted(os.listdir(str(path))) == sorted(IMAGES)
+    for filename, data in IMAGES.items():
+        with open(str(path / filename), 'rb') as f:
+            assert f.read() == data
+
+
+def test_tar_gz_is_unpacked_as_it_downloads():
+    with temp_config(), StandInHTTPServer({'a.tar.gz': ARCHIVE}) as server:
+        asset = StandInSource(server.url('a.tar.gz'))
+        assert asset.can_stream_unpack()
+        download_and_unpack_asset_if_needed(asset)
+        assert len(server.requests) == 1
+        assert_unpacked(asset)
+        assert has_blob(asset.sha1)
+
+
+def test_broken_stream_resumes_with_a_normal_download():
+    with temp_config(), StandInHTTPServer({'a.tar.gz': ARCHIVE}) as server:
+        server.cut_short['a.tar.gz'] = [len(ARCHIVE) // 2]
+        asset = StandInSource(server.url('a.tar.gz'))
+        download_and_unpack_asset_if_needed(asset)
+        # the second request carried on from what the first received
+        (_, _, first), (_, _, second) = server.requests
+        assert first is None
+        assert second is not None and second != 'bytes=0-'
+        assert_unpacked(asset)
+        assert not partial_download_path(asset.archive_path()).exists()
+
+
+def test_corrupt_stream_is_rolled_back():
+    corrupt = ARCHIVE[:len(ARCHIVE) // 2] + b'\0' * (len(ARCHIVE) // 2 + 1)
+    with temp_config(), StandInHTTPServer({'a.tar.gz': corrupt}) as server:
+        asset = StandInSource(server.url('a.tar.gz'))
+        try:
+            download_and_unpack_asset_if_needed(asset)
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected the corrupt download to be rejected'
+        assert not asset.unpacked_is_valid()
+        assert not asset.unpacked_path().exists()
+        assert not asset.archive_path().exists()
+
+
+def test_only_members_read_are_unpacked_from_tar_gz():
+    with temp_config(), StandInHTTPServer({'a.tar.gz': ARCHIVE}) as server:
+        assets = {'lfpw': lambda: StandInSource(server.url('a.tar.gz'))}
+        with managed_asset(assets, 'lfpw', pattern='*.png',
+                           max_members=3) as path:
+            assert sorted(os.listdir(str(path))) == sorted(IMAGES)[:3]
+        asset = assets['lfpw']()
+        assert not asset.unpacked_is_valid()
+        assert asset.member_index_path().is_file()
+        assert asset.archive_members() == ['lfpw/' + n
+                                           for n in sorted(IMAGES)]
+
+
+def test_corrupt_blob_is_downloaded_again():
+    with temp_config(), StandInHTTPServer({'a.tar.gz': ARCHIVE}) as server:
+        asset = StandInSource(server.url('a.tar.gz'))
+        download_asset_if_needed(asset)
+        asset.archive_path().unlink()
+        # flip the stored bytes without changing their size
+        with open(str(blob_path(asset.sha1)), 'r+b') as f:
+            f.write(b'\0' * 16)
+        download_asset_if_needed(asset)
+        assert len(server.requests) == 2
+        assert asset.archive_checksum() == asset.sha1
+
+
+def test_prefetch_streams_persistent_tar_gz_unpacked():
+    with temp_config(), StandInHTTPServer({'a.tar.gz': ARCHIVE}) as server:
+        assets = {'lfpw': lambda: StandInSource(server.url('a.tar.gz'))}
+        prefetch_assets([(assets, 'lfpw')])
+        assert len(server.requests) == 1
+        assert_unpacked(assets['lfpw']())
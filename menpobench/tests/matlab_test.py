@@ -0,0 +1,129 @@
+import shutil
+import sys
+from io import StringIO
+from pathlib import Path
+import numpy as np
+from menpobench.exception import MatlabError
+from menpobench.method.matlab.base import (MatlabSession, MatlabWrapper,
+                                           _SESSION, close_matlab_session)
+from menpobench.utils import TempDirectory
+
+FAKE_MATLAB = Path(__file__).parent / 'fake_matlab.py'
+
+
+def run_capturing_output(session, command):
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        session.run(command)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+def test_output_is_echoed_until_marker():
+    session = MatlabSession(FAKE_MATLAB)
+    try:
+        session.start()
+        output = run_capturing_output(session,
+                                      "disp('one'); disp('two');")
+        assert output.split() == ['one', 'two']
+        process = session.process
+        # the same process serves every command
+        run_capturing_output(session, "disp('three');")
+        assert session.process is process
+    finally:
+        session.close()
+    assert not session.is_running
+
+
+def test_error_is_raised_and_session_continues():
+    session = MatlabSession(FAKE_MATLAB)
+    try:
+        session.start()
+        try:
+            run_capturing_output(session, "error('no model.mat');")
+        except MatlabError as e:
+            assert 'no model.mat' in str(e)
+        else:
+            assert False, 'expected a MatlabError'
+        assert session.is_running
+        assert run_capturing_output(session, "disp('ok');").split() == ['ok']
+    finally:
+        session.close()
+
+
+def test_session_restarts_after_matlab_exits():
+    session = MatlabSession(FAKE_MATLAB)
+    try:
+        session.start()
+        try:
+            run_capturing_output(session, 'crash;')
+        except MatlabError:
+            pass
+        else:
+            assert False, 'expected a MatlabError'
+        assert not session.is_running
+        output = run_capturing_output(session, "disp('ok');")
+        assert output.startswith('Starting Matlab session')
+        assert output.split()[-1] == 'ok'
+    finally:
+        session.close()
+
+
+class FakeLandmarks(object):
+
+    def __init__(self, bounds):
+        self.lms = self
+        self._bounds = bounds
+
+    def bounds(self):
+        return self._bounds
+
+
+class FakeImage(object):
+    # just enough of a menpo image to be written out for Matlab
+
+    def __init__(self, bounds):
+        self.landmarks = {'bbox': FakeLandmarks(bounds)}
+
+    def rolled_channels(self):
+        return np.zeros((4, 4))
+
+
+class RecordingSession(MatlabSession):
+
+    def __init__(self, matlab_bin_path):
+        super(RecordingSession, self).__init__(matlab_bin_path)
+        self.commands = []
+
+    def run(self, command):
+        self.commands.append(command)
+        super(RecordingSession, self).run(command)
+
+
+def test_chunked_fitting_keeps_the_order_of_the_images():
+    ids = ['image_{}'.format(i) for i in range(7)]
+    # each image's bounding box (and so its stand-in fit) is unique to it
+    bounds = dict((id_, (np.array([i, i + 0.5]), np.array([i + 1.0, i + 2.0])))
+                  for i, id_ in enumerate(ids))
+    session = _SESSION['session'] = RecordingSession(FAKE_MATLAB)
+    n_dirs = len(TempDirectory._directories)
+    try:
+        wrapper = MatlabWrapper('method', chunk_size=3)
+        results = list(wrapper(FakeImage(bounds[id_]) for id_ in ids))
+        test_path = TempDirectory._directories[n_dirs]
+        left_over = list(test_path.glob('*/*'))
+    finally:
+        close_matlab_session()
+        for d in TempDirectory._directories[n_dirs:]:
+            shutil.rmtree(str(d), ignore_errors=True)
+        del TempDirectory._directories[n_dirs:]
+    fits = [c for c in session.commands if 'menpobench_matlab_fit' in c]
+    assert len(fits) == 3
+    assert len(results) == len(ids)
+    for id_, result in zip(ids, results):
+        assert np.array_equal(result.final_shape.points,
+                              np.vstack(bounds[id_]))
+    # each chunk is removed once its results have been read
+    assert left_over == []
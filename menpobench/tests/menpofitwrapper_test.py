@@ -0,0 +1,26 @@
+import menpobench.method.menpofitwrapper as mfw
+from menpobench.method.menpofitwrapper import MenpoFitWrapper
+
+
+def fake_fit_image(fitter, img):
+    return fitter * img
+
+
+def test_pool_fits_in_order_and_draws_a_bounded_window():
+    drawn = []
+
+    def images():
+        for i in range(20):
+            drawn.append(i)
+            yield i
+
+    fit_image = mfw.fit_image
+    # forked fitting processes see the stand-in too
+    mfw.fit_image = fake_fit_image
+    try:
+        results = MenpoFitWrapper(10)(images(), n_jobs=2)
+        assert next(results) == 0
+        assert len(drawn) <= mfw.IMAGES_IN_FLIGHT_PER_JOB * 2 + 1
+        assert list(results) == [10 * i for i in range(1, 20)]
+    finally:
+        mfw.fit_image = fit_image
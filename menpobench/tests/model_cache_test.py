@@ -0,0 +1,71 @@
+import os
+import time
+from multiprocessing import Process
+from menpobench.base import invoke_train
+from menpobench.exception import TrainedModelNotAvailable
+from menpobench.method.cache import retrieve_trained_model, model_dir
+from menpobench.tests.standin import temp_config
+
+
+class FakeTest(object):
+
+    def __init__(self, model):
+        self.test = model
+
+
+class FakeTrain(object):
+    # stands in for a trainable method - records every time it is trained
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+
+    def wrap_test(self, model):
+        return FakeTest(model)
+
+    def __call__(self, train_set):
+        with open(str(self.log_path), 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+        time.sleep(0.2)
+        return FakeTest({'weights': [1, 2, 3]})
+
+    def __str__(self):
+        return 'fake'
+
+
+def test_concurrent_processes_train_a_model_once():
+    model_id = {'method': 'fake', 'training': 'lfpw_train'}
+    with temp_config() as cache_dir:
+        log_path = cache_dir / 'log.txt'
+        train = FakeTrain(log_path)
+        workers = [Process(target=invoke_train,
+                           args=(train, lambda: []),
+                           kwargs={'model_id': model_id})
+                   for _ in range(3)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        with open(str(log_path), 'rt') as f:
+            assert len(f.read().splitlines()) == 1
+        assert retrieve_trained_model(model_id) == {'weights': [1, 2, 3]}
+
+
+class UnpicklableTrain(FakeTrain):
+
+    def __call__(self, train_set):
+        return FakeTest({'fit': lambda img: img})
+
+
+def test_unpicklable_model_is_used_without_caching():
+    model_id = {'method': 'unpicklable', 'training': 'lfpw_train'}
+    with temp_config() as cache_dir:
+        test = invoke_train(UnpicklableTrain(cache_dir / 'log.txt'),
+                            lambda: [], model_id=model_id)
+        assert test.test['fit'](1) == 1
+        try:
+            retrieve_trained_model(model_id)
+        except TrainedModelNotAvailable:
+            pass
+        else:
+            assert False, 'expected no model to be cached'
+        assert [p.suffix for p in model_dir().iterdir()] == ['.lock']
@@ -0,0 +1,122 @@
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import menpobench.output as output
+from menpobench.output import (ArrayResults, ResultsLog, summarise_speed,
+                               compute_and_save_errors, write_results_array,
+                               write_results_json)
+from menpobench.timing import stage, timed_iter, collect_timings
+from menpobench.utils import load_json, save_json
+
+
+def results(fit_times):
+    return dict(('image_{}'.format(i),
+                 {'gt': [[0.0, 0.0], [1.0, 1.0]],
+                  'result': {'final': [[0.0, 0.0], [1.0, 1.0]],
+                             'fit_time': t}})
+                for i, t in enumerate(fit_times))
+
+
+def section_dir(output_dir, section):
+    path = output_dir / 'results' / section
+    path.mkdir(parents=True)
+    return path
+
+
+def test_speed_is_keyed_on_section_and_uses_the_clock():
+    output_dir = Path(tempfile.mkdtemp())
+    plot = output.plot_accuracy_vs_speed
+    output.plot_accuracy_vs_speed = lambda speed, output_dir: None
+    try:
+        # the same method name in both sections - the binary results are
+        # preferred over the JSON
+        trainable = section_dir(output_dir, 'trainable_methods')
+        save_json(results([9.0] * 4), str(trainable / 'aam.json'))
+        ArrayResults.from_results(results([1.0] * 4)).save(
+            trainable / 'aam.npz')
+        untrainable = section_dir(output_dir, 'untrainable_methods')
+        save_json(results([2.0] * 2), str(untrainable / 'aam.json'))
+        # four images fitted side by side much faster than one at a time
+        collect_timings()
+        with stage('method', method='aam', section='trainable_methods'):
+            for _ in timed_iter((time.sleep(0.01) for _ in range(4)), 'fit'):
+                pass
+        summarise_speed(output_dir)
+        speed = load_json(output_dir / 'speed.json')
+    finally:
+        output.plot_accuracy_vs_speed = plot
+        collect_timings()
+        shutil.rmtree(str(output_dir))
+    assert sorted(speed) == ['trainable_methods/aam',
+                             'untrainable_methods/aam']
+    assert speed['trainable_methods/aam']['total'] == 4.0
+    assert speed['trainable_methods/aam']['serial_throughput'] == 1.0
+    assert speed['trainable_methods/aam']['throughput'] > 1.0
+    assert speed['untrainable_methods/aam']['throughput'] is None
+
+
+def test_array_results_keep_partial_initial_shapes():
+    partial = results([1.0, 2.0, 3.0])
+    partial['image_0']['result']['initial'] = [[0.5, 0.5], [1.5, 1.5]]
+    del partial['image_1']['result']['fit_time']
+    path = Path(tempfile.mkdtemp()) / 'results.npz'
+    try:
+        ArrayResults.from_results(partial).save(path)
+        loaded = ArrayResults.load(path)
+    finally:
+        shutil.rmtree(str(path.parent))
+    assert dict(loaded.items()) == partial
+    assert output.fit_times(loaded) is None
+
+
+class CountingResults(object):
+    # a results log that counts how many times it is read
+
+    def __init__(self, results):
+        self.results = results
+        self.n_reads = 0
+
+    def values(self):
+        self.n_reads += 1
+        return (r for _, r in sorted(self.results.items()))
+
+
+def test_errors_are_computed_in_one_chunked_pass():
+    chunk_size = output.ERRORS_CHUNK_SIZE
+    output.ERRORS_CHUNK_SIZE = 2
+    errors_dir = Path(tempfile.mkdtemp())
+    logged = CountingResults(results([1.0] * 5))
+    chunks = []
+    metric = lambda gt, final: chunks.append(len(gt)) or np.zeros(len(gt))
+    try:
+        compute_and_save_errors(logged, [('a', metric), ('b.py', metric)],
+                                'aam', errors_dir)
+        errors = load_json(errors_dir / 'aam.json')
+    finally:
+        output.ERRORS_CHUNK_SIZE = chunk_size
+        shutil.rmtree(str(errors_dir))
+    assert logged.n_reads == 1
+    assert chunks == [2, 2, 2, 2, 1, 1]
+    assert errors == {'a': [0.0] * 5, 'b_py': [0.0] * 5}
+
+
+def test_results_log_is_written_to_arrays_and_json_as_it_is_read():
+    partial = results([1.0, 2.0, 3.0])
+    partial['image_1']['result']['initial'] = [[0.5, 0.5], [1.5, 1.5]]
+    build_dir = Path(tempfile.mkdtemp())
+    try:
+        log = ResultsLog(build_dir / 'aam.jsonl')
+        log.extend(sorted(partial.items()))
+        write_results_array(log, build_dir / 'aam.npz')
+        loaded = ArrayResults.load(build_dir / 'aam.npz')
+        chunks = []
+        write_results_json(log, chunks.append, pretty=False)
+    finally:
+        shutil.rmtree(str(build_dir))
+    assert dict(loaded.items()) == partial
+    assert list(loaded.has_initial) == [False, True, False]
+    assert json.loads(''.join(chunks)) == partial
+    assert len(chunks) > len(partial)
@@ -0,0 +1,36 @@
+import shutil
+import tempfile
+from pathlib import Path
+from menpobench.base import check_resumable
+from menpobench.exception import OutputDirExistsError
+from menpobench.utils import save_yaml
+
+CONFIG = {'testing_data': ['lfpw_test'], 'error_metric': ['me']}
+
+
+class FakeExperiment(object):
+
+    def __init__(self, config):
+        self.config = config
+
+
+def assert_not_resumable(output_dir, ex):
+    try:
+        check_resumable(output_dir, ex)
+    except OutputDirExistsError:
+        pass
+    else:
+        assert False, 'expected {} not to be resumable'.format(output_dir)
+
+
+def test_only_output_of_same_experiment_is_resumable():
+    output_dir = Path(tempfile.mkdtemp())
+    try:
+        # not written by menpobench at all
+        assert_not_resumable(output_dir, FakeExperiment(CONFIG))
+        save_yaml(CONFIG, str(output_dir / 'experiment.yaml'))
+        check_resumable(output_dir, FakeExperiment(CONFIG))
+        other = dict(CONFIG, error_metric=['rmse'])
+        assert_not_resumable(output_dir, FakeExperiment(other))
+    finally:
+        shutil.rmtree(str(output_dir))
@@ -0,0 +1,162 @@
+import shutil
+import socket
+import sys
+import tempfile
+from contextlib import contextmanager
+from threading import Thread
+from pathlib import Path
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler  # Py3
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # Py2
+    from SocketServer import ThreadingMixIn
+
+# Stand-ins for the outside world (the user's config, the Menpo CDN, Matlab)
+# so the tests can run anywhere without touching a real cache dir.
+
+
+@contextmanager
+def temp_config(**config):
+    r"""Run the enclosed block against a fresh, empty cache dir and a config
+    holding only that and whatever keys are given. Yields the cache dir.
+    """
+    import menpobench.config
+    original = menpobench.config.load_config
+    cache_dir = Path(tempfile.mkdtemp())
+    config['cache_dir'] = str(cache_dir)
+    # modules that imported load_config by name need patching as well
+    modules = [m for n, m in list(sys.modules.items())
+               if n.startswith('menpobench') and m is not None and
+               getattr(m, 'load_config', None) is original]
+    for m in modules:
+        m.load_config = lambda: dict(config)
+    try:
+        yield cache_dir
+    finally:
+        for m in modules:
+            m.load_config = original
+        shutil.rmtree(str(cache_dir), ignore_errors=True)
+
+
+@contextmanager
+def localhost_subdomains():
+    r"""Resolve every '<name>.localhost' host to this machine, as the virtual
+    host style URLs of a bucket on a stand-in S3 server need.
+    """
+    getaddrinfo = socket.getaddrinfo
+
+    def resolve(host, *args, **kwargs):
+        if host.endswith('.localhost'):
+            host = '127.0.0.1'
+        return getaddrinfo(host, *args, **kwargs)
+
+    socket.getaddrinfo = resolve
+    try:
+        yield
+    finally:
+        socket.getaddrinfo = getaddrinfo
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+
+    def _path(self):
+        return self.path.split('?')[0].lstrip('/')
+
+    def _send_file(self, body=True):
+        path = self._path()
+        self.server.requests.append((self.command, path,
+                                     self.headers.get('range')))
+        if path in self.server.status:
+            self.send_error(self.server.status[path])
+            return
+        if path not in self.server.files:
+            self.send_error(404)
+            return
+        data = self.server.files[path]
+        start = 0
+        range_ = self.headers.get('range')
+        if range_ is not None:
+            # only the 'bytes=<first>-' form download_file sends
+            start = int(range_.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if body:
+            data = data[start:]
+            cuts = self.server.cut_short.get(path)
+            if cuts:
+                # promise the lot, send some, hang up
+                data = data[:cuts.pop(0)]
+            self.wfile.write(data)
+
+    def do_GET(self):
+        self._send_file()
+
+    def do_HEAD(self):
+        self._send_file(body=False)
+
+    def do_PUT(self):
+        path = self._path()
+        self.server.requests.append((self.command, path, None))
+        length = int(self.headers.get('content-length', 0))
+        self.server.files[path] = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInHTTPServer(ThreadingMixIn, HTTPServer):
+    r"""A local HTTP server holding files in memory. GET honours the Range
+    requests download_file makes, PUT stores a file (so it doubles as an S3
+    endpoint holding a single bucket), and cut_short maps a
+    path to the number of bytes to send of each of the next responses for
+    it before dropping the connection. status maps a path to an error code
+    every GET or HEAD of it fails with. Every request is recorded as
+    (method, path, range header) in requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, files=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInRequestHandler)
+        self.files = dict(files or {})
+        self.cut_short = {}
+        self.status = {}
+        self.requests = []
+
+    @property
+    def address(self):
+        return '127.0.0.1:{}'.format(self.server_port)
+
+    def s3_config(self, bucket='cdn'):
+        # config keys pointing menpobench's uploads and CDN reads here - use
+        # within localhost_subdomains()
+        return {'MENPO_CDN_S3_ACCESS_KEY': 'access',
+                'MENPO_CDN_S3_SECRET_KEY': 'secret',
+                'MENPO_CDN_S3_ENDPOINT': 'localhost:{}'.format(
+                    self.server_port),
+                'MENPO_CDN_S3_BUCKET': bucket,
+                'MENPO_CDN_S3_TLS': False}
+
+    def url(self, path):
+        return 'http://{}/{}'.format(self.address, path)
+
+    def __enter__(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
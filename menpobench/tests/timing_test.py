@@ -0,0 +1,57 @@
+import time
+from menpobench.timing import (stage, timed_iter, timed_map, within,
+                               current_stage, collect_timings)
+
+
+def stage_paths(records):
+    return [r['stage'] for r in records['stages']]
+
+
+def slow(x, delay=0.05):
+    time.sleep(delay)
+    return x
+
+
+def test_stages_nest():
+    collect_timings()
+    with stage('benchmark'):
+        with stage('method', method='aam'):
+            assert current_stage() == 'benchmark/method'
+            with stage('train'):
+                pass
+    assert current_stage() == ''
+    assert stage_paths(collect_timings()) == ['benchmark/method/train',
+                                              'benchmark/method',
+                                              'benchmark']
+
+
+def test_within_nests_without_recording():
+    collect_timings()
+    with stage('other'):
+        with within('benchmark'):
+            with stage('method'):
+                pass
+        assert current_stage() == 'other'
+    assert stage_paths(collect_timings()) == ['benchmark/method', 'other']
+
+
+def test_timed_iter_total_is_recorded_when_closed_early():
+    collect_timings()
+    it = timed_iter(iter(range(10)), 'load')
+    assert next(it) == 0
+    assert next(it) == 1
+    it.close()
+    records = collect_timings()
+    assert stage_paths(records) == ['load']
+    assert records['stages'][0]['n_items'] == 2
+    assert [r['id'] for r in records['items']] == [0, 1]
+    assert all('peak_rss_mb' in r for r in records['items'])
+
+
+def test_timed_map_only_times_f():
+    collect_timings()
+    upstream = (slow(i) for i in range(3))
+    assert list(timed_map(lambda x: x + 1, upstream, 'process')) == [1, 2, 3]
+    records = collect_timings()
+    assert records['stages'][0]['wall'] < 0.05
+    assert len(records['items']) == 3
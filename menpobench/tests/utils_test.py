@@ -0,0 +1,56 @@
+import io
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+from menpobench.utils import (_member_stems, select_members, extract_tar,
+                              tar_members)
+
+
+def test_member_stems():
+    assert _member_stems('a/img_01_dlib.ljson') == ['a/img_01_dlib',
+                                                    'a/img_01', 'a/img']
+    assert _member_stems('a_b/img.png') == ['a_b/img']
+    assert _member_stems('img') == ['img']
+
+
+def test_select_members_takes_companions():
+    names = ['lfpw/', 'lfpw/image_2.png', 'lfpw/image_2.pts',
+             'lfpw/image_1.png', 'lfpw/image_1.pts', 'lfpw/image_1_dlib.pts',
+             'lfpw/image_3.png', 'lfpw/image_3.pts', 'lfpw/sub/image_1.png']
+    assert select_members(names, 'lfpw/*.png', max_members=2) == [
+        'lfpw/image_2.png', 'lfpw/image_2.pts', 'lfpw/image_1.png',
+        'lfpw/image_1.pts', 'lfpw/image_1_dlib.pts']
+    assert select_members(names, 'lfpw/*.png') == [
+        n for n in names[1:] if not n.startswith('lfpw/sub/')]
+
+
+def test_select_members_orders_as_menpo_io():
+    # pathlib (and so menpo.io) sorts 'a/' before 'a-b/' - a plain string
+    # sort would not ('-' < '/')
+    names = ['a-b/x.png', 'a/y.png']
+    assert select_members(names, '*/*.png', max_members=1) == ['a/y.png']
+
+
+def test_select_members_of_dot_prefixed_tar():
+    names = ['./lfpw', './lfpw/b.png', './lfpw/a.png', './lfpw/a.pts']
+    assert select_members(names, 'lfpw/*.png', max_members=1) == [
+        './lfpw/a.png', './lfpw/a.pts']
+
+
+def test_extract_tar_members():
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        tar_path = tmp / 'a.tar.gz'
+        with tarfile.open(str(tar_path), mode='w:gz') as tar:
+            for name in ['a/1.png', 'a/1.pts', 'a/2.png', 'a/2.pts']:
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                tar.addfile(info, io.BytesIO(b'data'))
+        assert tar_members(tar_path) == ['a/1.png', 'a/1.pts', 'a/2.png',
+                                         'a/2.pts']
+        extract_tar(tar_path, tmp / 'out', members=['a/1.png', 'a/1.pts'])
+        assert sorted(p.name for p in (tmp / 'out' / 'a').iterdir()) == [
+            '1.png', '1.pts']
+    finally:
+        shutil.rmtree(str(tmp))
@@ -0,0 +1,80 @@
+import os
+import shutil
+from multiprocessing import Process
+import menpobench.base as base
+from menpobench.timing import stage, collect_timings
+from menpobench.utils import TempDirectory
+from menpobench.tests.standin import temp_config
+
+
+class FakeMethod(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeExperiment(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.trainable_methods = [FakeMethod(n) for n in config['methods']]
+        self.untrainable_methods = []
+
+
+def fake_run_method(log_path):
+    # stands in for running a method - records the temp dir it used
+    def run_method(ex, method, **kwargs):
+        with open(str(log_path), 'wt') as f:
+            f.write(str(TempDirectory.create_new()))
+    return run_method
+
+
+def test_worker_only_deletes_its_own_temp_dirs():
+    parent_dir = TempDirectory.create_new()
+    experiment, run_method = base.Experiment, base.run_method
+    try:
+        with temp_config() as cache_dir:
+            log_path = cache_dir / 'log.txt'
+            base.Experiment = FakeExperiment
+            base.run_method = fake_run_method(log_path)
+            worker = Process(target=base._run_method_in_worker,
+                             args=({'methods': ['a', 'b']}, True, 1, None,
+                                   None, 'benchmark', {}))
+            worker.start()
+            worker.join()
+            assert worker.exitcode == 0
+            with open(str(log_path), 'rt') as f:
+                worker_dir = f.read()
+        assert parent_dir.is_dir()
+        assert not os.path.exists(worker_dir)
+    finally:
+        base.Experiment, base.run_method = experiment, run_method
+        # other tests' temp dirs are theirs to delete
+        shutil.rmtree(str(parent_dir), ignore_errors=True)
+
+
+def timed_run_method(ex, method, **kwargs):
+    with stage('method', method=method.name):
+        pass
+
+
+def test_pool_records_each_stage_once():
+    experiment, run_method = base.Experiment, base.run_method
+    try:
+        with temp_config():
+            base.Experiment = FakeExperiment
+            base.run_method = timed_run_method
+            collect_timings()
+            # timed in the parent before the workers are forked
+            with stage('prefetch'):
+                pass
+            ex = FakeExperiment({'methods': ['a', 'b', 'c']})
+            base.run_methods_in_pool(ex, [(True, i, None, None)
+                                          for i in range(3)], 2)
+            stages = [r['stage'] for r in collect_timings()['stages']]
+    finally:
+        base.Experiment, base.run_method = experiment, run_method
+    assert sorted(stages) == ['method', 'method', 'method', 'prefetch']
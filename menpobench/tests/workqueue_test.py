@@ -0,0 +1,158 @@
+import os
+import socket
+import time
+from multiprocessing import Process
+import menpobench.workqueue as wq
+from menpobench.tests.standin import temp_config
+from menpobench.utils import load_yaml
+
+
+class FakeMethod(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeExperiment(object):
+
+    def __init__(self, n_trainable, n_untrainable):
+        self.config = {'testing_data': ['lfpw_test'], 'error_metric': ['me']}
+        self.fit_jobs = 1
+        self.trainable_methods = [FakeMethod('t{}'.format(i))
+                                  for i in range(n_trainable)]
+        self.untrainable_methods = [FakeMethod('u{}'.format(i))
+                                    for i in range(n_untrainable)]
+
+
+def fake_run_item(log_path):
+    # stands in for fitting a method - records who ran what
+    def run_item(job_path, claimed_path):
+        with open(str(log_path), 'a') as f:
+            f.write('{} {}\n'.format(wq.item_name(claimed_path), os.getpid()))
+        time.sleep(0.05)
+    return run_item
+
+
+def claim_in(job_path, name, pid, age=0):
+    path = job_path / wq.CLAIMED / '{}@{}-{}.json'.format(
+        name, socket.gethostname(), pid)
+    with open(str(path), 'wt') as f:
+        f.write('{}')
+    t = time.time() - age
+    os.utime(str(path), (t, t))
+    return path
+
+
+def dead_pid():
+    p = Process(target=time.sleep, args=(0,))
+    p.start()
+    p.join()
+    return p.pid
+
+
+def test_workers_run_every_item_exactly_once():
+    with temp_config() as cache_dir:
+        job_path = wq.create_job(FakeExperiment(3, 2), 4)
+        log_path = cache_dir / 'log.txt'
+        run_item = wq.run_item
+        wq.run_item = fake_run_item(log_path)
+        try:
+            workers = [Process(target=wq.work_on_job, args=(job_path,))
+                       for _ in range(3)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        finally:
+            wq.run_item = run_item
+        with open(str(log_path), 'rt') as f:
+            ran = [l.split()[0] for l in f.read().splitlines()]
+        assert len(ran) == 20
+        assert len(set(ran)) == 20
+        assert len(wq.list_items(job_path, wq.DONE)) == 20
+        assert len(wq.list_items(job_path, wq.PENDING)) == 0
+        assert len(wq.list_items(job_path, wq.CLAIMED)) == 0
+
+
+def test_claim_of_dead_worker_is_requeued():
+    with temp_config():
+        job_path = wq.create_job(FakeExperiment(1, 0), 1)
+        os.rename(str(wq.list_items(job_path, wq.PENDING)[0]),
+                  str(job_path / 'item.tmp'))
+        claim_in(job_path, 'trainable_methods-000-001', dead_pid())
+        assert wq.requeue_stale_claims(job_path) == 1
+        assert len(wq.list_items(job_path, wq.CLAIMED)) == 0
+        assert ([p.name for p in wq.list_items(job_path, wq.PENDING)] ==
+                ['trainable_methods-000-001.json'])
+
+
+def test_expired_lease_is_requeued():
+    with temp_config():
+        job_path = wq.create_job(FakeExperiment(0, 1), 1)
+        for p in wq.list_items(job_path, wq.PENDING):
+            p.unlink()
+        # both held by a live process - only the expired one is stale
+        claim_in(job_path, 'a', os.getpid(), age=1000)
+        claim_in(job_path, 'b', os.getpid(), age=10)
+        assert wq.requeue_stale_claims(job_path, lease_timeout=300) == 1
+        assert ([p.name for p in wq.list_items(job_path, wq.PENDING)] ==
+                ['a.json'])
+
+
+def test_redispatch_requeues_abandoned_claims():
+    with temp_config():
+        ex = FakeExperiment(1, 0)
+        job_path = wq.create_job(ex, 1)
+        item = wq.list_items(job_path, wq.PENDING)[0]
+        item.unlink()
+        claim_in(job_path, item.stem, dead_pid())
+        wq.create_job(ex, 1)
+        assert ([p.name for p in wq.list_items(job_path, wq.PENDING)] ==
+                [item.name])
+
+
+def test_lease_keeps_claim_fresh():
+    with temp_config():
+        job_path = wq.create_job(FakeExperiment(0, 0), 1)
+        claimed_path = claim_in(job_path, 'a', os.getpid(), age=1000)
+        with wq.lease(claimed_path, interval=0.05):
+            time.sleep(0.3)
+        assert not wq.claim_is_stale(claimed_path, lease_timeout=60)
+
+
+def test_wait_for_job_gives_up():
+    with temp_config():
+        job_path = wq.create_job(FakeExperiment(1, 0), 1)
+        try:
+            wq.wait_for_job(job_path, poll_interval=0.05, timeout=0.2)
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'expected wait_for_job to give up'
+
+
+def test_single_shard_job_is_left_unsharded():
+    with temp_config():
+        ex = FakeExperiment(1, 0)
+        whole = wq.create_job(ex, 1)
+        split = wq.create_job(ex, 2)
+        assert 'shard' not in load_yaml(
+            wq.shard_output_dir(whole, 1) / 'experiment.yaml')
+        assert load_yaml(wq.shard_output_dir(split, 2) /
+                         'experiment.yaml')['shard'] == [2, 2]
+
+
+def test_run_item_uses_the_jobs_cache_models_setting():
+    ran = []
+    experiment, run_method = wq.Experiment, wq.run_method
+    wq.Experiment = lambda config: FakeExperiment(1, 0)
+    wq.run_method = lambda *args, **kwargs: ran.append(kwargs)
+    try:
+        for cache_models in [False, True]:
+            with temp_config():
+                job_path = wq.create_job(FakeExperiment(1, 0), 1,
+                                         cache_models=cache_models)
+                wq.run_item(job_path, wq.claim_item(job_path))
+    finally:
+        wq.Experiment, wq.run_method = experiment, run_method
+    assert [kwargs['cache_models'] for kwargs in ran] == [False, True]
@@ -0,0 +1,190 @@
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from menpobench.utils import save_json
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+# Every stage of a benchmark run (downloading, loading a dataset, training,
+# fitting, computing errors...) is timed as it runs. Stages nest - each record
+# is keyed on the path of stages it ran inside, e.g. 'benchmark/method/train',
+# and carries the labels of those stages along with its own.
+# Iterators (datasets, fit results) are also timed per item. Everything that
+# was recorded is written out to timings.json at the end of a run.
+
+_RECORDS = {'stages': [], 'items': []}
+
+# the stack of stages being run is per-thread, as datasets may be loaded on
+# background threads
+_LOCAL = threading.local()
+
+# CPU time of the whole process (all threads)
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def peak_rss_mb():
+    r"""Peak resident set size of this process (and any children it has
+    waited on) in megabytes, or None where this isn't available.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on OS X and kilobytes elsewhere
+    scale = 1024.0 ** 2 if sys.platform == 'darwin' else 1024.0
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / scale
+
+
+def _stack():
+    # (name, labels) of every stage being run, outermost first
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+def _names():
+    return [name for name, _ in _stack()]
+
+
+def _labels(labels):
+    # labels of the stages being run, overridden by those given
+    merged = {}
+    for _, outer in _stack():
+        merged.update(outer)
+    merged.update(labels)
+    return merged
+
+
+def stage_path(name):
+    return '/'.join(_names() + [name])
+
+
+def current_stage():
+    r"""The path of the stage being run, or '' outside of any."""
+    return '/'.join(_names())
+
+
+@contextmanager
+def within(path):
+    r"""Run the enclosed block as if inside the given stage path, without
+    recording it as a stage - e.g. so the stages a worker process runs sit
+    inside the stage of the parent that started it.
+    """
+    # replaced rather than extended - a forked worker inherits the stack
+    stack = _stack()
+    outer = list(stack)
+    stack[:] = [(n, {}) for n in path.split('/') if n != '']
+    try:
+        yield
+    finally:
+        stack[:] = outer
+
+
+@contextmanager
+def stage(name, **labels):
+    r"""Record the wall time, CPU time and peak RSS of the enclosed block."""
+    path, labels = stage_path(name), _labels(labels)
+    _stack().append((name, labels))
+    wall, cpu = time.time(), cpu_time()
+    try:
+        yield
+    finally:
+        _stack().pop()
+        _RECORDS['stages'].append({'stage': path, 'labels': labels,
+                                   'wall': time.time() - wall,
+                                   'cpu': cpu_time() - cpu,
+                                   'peak_rss_mb': peak_rss_mb()})
+
+
+def timed(name):
+    r"""Decorator recording every call of a function as a stage."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(iterable, name, id_f=None, **labels):
+    r"""Pass through an iterable, recording the time taken to produce each
+    item (the consumer's time is not counted) and the total as a stage.
+    id_f maps an item to the id it is recorded under - by default the index
+    of the item is used.
+    """
+    # the path is fixed here - the iterable may be drained on another thread
+    return _timed_items(iter(iterable), None, stage_path(name), id_f,
+                        _labels(labels))
+
+
+def timed_map(f, iterable, name, id_f=None, **labels):
+    r"""Apply f to each item of an iterable, recording the time f takes on
+    each (and nothing upstream of it) and the total as a stage. id_f is as
+    for timed_iter.
+    """
+    return _timed_items(iter(iterable), f, stage_path(name), id_f,
+                        _labels(labels))
+
+
+def _timed_items(it, f, path, id_f, labels):
+    # times producing each item if f is None, else applying f to each - the
+    # total is recorded however the iteration ends
+    total_wall, total_cpu, i = 0.0, 0.0, 0
+    try:
+        while True:
+            if f is None:
+                wall, cpu = time.time(), cpu_time()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            if f is not None:
+                wall, cpu = time.time(), cpu_time()
+                item = f(item)
+            wall, cpu = time.time() - wall, cpu_time() - cpu
+            total_wall += wall
+            total_cpu += cpu
+            _RECORDS['items'].append({'stage': path, 'labels': labels,
+                                      'id': id_f(item) if id_f else i,
+                                      'wall': wall, 'cpu': cpu,
+                                      'peak_rss_mb': peak_rss_mb()})
+            i += 1
+            yield item
+    finally:
+        _RECORDS['stages'].append({'stage': path, 'labels': labels,
+                                   'wall': total_wall, 'cpu': total_cpu,
+                                   'peak_rss_mb': peak_rss_mb(),
+                                   'n_items': i})
+
+
+def recorded_stages(name, **labels):
+    r"""The records of every stage with the given name (at any depth) that
+    carries the given labels.
+    """
+    return [r for r in _RECORDS['stages']
+            if r['stage'].split('/')[-1] == name and
+            all(r['labels'].get(k) == v for k, v in labels.items())]
+
+
+def collect_timings():
+    r"""Take everything recorded so far, clearing the records."""
+    records = {'stages': list(_RECORDS['stages']),
+               'items': list(_RECORDS['items'])}
+    del _RECORDS['stages'][:]
+    del _RECORDS['items'][:]
+    return records
+
+
+def merge_timings(records):
+    # e.g. from a worker process
+    _RECORDS['stages'].extend(records['stages'])
+    _RECORDS['items'].extend(records['items'])
+
+
+def save_timings(path):
+    save_json(collect_timings(), str(path), pretty=True)
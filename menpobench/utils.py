@@ -1,15 +1,22 @@
+import fnmatch
 import hashlib
 import platform
+import posixpath
+from contextlib import contextmanager
 import subprocess
 import tarfile
 import tempfile
 import shutil
 from copy import deepcopy
+from functools import partial
 from inspect import isgeneratorfunction
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 try:
-    from urllib2 import urlopen, HTTPError  # Py2
+    from urllib2 import urlopen, Request, HTTPError, URLError  # Py2
 except ImportError:
-    from urllib.request import urlopen, HTTPError # Py3
+    from urllib.request import urlopen, Request  # Py3
+    from urllib.error import HTTPError, URLError
 import imp
 import os
 import zipfile
@@ -21,78 +28,319 @@ import random
 from math import ceil, floor
 from menpobench.schema import schema_error_report, schema_is_valid
 from menpobench.exception import (ModuleNotFoundError, SchemaError,
-                                  MissingMetadataError)
+                                  MissingMetadataError,
+                                  IncompleteDownloadError)
 import pyrx
 rx = pyrx.Factory({"register_core_types": True})
 
 
-def checksum(filepath, blocksize=65536):
+def update_checksum(sha, filepath, blocksize=65536):
     r"""
-    Report the SHA-1 checksum as a hex digest for a file at a path.
+    Feed the contents of the file at a path into a hashlib object.
     """
-    sha = hashlib.sha1()
     with open(str(filepath), 'rb') as f:
         buf = f.read(blocksize)
         while len(buf) > 0:
             sha.update(buf)
             buf = f.read(blocksize)
-    return sha.hexdigest()
+    return sha
+
 
+def checksum(filepath, blocksize=65536):
+    r"""
+    Report the SHA-1 checksum as a hex digest for a file at a path.
+    """
+    return update_checksum(hashlib.sha1(), filepath,
+                           blocksize=blocksize).hexdigest()
 
-def copy_and_yield(fsrc, fdst, length=1024*1024):
-    """copy data from file-like object fsrc to file-like object fdst"""
+
+def copy_and_yield(fsrc, fdst, length=1024*1024, sha=None):
+    """copy data from file-like object fsrc to file-like object fdst,
+    optionally updating a hashlib object with every chunk copied"""
     while 1:
         buf = fsrc.read(length)
         if not buf:
             break
         fdst.write(buf)
+        if sha is not None:
+            sha.update(buf)
         yield
 
 
-def download_file(url, dest_path):
+def partial_download_path(dest_path):
+    return Path(str(dest_path) + '.part')
+
+
+# Number of times download_file resumes a download that stops short before
+# giving up
+DEFAULT_DOWNLOAD_RETRIES = 3
+
+
+def content_range(req):
+    r"""(first byte, total size) from the Content-Range header of a partial
+    response. The total is None if the server doesn't know it.
+    """
+    # e.g. 'bytes 1024-4095/4096'
+    first_last, total = req.headers['content-range'].split()[1].split('/')
+    return (int(first_last.split('-')[0]),
+            int(total) if total != '*' else None)
+
+
+def download_file(url, dest_path, retries=DEFAULT_DOWNLOAD_RETRIES):
     r"""
-    Download a file to a path, reporting the progress with a progress bar
+    Download a file to a path, reporting the progress with a progress bar.
+
+    Bytes are streamed into a '.part' file alongside dest_path, which is only
+    moved into place once the download completes. If a '.part' file is
+    already present from an interrupted download it is resumed with an HTTP
+    Range request. A download that ends before the size the server promised
+    is resumed up to retries times, after which IncompleteDownloadError is
+    raised - the '.part' file is always kept for the next attempt.
+
+    Returns the SHA-1 checksum of the downloaded file as a hex digest, computed
+    as the bytes arrive.
     """
     from menpo.visualize.textutils import print_progress, bytes_str
-    req = urlopen(url)
-    n_bytes = int(req.headers['content-length'])
+    part_path = partial_download_path(dest_path)
+    sha = hashlib.sha1()
+    offset = part_path.stat().st_size if part_path.is_file() else 0
+    request = Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+    try:
+        req = urlopen(request)
+    except HTTPError as e:
+        if offset > 0 and e.code == 416:
+            # the partial file is no use to the server - start from scratch
+            part_path.unlink()
+            return download_file(url, dest_path, retries=retries)
+        raise
+    content_length = req.headers.get('content-length')
+    if offset > 0 and req.getcode() == 206:
+        start, expected_size = content_range(req)
+        if start != offset:
+            # not the bytes we asked for - start from scratch
+            req.close()
+            part_path.unlink()
+            return download_file(url, dest_path, retries=retries)
+        print('Resuming download from {}'.format(bytes_str(offset)))
+        # bring the running checksum up to date with what we already have
+        update_checksum(sha, part_path)
+        mode = 'ab'
+        if expected_size is None and content_length is not None:
+            expected_size = offset + int(content_length)
+    else:
+        # either a fresh download or a server that ignored our Range header
+        mode = 'wb'
+        expected_size = (int(content_length) if content_length is not None
+                         else None)
     chunk_size_bytes = 512 * 1024
-    n_items = int(ceil((1.0 * n_bytes) / chunk_size_bytes))
-    prefix = 'Downloading {}'.format(bytes_str(n_bytes))
-    with open(str(dest_path), 'wb') as fp:
-        for _ in print_progress(copy_and_yield(req, fp,
-                                               length=chunk_size_bytes),
-                                n_items=n_items, show_count=False,
-                                prefix=prefix):
+    with open(str(part_path), mode) as fp:
+        copier = copy_and_yield(req, fp, length=chunk_size_bytes, sha=sha)
+        if content_length is not None:
+            n_bytes = int(content_length)
+            n_items = int(ceil((1.0 * n_bytes) / chunk_size_bytes))
+            prefix = 'Downloading {}'.format(bytes_str(n_bytes))
+            copier = print_progress(copier, n_items=n_items, show_count=False,
+                                    prefix=prefix)
+        for _ in copier:
             pass
     req.close()
+    size = part_path.stat().st_size
+    if expected_size is not None and size < expected_size:
+        # the connection closed early without raising (read() just returns
+        # short) - keep what arrived and carry on from there
+        if retries > 0:
+            print('Download stopped at {} of {} - resuming'.format(
+                bytes_str(size), bytes_str(expected_size)))
+            return download_file(url, dest_path, retries=retries - 1)
+        raise IncompleteDownloadError(
+            'Download of {} stopped at {} of {} bytes - run again to '
+            'resume'.format(url, size, expected_size))
+    if Path(dest_path).is_file():
+        Path(dest_path).unlink()
+    os.rename(str(part_path), str(dest_path))
+    return sha.hexdigest()
 
 
-def extract_tar(tar_path, dest_dir):
+class TeeReader(object):
+    r"""A file-like object reading from src that copies every byte read into
+    the file-like dst and a hashlib object.
+    """
+
+    def __init__(self, src, dst, sha):
+        self.src = src
+        self.dst = dst
+        self.sha = sha
+
+    def read(self, size=-1):
+        buf = self.src.read(size) if size >= 0 else self.src.read()
+        self.dst.write(buf)
+        self.sha.update(buf)
+        return buf
+
+
+def download_and_extract_tar(url, dest_path, dest_dir):
     r"""
-    Extract a tar file to a destination
+    Download a .tar.gz file to a path, extracting it into dest_dir as the
+    bytes arrive rather than reading the archive back in once downloaded.
+
+    As with download_file, the archive is written to a '.part' file that is
+    only moved into place once complete, and the SHA-1 checksum of the
+    archive is returned as a hex digest. It is up to the caller to discard
+    dest_dir if the checksum turns out to be wrong, or if anything goes wrong
+    part way through - in which case the '.part' file is kept so that
+    download_file can resume from it.
     """
-    with tarfile.open(str(tar_path)) as tar:
-        tar.extractall(path=str(dest_dir))
+    from menpo.visualize.textutils import bytes_str
+    part_path = partial_download_path(dest_path)
+    sha = hashlib.sha1()
+    req = urlopen(url)
+    content_length = req.headers.get('content-length')
+    if content_length is not None:
+        print('Downloading and unpacking {}'.format(
+            bytes_str(int(content_length))))
+    try:
+        with open(str(part_path), 'wb') as fp:
+            tee = TeeReader(req, fp, sha)
+            # 'r|gz' reads the archive strictly as a stream - no seeking
+            with tarfile.open(fileobj=tee, mode='r|gz') as tar:
+                tar.extractall(path=str(dest_dir))
+            # whatever follows the last member (padding) is still part of
+            # the archive, and so of its checksum
+            while len(tee.read(512 * 1024)) > 0:
+                pass
+    finally:
+        req.close()
+    size = part_path.stat().st_size
+    if content_length is not None and size < int(content_length):
+        raise IncompleteDownloadError(
+            'Download of {} stopped at {} of {} bytes'.format(
+                url, size, content_length))
+    if Path(dest_path).is_file():
+        Path(dest_path).unlink()
+    os.rename(str(part_path), str(dest_path))
+    return sha.hexdigest()
+
+
+def extract_tar(tar_path, dest_dir, members=None):
+    r"""
+    Extract a tar file (or just the named members of it) to a destination.
+    Members are read in the order they are stored, so reading stops as soon
+    as the last of the named members has been extracted.
+    """
+    if members is None:
+        with tarfile.open(str(tar_path)) as tar:
+            tar.extractall(path=str(dest_dir))
+        return
+    remaining = set(members)
+    if len(remaining) == 0:
+        return
+    with tarfile.open(str(tar_path), mode='r|*') as tar:
+        for member in tar:
+            if member.name in remaining:
+                tar.extract(member, path=str(dest_dir))
+                remaining.discard(member.name)
+                if len(remaining) == 0:
+                    break
+
+
+def tar_members(tar_path):
+    r"""
+    The names of the members of a tar file, in the order they are stored.
+    A compressed tar has no index, so this is a pass over the whole archive.
+    """
+    with tarfile.open(str(tar_path), mode='r|*') as tar:
+        return [member.name for member in tar]
+
 
+def zip_members(zip_path):
+    r"""
+    The names of the members of a zip file.
+    """
+    with zipfile.ZipFile(str(zip_path)) as z:
+        return z.namelist()
+
+
+# Default number of threads a zip archive is extracted on - zlib releases the
+# GIL while inflating, so threads are enough to keep every core busy
+DEFAULT_UNPACK_JOBS = cpu_count()
 
-def extract_zip(zip_path, dest_dir):
+
+def _extract_zip_members(zip_path, dest_dir, names):
+    # each thread needs its own handle on the archive
+    with zipfile.ZipFile(str(zip_path)) as z:
+        for name in names:
+            z.extract(name, path=str(dest_dir))
+
+
+def extract_zip(zip_path, dest_dir, members=None,
+                n_jobs=DEFAULT_UNPACK_JOBS):
     r"""
-    Extract a zip file to a destination
+    Extract a zip file (or just the named members of it) to a destination.
+    Every member of a zip is compressed independently, so members are
+    extracted across n_jobs threads.
     """
-    with zipfile.PyZipFile(str(zip_path)) as z:
-        z.extractall(path=str(dest_dir))
+    if members is None:
+        with zipfile.ZipFile(str(zip_path)) as z:
+            members = z.namelist()
+    members = list(members)
+    # make every folder up front, so threads never race to create one
+    for d in set(posixpath.dirname(m.rstrip('/')) for m in members):
+        path = os.path.join(str(dest_dir), *d.split('/'))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    n_jobs = max(1, min(n_jobs, len(members)))
+    if n_jobs == 1:
+        return _extract_zip_members(zip_path, dest_dir, members)
+    # interleave members so each thread gets a similar mix of sizes
+    chunks = [members[i::n_jobs] for i in range(n_jobs)]
+    pool = ThreadPool(processes=n_jobs)
+    try:
+        pool.map(partial(_extract_zip_members, zip_path, dest_dir), chunks)
+    finally:
+        pool.close()
+        pool.join()
 
 
-def extract_archive(path, dest_dir):
+def _member_stems(name):
+    # 'a/img_01_dlib.ljson' -> 'a/img_01_dlib', 'a/img_01', 'a/img'
+    root = posixpath.splitext(name)[0]
+    base_start = root.rfind('/') + 1
+    return [root] + [root[:i] for i in range(len(root) - 1, base_start, -1)
+                     if root[i] == '_']
+
+
+def select_members(names, pattern, max_members=None):
+    r"""
+    The names of the members of an archive matching a glob pattern - only
+    the first max_members of them if max_members is given - along with every
+    member that accompanies them (shares their stem, e.g. the landmarks of
+    an image). Members are taken in the order menpo.io imports files in,
+    which sorts the paths it globs segment by segment (as pathlib does).
+    """
+    # tar members may be stored as './name/...'
+    paths = [posixpath.normpath(n) for n in names]
+    depth = pattern.count('/')
+    selected = sorted((p for p in paths if p.count('/') == depth and
+                       fnmatch.fnmatchcase(p, pattern)),
+                      key=lambda p: p.split('/'))
+    if max_members is not None:
+        selected = selected[:max_members]
+    stems = set(posixpath.splitext(p)[0] for p in selected)
+    return [n for n, p in zip(names, paths)
+            if any(s in stems for s in _member_stems(p))]
+
+
+def extract_archive(path, dest_dir, members=None):
     r"""
-    Extract a given archive file to a destination. Currently supports .zip
-    and .tar.gz
+    Extract a given archive file (or just the named members of it) to a
+    destination. Currently supports .zip and .tar.gz
     """
     if path.suffix == '.zip':
-        return extract_zip(path, dest_dir)
+        return extract_zip(path, dest_dir, members=members)
     elif ''.join(path.suffixes) == '.tar.gz':
-        return extract_tar(path, dest_dir)
+        return extract_tar(path, dest_dir, members=members)
 
 
 def load_module(path):
@@ -234,7 +482,7 @@ def centre_str(s, c=' ', width=80):
     remaining = width - len(s) - 2  # whitespace padding
     if remaining % 2 == 0:
         # remaining space evenly divides!
-        padding = remaining / 2
+        padding = remaining // 2
         return c * padding + ' ' + s + ' ' + c * padding
     else:
         # gah, will have to be a different amount left and right
@@ -273,6 +521,45 @@ class TempDirectory(Singleton):
     def delete_all(cls):
         for d in cls._directories:
             shutil.rmtree(str(d), ignore_errors=True)
+        cls.forget_all()
+
+    @classmethod
+    def forget_all(cls):
+        # leaves the directories on disk - for a forked process whose list
+        # was inherited from a parent still using them
+        cls._directories = []
+
+
+@contextmanager
+def file_lock(path):
+    r"""Hold an exclusive, inter-process lock on the file at path for the
+    duration of the context. Blocks until the lock is available.
+    """
+    with open(str(path), 'a') as f:
+        if is_windows():
+            import msvcrt
+            import time
+            while True:
+                f.seek(0)
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                except IOError:
+                    # LK_LOCK gives up after ~10 seconds - keep waiting
+                    time.sleep(1)
+                else:
+                    break
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 
 def wrap_generator(generator, f):
@@ -294,12 +581,31 @@ def is_linux():
     return 'linux' in platform.system().lower()
 
 
-def randomly_exhaust(*iterables):
+def randomly_exhaust(*iterables, **kwargs):
     # randomly_exhaust('ABC', 'DEF') --> A B F E C D
-    pool = set(iterables)
+    # pass rng=random.Random(seed) for a reproducible order
+    rng = kwargs.get('rng', random)
+    # a list, not a set, so the order doesn't hang on object ids
+    pool = list(iterables)
     while len(pool) > 0:
-        chosen = random.choice(tuple(pool))
+        chosen = rng.choice(pool)
         try:
             yield next(chosen)
         except StopIteration:
             pool.remove(chosen)
+
+
+def in_shard(id_, k, n):
+    r"""True if id_ falls in shard k (counting from 1) of n. Shards are
+    assigned by hashing the id, so don't depend on iteration order.
+    """
+    h = hashlib.sha1(str(id_).encode('utf-8')).hexdigest()
+    return int(h, 16) % n == k - 1
+
+
+def seeded_key(seed, id_):
+    r"""A sort key putting ids in an order fixed by seed. Like in_shard, it
+    only depends on the id, so the same ids always sort the same way however
+    they were listed.
+    """
+    return hashlib.sha1('{}:{}'.format(seed, id_).encode('utf-8')).hexdigest()
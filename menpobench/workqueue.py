@@ -0,0 +1,339 @@
+import errno
+import os
+import socket
+import time
+import traceback
+from contextlib import contextmanager
+from threading import Thread, Event
+from menpobench.base import run_method, merge_shards, mkdir_if_missing
+from menpobench.cache import hash_of_id, flush_uploads, close_uploads
+from menpobench.config import resolve_cache_dir
+from menpobench.experiment import retrieve_experiment, Experiment
+from menpobench.method.matlab.base import close_matlab_session
+from menpobench.utils import (centre_str, create_path, load_json, save_json,
+                              load_yaml, save_yaml, TempDirectory, is_windows)
+
+# A job is a folder in the queue dir holding the experiment (job.yaml), a
+# folder per state of work item, and an output dir per test set shard. A work
+# item is a small JSON file naming a method and a shard. Items are claimed by
+# renaming them from pending/ to claimed/ - only one worker can win the
+# rename, so any number of workers on any number of machines sharing the
+# cache dir can pull from the same job without a broker.
+#
+# A claim is a lease - the worker holding it touches the claimed file every
+# HEARTBEAT_INTERVAL seconds. A claim that hasn't been touched for
+# DEFAULT_LEASE_TIMEOUT seconds (or whose worker process is gone, if it ran on
+# this host) is stale, and is moved back to pending/ for another worker.
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+STATES = [PENDING, CLAIMED, DONE, FAILED]
+
+SECTIONS = {True: 'trainable_methods', False: 'untrainable_methods'}
+
+# Seconds between checks of the queue
+DEFAULT_POLL_INTERVAL = 5
+
+# Seconds between touches of a claimed item by the worker running it
+HEARTBEAT_INTERVAL = 30
+
+# Seconds after the last touch that a claim is considered abandoned
+DEFAULT_LEASE_TIMEOUT = 300
+
+
+# ----------- Queue path management ---------- #
+
+@create_path
+def queue_dir():
+    return resolve_cache_dir() / 'queue'
+
+
+def job_id(config):
+    return hash_of_id(config)[:10]
+
+
+def shard_output_dir(job_path, k):
+    return job_path / 'output' / 'shard-{}'.format(k)
+
+
+def list_items(job_path, state):
+    return sorted((job_path / state).glob('*.json'))
+
+
+def item_name(item_path):
+    # claimed items have the claiming worker appended after an '@'
+    return item_path.stem.split('@')[0] + '.json'
+
+
+def worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def claim_owner(claimed_path):
+    # (host, pid) of the worker holding a claim
+    host, pid = claimed_path.stem.split('@')[1].rsplit('-', 1)
+    return host, int(pid)
+
+
+# ----------- Leases ---------- #
+
+def pid_is_running(pid):
+    if is_windows():
+        # os.kill would terminate the process - assume it is alive and rely
+        # on the lease timeout
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def claim_is_stale(claimed_path, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    try:
+        age = time.time() - os.path.getmtime(str(claimed_path))
+    except OSError:
+        # finished (or requeued) since it was listed
+        return False
+    if age > lease_timeout:
+        return True
+    host, pid = claim_owner(claimed_path)
+    return host == socket.gethostname() and not pid_is_running(pid)
+
+
+def requeue_stale_claims(job_path, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    r"""Move every stale claim of a job back to pending/. Returns the number
+    of items requeued.
+    """
+    n_requeued = 0
+    for claimed_path in list_items(job_path, CLAIMED):
+        if not claim_is_stale(claimed_path, lease_timeout=lease_timeout):
+            continue
+        try:
+            os.rename(str(claimed_path),
+                      str(job_path / PENDING / item_name(claimed_path)))
+        except OSError:
+            # another process requeued it (or the worker finished) first
+            continue
+        print('Requeued abandoned work item {}'.format(claimed_path.name))
+        n_requeued += 1
+    return n_requeued
+
+
+@contextmanager
+def lease(claimed_path, interval=HEARTBEAT_INTERVAL):
+    r"""Touch a claimed item every interval seconds for the duration of the
+    context, so other processes know the claim is still being worked on.
+    """
+    stop = Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                os.utime(str(claimed_path), None)
+            except OSError:
+                # the claim was requeued from under us
+                return
+
+    thread = Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+# ----------- Dispatching ---------- #
+
+def shard_config(config, k, n):
+    # a single shard is the whole test set - left unsharded, so its results
+    # can be read from and written to the results cache
+    return dict(config, shard=[k, n]) if n > 1 else dict(config)
+
+
+def create_job(ex, n_shards, cache_models=False):
+    config = dict(ex.config)
+    config.pop('shard', None)
+    job_path = queue_dir() / job_id(dict(config, n_shards=n_shards))
+    mkdir_if_missing(job_path)
+    for state in STATES:
+        mkdir_if_missing(job_path / state)
+    save_yaml(config, str(job_path / 'job.yaml'))
+    mkdir_if_missing(job_path / 'output')
+    for k in range(1, n_shards + 1):
+        shard_dir = shard_output_dir(job_path, k)
+        mkdir_if_missing(shard_dir)
+        save_yaml(shard_config(config, k, n_shards),
+                  str(shard_dir / 'experiment.yaml'))
+        for d in ['results', 'errors']:
+            mkdir_if_missing(shard_dir / d)
+            for section in SECTIONS.values():
+                mkdir_if_missing(shard_dir / d / section)
+
+    # a job that is dispatched again carries on where it left off - only
+    # failed, abandoned or missing items are queued again
+    requeue_stale_claims(job_path)
+    queued = set(item_name(p) for s in [PENDING, CLAIMED, DONE]
+                 for p in list_items(job_path, s))
+    for p in (job_path / FAILED).iterdir():
+        p.unlink()
+    for trainable, methods in [(True, ex.trainable_methods),
+                               (False, ex.untrainable_methods)]:
+        for i, method in enumerate(methods):
+            for k in range(1, n_shards + 1):
+                name = '{}-{:03d}-{:03d}.json'.format(SECTIONS[trainable], i,
+                                                      k)
+                if name not in queued:
+                    save_json({'trainable': trainable, 'index': i,
+                               'method': method.name, 'shard': [k, n_shards],
+                               'cache_models': cache_models},
+                              str(job_path / PENDING / name))
+    return job_path
+
+
+def wait_for_job(job_path, poll_interval=DEFAULT_POLL_INTERVAL, timeout=None,
+                 lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    r"""Block until nothing in a job is pending or claimed, requeueing
+    abandoned claims as they go stale. Raises a RuntimeError if that takes
+    longer than timeout seconds. Returns the number of items in each state.
+    """
+    start = time.time()
+    last_status = None
+    while True:
+        requeue_stale_claims(job_path, lease_timeout=lease_timeout)
+        counts = dict((s, len(list_items(job_path, s))) for s in STATES)
+        status = ('{pending} pending, {claimed} running, {done} done, '
+                  '{failed} failed'.format(**counts))
+        if status != last_status:
+            print(status)
+            last_status = status
+        if counts[PENDING] == 0 and counts[CLAIMED] == 0:
+            return counts
+        if timeout is not None and time.time() - start > timeout:
+            raise RuntimeError(
+                'Gave up waiting for job {} after {} seconds ({}). Start more '
+                'workers and dispatch the experiment again to carry '
+                'on.'.format(job_path.name, timeout, status))
+        time.sleep(poll_interval)
+
+
+def dispatch(experiment_name, output_dir, n_shards=1, overwrite=False,
+             poll_interval=DEFAULT_POLL_INTERVAL, timeout=None,
+             cache_models=False):
+    r"""Queue every (method, test set shard) pair of an experiment as work
+    for 'menpobench worker' processes, wait for them all to be done and merge
+    the outcome into output_dir. Gives up after timeout seconds if given.
+    Workers reuse (and save) trained models only if cache_models is True.
+    """
+    ex = retrieve_experiment(experiment_name)
+    job_path = create_job(ex, n_shards, cache_models=cache_models)
+    print(centre_str('job: {}'.format(job_path.name)))
+    print(centre_str('queue: {}'.format(job_path)))
+    counts = wait_for_job(job_path, poll_interval=poll_interval,
+                          timeout=timeout)
+    if counts[FAILED] > 0:
+        raise RuntimeError(
+            '{} work items failed - see the logs in {}. Dispatch the '
+            'experiment again to retry them.'.format(counts[FAILED],
+                                                     job_path / FAILED))
+    merge_shards([shard_output_dir(job_path, k)
+                  for k in range(1, n_shards + 1)],
+                 output_dir, overwrite=overwrite)
+
+
+# ----------- Working ---------- #
+
+def claim_item(job_path):
+    requeue_stale_claims(job_path)
+    worker = worker_id()
+    for item_path in list_items(job_path, PENDING):
+        claimed_path = job_path / CLAIMED / '{}@{}.json'.format(
+            item_path.stem, worker)
+        try:
+            # the claim's lease starts now, not when the item was queued
+            os.utime(str(item_path), None)
+            os.rename(str(item_path), str(claimed_path))
+        except OSError:
+            # another worker got there first
+            continue
+        return claimed_path
+    return None
+
+
+def run_item(job_path, claimed_path):
+    item = load_json(claimed_path)
+    k, n = item['shard']
+    print(centre_str('{} - shard {} of {}'.format(item['method'], k, n),
+                     c='='))
+    ex = Experiment(shard_config(load_yaml(job_path / 'job.yaml'), k, n))
+    trainable = item['trainable']
+    methods = ex.trainable_methods if trainable else ex.untrainable_methods
+    shard_dir = shard_output_dir(job_path, k)
+    section = SECTIONS[trainable]
+    # each shard of a trainable method needs the same model - with
+    # cache_models the first worker to get to it trains it and the rest wait
+    # for it to land in the trained model cache (Matlab methods can't be
+    # cached, so are trained for every shard)
+    run_method(ex, methods[item['index']], trainable=trainable, output=True,
+               errors_dir=shard_dir / 'errors' / section,
+               results_dir=shard_dir / 'results' / section,
+               cache_models=item.get('cache_models', False),
+               fit_jobs=ex.fit_jobs)
+
+
+def finish_item(claimed_path, finished_path):
+    try:
+        os.rename(str(claimed_path), str(finished_path))
+    except OSError:
+        # our lease lapsed and the item was requeued - whoever runs it again
+        # will record the outcome
+        print('Lost the claim on {} - leaving it to the worker that '
+              'requeued it'.format(claimed_path.name))
+
+
+def work_on_job(job_path):
+    r"""Claim and run items of a job until none are left pending. Returns the
+    number of items run.
+    """
+    n_run = 0
+    claimed_path = claim_item(job_path)
+    while claimed_path is not None:
+        name = item_name(claimed_path)
+        try:
+            with lease(claimed_path):
+                run_item(job_path, claimed_path)
+        except Exception:
+            log = traceback.format_exc()
+            print(log)
+            with open(str(job_path / FAILED / (name + '.log')), 'wt') as f:
+                f.write(log)
+            finish_item(claimed_path, job_path / FAILED / name)
+        else:
+            finish_item(claimed_path, job_path / DONE / name)
+        n_run += 1
+        claimed_path = claim_item(job_path)
+    return n_run
+
+
+def work(job=None, wait=False, poll_interval=DEFAULT_POLL_INTERVAL):
+    r"""Run queued work items from every job (or just the given job). Returns
+    once nothing is pending, or keeps polling for new work if wait is True.
+    """
+    try:
+        while True:
+            job_paths = ([queue_dir() / job] if job is not None else
+                         sorted(p for p in queue_dir().iterdir()
+                                if (p / 'job.yaml').is_file()))
+            n_run = sum(work_on_job(p) for p in job_paths)
+            if n_run == 0:
+                if not wait:
+                    break
+                time.sleep(poll_interval)
+        flush_uploads()
+    finally:
+        close_uploads()
+        close_matlab_session()
+        TempDirectory.delete_all()